@@ -0,0 +1,89 @@
+"""
+Benchmark of POST /search on a large selections table, buffered json against streamed ndjson
+Reports the time to first byte, total time and the peak RSS of the server process
+
+    python -m benchmarks.search_stream --rows 1000000
+"""
+
+import argparse
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from sportsbook.schema import migrate
+
+PORT = 8765
+
+
+def create_database(path: str, rows: int):
+    """
+    Creates a database with one sport, one event and the given number of selections
+    """
+    migrate(path)
+    connection = sqlite3.connect(path)
+    connection.execute("INSERT INTO sports(sport_name, slug, active) VALUES ('bench', 'bench', true)")
+    connection.execute("INSERT INTO events(event_name, slug, active, type, sport_id, status, scheduled_start) "
+                       "VALUES ('bench', 'bench', true, 'preplay', 1, 'pending', '2030-01-01 00:00:00+00:00')")
+    connection.executemany("INSERT INTO selections(selection_name, event_id, price, active, outcome) VALUES (?, 1, ?, true, 'unsettled')",
+                           ((f"selection{i}", 100 + i % 100) for i in range(rows)))
+    connection.commit()
+    connection.close()
+
+
+def peak_rss(pid: int) -> int:
+    """
+    Returns the peak resident set size of the process in kB
+    """
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmHWM"):
+                return int(line.split()[1])
+
+
+def run(path: str, accept: str):
+    """
+    Starts a fresh server, runs one full search and returns the timings and its peak memory
+    """
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "sportsbook.__main__:app", "--port", str(PORT), "--log-level", "warning"],
+                              env={**os.environ, "DB_PATH": path})
+    try:
+        for _ in range(100):
+            try:
+                httpx.get(f"http://127.0.0.1:{PORT}/docs")
+                break
+            except httpx.ConnectError:
+                time.sleep(0.1)
+        start = time.perf_counter()
+        first_byte = None
+        size = 0
+        with httpx.stream("POST", f"http://127.0.0.1:{PORT}/search", json={"table_name": "selections"},
+                          headers={"Accept": accept}, timeout=None) as response:
+            for chunk in response.iter_raw():
+                if first_byte is None:
+                    first_byte = time.perf_counter() - start
+                size += len(chunk)
+        return first_byte, time.perf_counter() - start, size, peak_rss(server.pid)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        create_database(path, args.rows)
+        for accept in ["application/json", "application/x-ndjson"]:
+            first_byte, total, size, rss = run(path, accept)
+            print(f"{accept:22} first byte {first_byte:.3f}s  total {total:.3f}s  {size / 2**20:.1f} MiB  peak rss {rss / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
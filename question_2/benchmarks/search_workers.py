@@ -0,0 +1,91 @@
+"""
+Load test of POST /search with a growing number of uvicorn workers
+Reports the read throughput for every worker count, the query cache is disabled
+so every request reaches the database
+
+    python -m benchmarks.search_workers --workers 1 2 4 --clients 8 --seconds 10
+"""
+
+import argparse
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from sportsbook.schema import migrate
+
+PORT = 8766
+SEARCH = {"table_name": "selections", "conditions": [{"key": "event_name", "operator": "=", "value": "event7"}]}
+
+
+def create_database(path: str, events: int, selections: int):
+    """
+    Creates a database with one sport and the given number of events, each with the given number of selections
+    """
+    migrate(path)
+    connection = sqlite3.connect(path)
+    connection.execute("INSERT INTO sports(sport_name, slug, active) VALUES ('bench', 'bench', true)")
+    connection.executemany("INSERT INTO events(event_name, slug, active, type, sport_id, status, scheduled_start) "
+                           "VALUES (?, ?, true, 'preplay', 1, 'pending', '2030-01-01 00:00:00+00:00')",
+                           ((f"event{i}", f"event{i}") for i in range(events)))
+    connection.executemany("INSERT INTO selections(selection_name, event_id, price, active, outcome) VALUES (?, ?, 150, true, 'unsettled')",
+                           ((f"selection{i}", 1 + i // selections) for i in range(events * selections)))
+    connection.commit()
+    connection.close()
+
+
+def client(seconds: float) -> int:
+    """
+    Sends searches one after the other for the given time and returns how many succeeded
+    """
+    done = 0
+    with httpx.Client(base_url=f"http://127.0.0.1:{PORT}") as http:
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            if http.post("/search", json=SEARCH).status_code == 200:
+                done += 1
+    return done
+
+
+def run(path: str, workers: int, clients: int, seconds: float) -> float:
+    """
+    Starts the server with the given number of workers and returns the requests per second
+    """
+    server = subprocess.Popen([sys.executable, "-m", "sportsbook", "serve", "--port", str(PORT), "--workers", str(workers)],
+                              env={**os.environ, "DB_PATH": path, "DB_CACHE_SIZE": "0"},
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            try:
+                httpx.post(f"http://127.0.0.1:{PORT}/search", json=SEARCH)
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+        with multiprocessing.Pool(clients) as pool:
+            done = sum(pool.map(client, [seconds] * clients))
+        return done / seconds
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--seconds", type=float, default=10)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        create_database(path, 1000, 50)
+        for workers in args.workers:
+            print(f"{workers} workers: {run(path, workers, args.clients, args.seconds):.0f} requests/sec")
+
+
+if __name__ == "__main__":
+    main()
@@ -11,9 +11,6 @@ if [ ! -f "$DB_FILE" -o ! -s "$DB_FILE" ]; then
   echo "Done."
 fi
 
-echo "Executing database schema..."
-sqlite3 "$DB_FILE" < ./schema_sports.sql
-sqlite3 "$DB_FILE" < ./schema_events.sql
-sqlite3 "$DB_FILE" < ./schema_selections.sql
+# The schema is created and migrated by the app itself on startup (sportsbook/schema.py)
 
 echo "All set."
\ No newline at end of file
@@ -1,19 +1,81 @@
-from fastapi import FastAPI, Request, status
+from fastapi import FastAPI, Query, Request, status
 from fastapi.exceptions import HTTPException
-from fastapi.responses import JSONResponse
+from pydantic import ValidationError
+from typing import List
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from contextlib import asynccontextmanager
 from sqlite3 import IntegrityError
+import argparse
+import asyncio
+import json
+import os
+import sys
 
 
 import uvicorn
 
-from .database import insert_values, fetch_values, update_values
+from .database import pool_stats, get_db, get_db_path, fetch_row, insert_values, insert_many, fetch_values, update_values, stream_values, write_returning, open_pool, close_pool, transaction, query_cache, write_coalescer, commit_hooks
 from .queries import *
+from .names import sport_names, event_names, add_parent_names, NAME_MAPS
+from .pubsub import broker, stream_events
+from .changes import change_feed, compact_periodically
+from .counters import check_counters
+from .book import get_books
+from .tree import get_tree
+from .lifecycle import lifecycle
+from .metrics import metrics, MetricsMiddleware
+from .slowlog import slow_queries
+from .guard import search_limiter, check_cost, SearchStreamingResponse
+from .prices import update_prices
 from .models import *
 from .constants import *
 from .exception import *
 
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Opens the database connection pool on startup and closes it on shutdown
+    """
+    await open_pool()
+    compaction = asyncio.create_task(compact_periodically(
+        float(os.environ.get('DB_CHANGES_COMPACT_INTERVAL', CHANGES_COMPACT_INTERVAL)),
+        float(os.environ.get('DB_CHANGES_RETENTION', CHANGES_RETENTION))))
+    if os.environ.get('EVENT_LIFECYCLE', '1') == '1':
+        lifecycle.resync_interval = float(os.environ.get('EVENT_LIFECYCLE_RESYNC', LIFECYCLE_RESYNC_INTERVAL))
+        lifecycle.start()
+    yield
+    compaction.cancel()
+    await lifecycle.close()
+    await write_coalescer.close()
+    await close_pool()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware)
+
+async def deactivate_sports(events: list, database) -> list:
+    """
+    When all the events of a sport are inactive we need to make that sport inactive
+    Returns the sports made inactive
+    """
+    sport_ids = list({row['sport_id'] for row in events if row['sport_id'] is not None})
+    if not sport_ids:
+        return []
+    return await write_returning(UPDATE_SPORT_EVENT, {"sport_ids": json.dumps(sport_ids)}, database)
+
+async def deactivate_events(selections: list, database) -> list:
+    """
+    Whenever all the selections are inactive update that event to be inactive
+    Returns the events made inactive
+    """
+    event_ids = list({row['event_id'] for row in selections if row['event_id'] is not None})
+    if not event_ids:
+        return []
+    return await write_returning(UPDATE_EVENT_SELECTION, {"event_ids": json.dumps(event_ids)}, database)
+
+write_coalescer.cascades[Tables.SELECTIONS] = deactivate_events
+write_coalescer.on_commit = broker.publish
+commit_hooks.append(change_feed.notify)
 
 def error_handler(func):
     def inner_function(*args, **kwargs):
@@ -25,10 +87,21 @@ def error_handler(func):
 
 @app.exception_handler(IntegrityError)
 @app.exception_handler(NotFoundException)
+@app.exception_handler(InvalidQueryException)
 async def my_exception_handler(request: Request, exc):
     return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, 
         content={"message": str(exc)})
 
+@app.exception_handler(SearchBusyException)
+async def busy_exception_handler(request: Request, exc):
+    return JSONResponse(status_code=status.HTTP_429_TOO_MANY_REQUESTS, headers={"Retry-After": "1"},
+        content={"message": str(exc)})
+
+@app.exception_handler(SearchTimeoutException)
+async def timeout_exception_handler(request: Request, exc):
+    return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"message": str(exc)})
+
 @app.exception_handler(Exception)
 async def my_exception_handler(request: Request, exc):
     return JSONResponse(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, 
@@ -51,8 +124,90 @@ async def insert_sport(sport: Sports):
         Response saying the value is inserted
     """
     response = await insert_values(INSERT_SPORT, dict(sport))
+    sport_names.set(response, sport.sport_name)
     return f'Inserted successfully with id {response}'
    
+async def bulk_insert(items: list, model, table_name: str, query: str) -> list:
+    """
+    Validates all the items up front and inserts the valid ones with one executemany in one transaction
+
+    Parameters
+    ----------
+    items : list
+        items to be inserted, as sent in the request
+    model : BaseModel
+        pydantic model every item is validated with
+    table_name : str
+        table the items are inserted in
+    query : str
+        insert query of the table
+
+    Returns
+    -------
+    list
+        for every item either {"id": inserted id} or {"error": why it was not inserted}
+    """
+    if len(items) > MAX_BULK_SIZE:
+        raise InvalidQueryException(f"At most {MAX_BULK_SIZE} rows can be inserted at once")
+    name_key = NAME_KEYS[table_name]
+    results = [None] * len(items)
+    valid = {}
+    for index, item in enumerate(items):
+        try:
+            values = dict(model.model_validate(item))
+        except ValidationError as exc:
+            results[index] = {"error": exc.errors()[0]['msg']}
+            continue
+        if values[name_key] in valid:
+            results[index] = {"error": f"Duplicate {name_key} {values[name_key]}"}
+            continue
+        valid[values[name_key]] = (index, values)
+
+    # parent is given by name but stored by id
+    if table_name in PARENT_KEYS:
+        parent_name_key, parent_id_key, parent_table = PARENT_KEYS[table_name]
+        for name, (index, values) in list(valid.items()):
+            values[parent_id_key] = await NAME_MAPS[parent_table].get_id(values.pop(parent_name_key))
+            if values[parent_id_key] is None:
+                results[index] = {"error": f"{parent_table} not found"}
+                del valid[name]
+
+    ids = []
+    if valid:
+        async with transaction() as database:
+            names = list(valid)
+            placeholders = ", ".join("?" * len(names))
+            existing = await fetch_values(SELECT_CONDITION.format(table_name=table_name, condition=f"{name_key} IN ({placeholders})"), names, database)
+            for row in existing:
+                index, _ = valid.pop(row[name_key])
+                results[index] = {"error": f"UNIQUE constraint failed: {table_name}.{name_key}"}
+            ids = await insert_many(query, [values for _, values in valid.values()], database)
+    for (index, values), id in zip(valid.values(), ids):
+        results[index] = {"id": id}
+        if table_name in NAME_MAPS:
+            NAME_MAPS[table_name].set(id, values[name_key])
+    if table_name == Tables.EVENTS:
+        lifecycle.schedule([{**values, 'id': id} for (_, values), id in zip(valid.values(), ids)])
+    return results
+
+@error_handler
+@app.post("/sport/bulk")
+async def insert_sports(sports: List[dict]):
+    """
+    Inserts many rows to sports table at once
+
+    Parameters
+    ----------
+    sports : List[dict]
+        list of Sports, every item is validated on its own
+
+    Returns
+    -------
+    HTTPResponse
+        For every item the inserted id or the error
+    """
+    return await bulk_insert(sports, Sports, Tables.SPORTS, INSERT_SPORT)
+
 @error_handler
 @app.put("/sport")
 async def update_sport(sport: UpdateSport):
@@ -71,20 +226,19 @@ async def update_sport(sport: UpdateSport):
     HTTPResponse
         Response saying the value is updated
     """
-    sport_old = None
-    # If the sport name is updated we have the sport name reference in event table
-    # So get the old name inorder to update that value
-    if sport.condition.id and sport.update.sport_name:
-        select_query = SELECT_CONDITION.format(table_name = Tables.SPORTS, condition = f"id= {sport.condition.id}")
-        sport_old = await fetch_values(select_query)
-        if not sport_old:
+    if sport.condition.sport_name:
+        condition = name_condition(Tables.SPORTS, 'sport_name', 'like', ':cond_sport_name')
+        condition_values = {"cond_sport_name": sport.condition.sport_name}
+    else:
+        condition, condition_values = 'id = :cond_id', {"cond_id": sport.condition.id}
+    # events reference the sport by id, so a rename only touches the sport row
+    async with transaction() as database:
+        updated_rows = await update_values(sport, condition, Tables.SPORTS, condition_values, database)
+        if not updated_rows:
             raise NotFoundException("Sport Not Found")
-    condition = f'sport_name like "{sport.condition.sport_name}"' if sport.condition.sport_name else f"id = {sport.condition.id}"
-    response = await update_values(sport, condition, Tables.SPORTS)
-    if not response:
-        raise NotFoundException("Sport Not Found")
-    if sport_old:
-        await insert_values(UPDATE_SPORT_NAME.format(sport_name= sport.update.sport_name, sport_name_old= sport_old[0]['sport_name']))
+    for row in updated_rows:
+        sport_names.set(row['id'], row['sport_name'])
+    await broker.publish(Tables.SPORTS, updated_rows)
     return f"Sport successfully updated"
 
 @error_handler  
@@ -103,9 +257,33 @@ async def insert_event(event: Event):
     HTTPResponse
         Response saying the value is inserted
     """
-    response = await insert_values(INSERT_EVENT, dict(event))
+    values = dict(event)
+    values['sport_id'] = await sport_names.get_id(values.pop('sport_name'))
+    if values['sport_id'] is None:
+        raise NotFoundException("Sport Not Found")
+    response = await insert_values(INSERT_EVENT, values)
+    event_names.set(response, event.event_name)
+    lifecycle.schedule([{**values, 'id': response}])
     return f'Inserted successfully with id {response}'
 
+@error_handler
+@app.post("/event/bulk")
+async def insert_events(events: List[dict]):
+    """
+    Inserts many rows to events table at once
+
+    Parameters
+    ----------
+    events : List[dict]
+        list of Event, every item is validated on its own
+
+    Returns
+    -------
+    HTTPResponse
+        For every item the inserted id or the error
+    """
+    return await bulk_insert(events, Event, Tables.EVENTS, INSERT_EVENT)
+
 @error_handler
 @app.put("/event")
 async def update_event(event: EventUpdate):
@@ -124,29 +302,27 @@ async def update_event(event: EventUpdate):
     HTTPResponse
         Response saying the value is updated
     """
-    event_old = None
-    if event.condition.id and event.update.event_name:
-        select_query = SELECT_CONDITION.format(table_name = Tables.EVENTS, condition = f"id= {event.condition.id}")
-        event_old = await fetch_values(select_query)
-        if not event_old:
-            raise NotFoundException('Event not found')
-
     if event.condition.event_name:
-        condition = f'event_name like "{event.condition.event_name}" ' 
+        condition = name_condition(Tables.EVENTS, 'event_name', 'like', ':cond_event_name')
+        condition_values = {"cond_event_name": event.condition.event_name}
     elif event.condition.sport_name:
-        condition = f'sport_name like "{event.condition.sport_name}" ' 
-    else: 
-        condition = f"id = {event.condition.id}"
-    id = await update_values(event, condition, Tables.EVENTS)
-    if not id:
-        raise NotFoundException("Event not found")
-    
-    select_query = SELECT_CONDITION.format(table_name = Tables.EVENTS, condition = f"id= {id}")
-    updated_value = await fetch_values(select_query)
-    # when all the events of a sport are inactive we need to make that sport inactive
-    await insert_values(UPDATE_SPORT_EVENT.format(sport_name=updated_value[0]['sport_name']))
-    if event_old:
-        await insert_values(UPDATE_EVENT_NAME.format(event_name = event.update.event_name, event_name_old = event_old[0]['event_name']))
+        condition = name_condition(Tables.EVENTS, 'sport_name', 'like', ':cond_sport_name')
+        condition_values = {"cond_sport_name": event.condition.sport_name}
+    else:
+        condition, condition_values = 'id = :cond_id', {"cond_id": event.condition.id}
+    if event.update.sport_name and await sport_names.get_id(event.update.sport_name) is None:
+        raise NotFoundException("Sport Not Found")
+    # selections reference the event by id, so a rename only touches the event row
+    async with transaction() as database:
+        updated_rows = await update_values(event, condition, Tables.EVENTS, condition_values, database)
+        if not updated_rows:
+            raise NotFoundException("Event not found")
+        deactivated = await deactivate_sports(updated_rows, database)
+    for row in updated_rows:
+        event_names.set(row['id'], row['event_name'])
+    lifecycle.schedule(updated_rows)
+    await broker.publish(Tables.EVENTS, updated_rows)
+    await broker.publish(Tables.SPORTS, deactivated)
     return f"Event successfully updated"
 
 @error_handler 
@@ -165,9 +341,31 @@ async def insert_selection(selection: Selection):
     HTTPResponse
         Response saying the value is inserted
     """
-    response = await insert_values(INSERT_SELECTION, dict(selection))
+    values = dict(selection)
+    values['event_id'] = await event_names.get_id(values.pop('event_name'))
+    if values['event_id'] is None:
+        raise NotFoundException("Event not found")
+    response = await insert_values(INSERT_SELECTION, values)
     return f'Inserted successfully with id {response}'
 
+@error_handler
+@app.post("/selection/bulk")
+async def insert_selections(selections: List[dict]):
+    """
+    Inserts many rows to selections table at once
+
+    Parameters
+    ----------
+    selections : List[dict]
+        list of Selection, every item is validated on its own
+
+    Returns
+    -------
+    HTTPResponse
+        For every item the inserted id or the error
+    """
+    return await bulk_insert(selections, Selection, Tables.SELECTIONS, INSERT_SELECTION)
+
 @error_handler
 @app.put("/selection")
 async def update_selection(selection: SelectionUpdate):
@@ -187,24 +385,241 @@ async def update_selection(selection: SelectionUpdate):
         Response saying the value is updated
     """
     if selection.condition.selection_name:
-        condition = f'selection_name like "{selection.condition.selection_name}" ' 
+        condition = name_condition(Tables.SELECTIONS, 'selection_name', 'like', ':cond_selection_name')
+        condition_values = {"cond_selection_name": selection.condition.selection_name}
     elif selection.condition.event_name:
-        condition = f'event_name like "{selection.condition.event_name}" ' 
-    else: 
-        condition = f"id = {selection.condition.id}"
-        
-    id = await update_values(selection, condition, Tables.SELECTIONS)
-    if not id:
+        condition = name_condition(Tables.SELECTIONS, 'event_name', 'like', ':cond_event_name')
+        condition_values = {"cond_event_name": selection.condition.event_name}
+    else:
+        condition, condition_values = 'id = :cond_id', {"cond_id": selection.condition.id}
+    if selection.update.event_name and await event_names.get_id(selection.update.event_name) is None:
         raise NotFoundException("Event not found")
-    select_query = SELECT_CONDITION.format(table_name = Tables.SELECTIONS, condition = f"id= {id}")
-    updated_value = await fetch_values(select_query)
-    # whenever all the selections are inactive update that event to be inactive
-    response = await insert_values(UPDATE_EVENT_SELECTION.format(event_name=updated_value[0]['event_name']))
+    # frequent updates of one selection, like price changes, are batched with other updates
+    if write_coalescer.enabled and not selection.condition.selection_name and not selection.condition.event_name:
+        if await write_coalescer.submit(Tables.SELECTIONS, selection.condition.id, dict(selection.update)) is None:
+            raise NotFoundException("Selection not found")
+        return f"Selection successfully updated"
+    async with transaction() as database:
+        updated_rows = await update_values(selection, condition, Tables.SELECTIONS, condition_values, database)
+        if not updated_rows:
+            raise NotFoundException("Selection not found")
+        deactivated = await deactivate_events(updated_rows, database)
+    await broker.publish(Tables.SELECTIONS, updated_rows)
+    await broker.publish(Tables.EVENTS, deactivated)
     return f"Selection successfully updated"
 
+@error_handler
+@app.put("/selections/prices")
+async def put_prices(prices: SelectionPrices):
+    """
+    Updates the prices of many selections in one transaction
+    The prices are validated together, the invalid ones and the unknown ids are reported and not updated
+
+    Parameters
+    ----------
+    prices : SelectionPrices
+        pydantic model SelectionPrices with the parallel arrays of selection ids and prices
+
+    Returns
+    -------
+    HTTPResponse
+        number of selections updated, and the id and error of every one not updated
+    """
+    if len(prices.id) > MAX_PRICE_UPDATES:
+        raise InvalidQueryException(f"At most {MAX_PRICE_UPDATES} prices can be updated at once")
+    async with transaction() as database:
+        updated_rows, rejected = await update_prices(prices.id, prices.price, database)
+        deactivated = await deactivate_events(updated_rows, database)
+    await broker.publish(Tables.SELECTIONS, updated_rows)
+    await broker.publish(Tables.EVENTS, deactivated)
+    return {"updated": len(updated_rows), "errors": rejected}
+
+async def settle_event(event_id: int, settlement: Settlement, database) -> tuple[list, list]:
+    """
+    Sets the outcome of all the selections of the event and ends the event, within the given transaction
+
+    Parameters
+    ----------
+    event_id : int
+        id of the event to settle
+    settlement : Settlement
+        winning and void selections of the event
+    database : aiosqlite.Connection
+        connection of the running transaction
+
+    Returns
+    -------
+    tuple(list, list)
+        the settled selections and the ended event
+    """
+    selections = await write_returning(SETTLE_SELECTIONS, {"event_id": event_id, "void_all": settlement.void_all,
+                                                           "winners": json.dumps(settlement.winners),
+                                                           "void": json.dumps(settlement.void)}, database)
+    missing = set(settlement.winners + settlement.void) - {row['id'] for row in selections}
+    if missing:
+        raise NotFoundException(f"Selections {sorted(missing)} not found in event {event_id}")
+    events = await write_returning(SETTLE_EVENT, {"event_id": event_id}, database)
+    if not events:
+        raise NotFoundException(f"Event {event_id} not found")
+    return selections, events
+
+async def settle_events(settlements: list) -> str:
+    """
+    Settles all the given (event id, settlement) in one transaction,
+    the sports left without active events are made inactive
+    """
+    selections, events = [], []
+    async with transaction() as database:
+        for event_id, settlement in settlements:
+            event_selections, event = await settle_event(event_id, settlement, database)
+            selections += event_selections
+            events += event
+        sports = await deactivate_sports(events, database)
+    lifecycle.schedule(events)
+    await broker.publish(Tables.SELECTIONS, selections)
+    await broker.publish(Tables.EVENTS, events)
+    await broker.publish(Tables.SPORTS, sports)
+    return f"Settled {len(events)} events and {len(selections)} selections"
+
+@error_handler
+@app.post("/event/{event_id}/settle")
+async def settle(event_id: int, settlement: Settlement):
+    """
+    Settles an event: the winners win, the void selections are void and all the other selections lose.
+    All the selections and the event are made inactive and the event is ended,
+    the sport is made inactive when it has no other active event
+
+    Parameters
+    ----------
+    event_id : int
+        id of the event to settle
+    settlement : Settlement
+        pydantic model Settlement with the ids of the winning and void selections
+
+    Returns
+    -------
+    HTTPResponse
+        Response saying how many selections were settled
+    """
+    return await settle_events([(event_id, settlement)])
+
+@error_handler
+@app.post("/event/settle/bulk")
+async def settle_bulk(settlements: List[EventSettlement]):
+    """
+    Settles many events at once in one transaction, if any event cannot be settled none is
+
+    Parameters
+    ----------
+    settlements : List[EventSettlement]
+        the event id and the winning and void selections of every event
+
+    Returns
+    -------
+    HTTPResponse
+        Response saying how many events and selections were settled
+    """
+    if len(settlements) > MAX_BULK_SIZE:
+        raise InvalidQueryException(f"At most {MAX_BULK_SIZE} events can be settled at once")
+    if len({settlement.event_id for settlement in settlements}) != len(settlements):
+        raise InvalidQueryException("Every event can be settled only once per batch")
+    return await settle_events([(settlement.event_id, settlement) for settlement in settlements])
+
+@error_handler
+@app.get("/event/book")
+async def books(event_id: List[int] = Query([])):
+    """
+    Returns the books of many events at once, in the same columnar format as /event/{event_id}/book
+
+    Parameters
+    ----------
+    event_id : List[int]
+        ids of the events, repeated
+
+    Returns
+    -------
+    HTTPResponse
+        per event the overround and margin, per selection the implied and fair probability and price.
+        Events without active selections have null overround and margin
+    """
+    if not 0 < len(event_id) <= MAX_BULK_SIZE:
+        raise InvalidQueryException(f"Give between 1 and {MAX_BULK_SIZE} event_id")
+    return await get_books(event_id)
+
+@error_handler
+@app.get("/event/{event_id}/book")
+async def book(event_id: int):
+    """
+    Returns the book of an event computed from the prices of its active selections:
+    the implied probability (1 / price) of every selection, the overround (sum of the implied
+    probabilities) and margin (overround - 1) of the event, and the fair probability and price
+    of every selection once the margin is removed
+
+    Parameters
+    ----------
+    event_id : int
+        id of the event
+
+    Returns
+    -------
+    HTTPResponse
+        columnar book of the event
+    """
+    if await fetch_row(Tables.EVENTS, event_id) is None:
+        raise NotFoundException("Event not found")
+    return await get_books([event_id])
+
+@error_handler
+@app.get("/sport/{sport_id}/tree")
+async def sport_tree(sport_id: int, active_only: bool = False, status: List[str] = Query(None)):
+    """
+    Returns the sport with its events and their selections nested, read with one query per level
+
+    Parameters
+    ----------
+    sport_id : int
+        id of the sport
+    active_only : bool
+        only the active events and selections
+    status : List[str]
+        only the events with one of these statuses, repeated
+
+    Returns
+    -------
+    HTTPResponse
+        the sport with its events under events and their selections under selections
+    """
+    sport = await fetch_row(Tables.SPORTS, sport_id)
+    if sport is None:
+        raise NotFoundException("Sport Not Found")
+    return await get_tree(Tables.SPORTS, sport, active_only, status)
+
+@error_handler
+@app.get("/event/{event_id}/tree")
+async def event_tree(event_id: int, active_only: bool = False):
+    """
+    Returns the event with its selections nested
+
+    Parameters
+    ----------
+    event_id : int
+        id of the event
+    active_only : bool
+        only the active selections
+
+    Returns
+    -------
+    HTTPResponse
+        the event with its selections under selections
+    """
+    event = await fetch_row(Tables.EVENTS, event_id)
+    if event is None:
+        raise NotFoundException("Event Not Found")
+    return await get_tree(Tables.EVENTS, event, active_only)
+
 @error_handler
 @app.post("/search")
-async def search(search: Search):
+async def search(search: Search, request: Request):
     """
     Provides a search feature for all the tables
     Here we can provide 
@@ -217,6 +632,11 @@ async def search(search: Search):
         table_name -> name of the same table or parent table
         join_key -> applicable only if we are selecting from parent table
         keys -> if we want to select only particular columns
+    limit, order_by, cursor -> optional keyset pagination, when any of them is given
+        the response is one page of rows and the cursor to pass for the next page
+    With the header Accept: application/x-ndjson the rows are streamed one json per line
+    A search that would scan a large table without an index is rejected unless it is streamed, or paginated without filters,
+    it is interrupted after SEARCH_TIMEOUT seconds and at most SEARCH_CONCURRENCY searches run at once
  
     Parameters
     ----------
@@ -228,8 +648,243 @@ async def search(search: Search):
     HTTPResponse
         All the values that are filtered
     """
-    query = build_search_query(search)
-    return await fetch_values(query) 
+    query, values = build_search_query(search)
+    table_name = search.select.table_name if search.select and search.select.table_name else search.table_name
+    timeout = float(os.environ.get('SEARCH_TIMEOUT', SEARCH_TIMEOUT))
+    if NDJSON_MEDIA_TYPE in request.headers.get("accept", ""):
+        if search.paginated:
+            raise InvalidQueryException("Streamed searches cannot be paginated")
+        # the slot is held until the stream is sent
+        search_limiter.acquire()
+        return SearchStreamingResponse(stream_search(query, values, table_name, timeout, selected_keys(search)),
+                                       media_type=NDJSON_MEDIA_TYPE)
+    with search_limiter.slot():
+        # a page without filters is read in index order up to its limit, with filters the plan tells
+        # if an index serves them or the rows are read until enough of them match
+        if not search.paginated or search.conditions or search.conditions_date or table_name != search.table_name:
+            await check_cost(query, values)
+        rows = await fetch_values(query, values, cache=True, timeout=timeout)
+    if not search.paginated:
+        return await add_parent_names(table_name, rows_from_db(table_name, rows), keys=selected_keys(search))
+    page = rows[:page_size(search)]
+    next_cursor = encode_cursor(page[-1], search.order_by or 'id') if len(rows) > len(page) else None
+    return {"rows": await add_parent_names(table_name, rows_from_db(table_name, page), keys=selected_keys(search)),
+            "next_cursor": next_cursor}
+
+@error_handler
+@app.get("/cache")
+async def cache_stats():
+    """
+    Returns the hit and miss counters of the query cache, to size it
+
+    Returns
+    -------
+    HTTPResponse
+        hits, misses, size and max_size of the cache
+    """
+    return query_cache.stats()
+
+@error_handler
+@app.get("/writes")
+async def write_stats():
+    """
+    Returns the queue depth and batch sizes of the write coalescer
+
+    Returns
+    -------
+    HTTPResponse
+        counters of the write coalescer
+    """
+    return write_coalescer.stats()
+
+@error_handler
+@app.get("/lifecycle")
+async def lifecycle_stats():
+    """
+    Returns the counters of the scheduler that starts the pending events at their scheduled start
+
+    Returns
+    -------
+    HTTPResponse
+        pending events, next scheduled start, events started, batches and the lags in seconds
+        between the scheduled and actual starts
+    """
+    return lifecycle.stats()
+
+@error_handler
+@app.get("/metrics")
+async def metrics_export():
+    """
+    Returns the request and statement latencies with the pool, cache, write, subscriber and
+    lifecycle counters of this worker in the Prometheus text format
+
+    Returns
+    -------
+    HTTPResponse
+        the metrics as text
+    """
+    gauges = {}
+    for prefix, help, stats in (("pool", "Pooled connections", pool_stats()), ("cache", "Query cache", query_cache.stats()),
+                                ("writes", "Write coalescer", write_coalescer.stats()), ("subscribers", "Subscriptions", broker.stats()),
+                                ("lifecycle", "Lifecycle scheduler", lifecycle.stats())):
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                gauges[f"sportsbook_{prefix}_{key}"] = (f"{help} {key.replace('_', ' ')}", float(value))
+    return Response(metrics.render(gauges), media_type=METRICS_MEDIA_TYPE)
+
+@error_handler
+@app.get("/queries/slow")
+async def slow_query_stats(limit: int = 20):
+    """
+    Returns the statements that were slower than DB_SLOW_QUERY_MS for the longest time in total
+
+    Parameters
+    ----------
+    limit : int
+        most statements returned
+
+    Returns
+    -------
+    HTTPResponse
+        per statement its normalized sql, how many times and how long it was slow,
+        its query plan and the redacted parameters of its last slow run
+    """
+    return {"threshold_ms": slow_queries.threshold * 1000, "queries": slow_queries.top(limit)}
+
+@error_handler
+@app.get("/searches")
+async def search_stats():
+    """
+    Returns the number of searches running and rejected because too many were running
+
+    Returns
+    -------
+    HTTPResponse
+        limit, running and rejected counters of the search slots
+    """
+    return search_limiter.stats()
+
+@error_handler
+@app.get("/subscribe")
+async def subscribe(sport_id: List[int] = Query([]), event_id: List[int] = Query([]), selection_id: List[int] = Query([])):
+    """
+    Pushes the changes of the given sports, events and selections as server-sent events
+    A sport covers all its events and their selections, an event covers its selections.
+    Every change is one event named after its table with the changed row as data.
+    A client that does not keep up is dropped with a last dropped event
+
+    Parameters
+    ----------
+    sport_id, event_id, selection_id : List[int]
+        ids to subscribe to, can be repeated
+
+    Returns
+    -------
+    HTTPResponse
+        text/event-stream of the changes
+    """
+    topics = {(Tables.SPORTS, id) for id in sport_id} | {(Tables.EVENTS, id) for id in event_id} \
+        | {(Tables.SELECTIONS, id) for id in selection_id}
+    if not topics:
+        raise InvalidQueryException("Subscribe to at least one sport_id, event_id or selection_id")
+    return StreamingResponse(stream_events(broker.subscribe(topics)), media_type=SSE_MEDIA_TYPE,
+                             headers={"Cache-Control": "no-cache"})
+
+@error_handler
+@app.get("/changes")
+async def changes(after: int = 0, limit: int = CHANGES_PAGE_SIZE, wait: float = 0):
+    """
+    Returns the inserts, updates and deletes of all the tables in the order they were committed
+    Consumers pass the last_seq of the previous response as after to read only the new changes
+
+    Parameters
+    ----------
+    after : int
+        last seq already read, 0 to read from the oldest change kept
+    limit : int
+        most changes returned
+    wait : float
+        long poll, seconds to wait for a change when there is none yet
+
+    Returns
+    -------
+    HTTPResponse
+        changes, last_seq and truncated, truncated is true when changes after the given seq
+        were already compacted and the tables have to be reloaded
+    """
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise InvalidQueryException(f"limit should be between 1 and {MAX_PAGE_SIZE}")
+    if not 0 <= wait <= CHANGES_MAX_WAIT:
+        raise InvalidQueryException(f"wait should be between 0 and {CHANGES_MAX_WAIT}")
+    return await change_feed.read(after, limit, wait)
+
+@error_handler
+@app.post("/counters/check")
+async def counters_check(rebuild: bool = False):
+    """
+    Checks the active children counters of sports and events against the children
+
+    Parameters
+    ----------
+    rebuild : bool
+        recount all the counters from the children
+
+    Returns
+    -------
+    HTTPResponse
+        for sport_counts and event_counts the counters that differed
+    """
+    return await check_counters(rebuild)
+
+@error_handler
+@app.get("/subscribers")
+async def subscriber_stats():
+    """
+    Returns the number of subscribers and of changes pushed and dropped
+
+    Returns
+    -------
+    HTTPResponse
+        counters of the change broker
+    """
+    return broker.stats()
+
+async def stream_search(query: str, values: list, table_name: str, timeout: float = None, keys: list = None):
+    """
+    Yields the rows of the search encoded as newline delimited json, one batch at a time
+    """
+    # the names are looked up on the reader of the stream, a second reader could be taken by other streams
+    async with get_db() as database:
+        async for rows in stream_values(query, values, timeout=timeout, database=database):
+            rows = await add_parent_names(table_name, rows_from_db(table_name, rows), database, keys)
+            yield "".join(json.dumps(row, default=str) + "\n" for row in rows)
+
+def main():
+    """
+    Command line entry point
+    Runs the api by default, and loads fixture files into the database with the load command
+    """
+    parser = argparse.ArgumentParser(prog="sportsbook")
+    commands = parser.add_subparsers(dest="command")
+    serve = commands.add_parser("serve", help="run the api (default)")
+    serve.add_argument("--host", default="0.0.0.0")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--workers", type=int, default=int(os.environ.get('WORKERS', DEFAULT_WORKERS)),
+                       help="number of worker processes, they share the database file")
+    load = commands.add_parser("load", help="load csv or ndjson files into the database")
+    for table_name in Tables:
+        load.add_argument(f"--{table_name}", nargs="+", default=[], metavar="FILE", help=f"files with {table_name}")
+    load.add_argument("--batch-size", type=int, default=LOAD_BATCH_SIZE, help="rows inserted per transaction")
+    args = parser.parse_args(sys.argv[1:] or ["serve"])
+
+    if args.command == "load":
+        from .loader import load_files
+        load_files(get_db_path(), {table_name: getattr(args, table_name) for table_name in Tables}, args.batch_size)
+    elif args.workers > 1:
+        # every worker imports the app on its own and opens its own connection pool
+        uvicorn.run("sportsbook.__main__:app", host=args.host, port=args.port, workers=args.workers)
+    else:
+        uvicorn.run(app, host=args.host, port=args.port)
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    main()
\ No newline at end of file
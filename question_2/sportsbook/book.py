@@ -0,0 +1,87 @@
+"""
+This python file is used to compute the market book of events from the prices of their selections
+The prices of all the requested events are loaded into one array and the implied probabilities,
+overround and fair prices are computed for all of them at once
+"""
+
+import numpy as np
+
+from .constants import PRICE_SCALE
+from .database import fetch_values
+from .queries import BOOK_SELECTIONS
+
+
+def compute_books(event_ids: list, event_of: np.ndarray, selection_ids: np.ndarray, prices: np.ndarray) -> dict:
+    """
+    Computes the book of every event from the decimal prices of its selections
+
+    Parameters
+    ----------
+    event_ids : list
+        ids of the events, in the order of the response
+    event_of : np.ndarray
+        for every selection the index of its event in event_ids
+    selection_ids : np.ndarray
+        ids of the selections
+    prices : np.ndarray
+        decimal prices of the selections
+
+    Returns
+    -------
+    dict
+        columnar book: per event the overround and margin, per selection the event, price,
+        implied probability, fair probability and fair price. Events without selections have null values
+    """
+    implied = np.divide(1.0, prices, out=np.zeros_like(prices), where=prices > 0)
+    overround = np.bincount(event_of, weights=implied, minlength=len(event_ids))
+    has_book = np.bincount(event_of, minlength=len(event_ids)) > 0
+    # fair probabilities are the implied ones normalised to sum to 1 within every event
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fair = implied / overround[event_of]
+        fair_price = np.divide(1.0, fair, out=np.zeros_like(fair), where=fair > 0)
+    overround = np.where(has_book, overround, np.nan)
+    return {
+        "event_id": event_ids,
+        "overround": _column(overround),
+        "margin": _column(overround - 1),
+        "selections": {
+            "event_id": [event_ids[index] for index in event_of.tolist()],
+            "selection_id": selection_ids.tolist(),
+            "price": prices.tolist(),
+            "implied_probability": _column(implied),
+            "fair_probability": _column(fair),
+            "fair_price": _column(fair_price),
+        },
+    }
+
+
+def _column(values: np.ndarray) -> list:
+    """
+    Rounds the column for the response, NaN becomes null
+    """
+    return [None if value != value else value for value in np.round(values, 6).tolist()]
+
+
+async def get_books(event_ids: list) -> dict:
+    """
+    Loads the active selections of the events and computes their books
+
+    Parameters
+    ----------
+    event_ids : list
+        ids of the events
+
+    Returns
+    -------
+    dict
+        columnar book of the events, as returned by compute_books
+    """
+    event_ids = list(dict.fromkeys(event_ids))
+    placeholders = ", ".join("?" * len(event_ids))
+    rows = await fetch_values(BOOK_SELECTIONS.format(placeholders=placeholders), event_ids, cache=True)
+    index = {event_id: position for position, event_id in enumerate(event_ids)}
+    event_of = np.fromiter((index[row['event_id']] for row in rows), dtype=np.intp, count=len(rows))
+    selection_ids = np.fromiter((row['id'] for row in rows), dtype=np.int64, count=len(rows))
+    # prices are stored as whole hundredths
+    prices = np.fromiter((row['price'] for row in rows), dtype=np.int64, count=len(rows)) / PRICE_SCALE
+    return compute_books(event_ids, event_of, selection_ids, prices)
@@ -0,0 +1,100 @@
+"""
+This python file is used to read the change log of sports, events and selections
+Every insert, update and delete appends a row with an increasing seq to the changes table,
+in the same transaction as the write, so consumers can follow the tables from the last seq they read
+"""
+
+import asyncio
+import json
+
+from .constants import CHANGES_POLL_INTERVAL, CHANGES_RETENTION, CHANGES_COMPACT_INTERVAL
+from .database import fetch_values, insert_values
+from .queries import SELECT_CHANGES, SELECT_CHANGES_RANGE, DELETE_CHANGES
+
+
+class ChangeFeed:
+    """
+    Long poll reader of the changes table
+    Waiting readers are woken up by the commits of this process, changes committed
+    by other workers are found by reading again every poll_interval seconds
+    """
+
+    def __init__(self, poll_interval: float = CHANGES_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._event = None
+
+    def notify(self):
+        """
+        Wakes up the waiting readers, called after every commit
+        """
+        if self._event is not None:
+            self._event.set()
+            self._event = None
+
+    def _waiter(self) -> asyncio.Event:
+        if self._event is None:
+            self._event = asyncio.Event()
+        return self._event
+
+    async def read(self, after: int, limit: int, wait: float = 0) -> dict:
+        """
+        Returns the changes after the given seq, waiting up to wait seconds for one if there is none yet
+
+        Parameters
+        ----------
+        after : int
+            last seq the consumer has read, 0 to read from the start
+        limit : int
+            most changes returned
+        wait : float
+            seconds to wait for a change when there is none after the seq
+
+        Returns
+        -------
+        dict
+            changes: the changes in seq order, with data the row after the change
+            last_seq: seq to pass as after on the next read
+            truncated: changes after the given seq were compacted already,
+                the consumer missed them and has to reload the tables
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + wait
+        while True:
+            # taken before reading so a commit between the read and the wait is not missed
+            waiter = self._waiter()
+            rows = await fetch_values(SELECT_CHANGES, [after, limit])
+            remaining = deadline - loop.time()
+            if rows or remaining <= 0:
+                break
+            try:
+                await asyncio.wait_for(waiter.wait(), min(self.poll_interval, remaining))
+            except asyncio.TimeoutError:
+                pass
+        first_seq, last_seq = (await fetch_values(SELECT_CHANGES_RANGE))[0].values()
+        oldest = first_seq if first_seq is not None else (last_seq or 0) + 1
+        for row in rows:
+            row['data'] = json.loads(row['data']) if row['data'] is not None else None
+        return {"changes": rows, "last_seq": rows[-1]['seq'] if rows else after, "truncated": after + 1 < oldest}
+
+
+change_feed = ChangeFeed()
+
+
+async def compact_changes(retention: float = CHANGES_RETENTION) -> int:
+    """
+    Removes the changes older than retention seconds, returns the number of changes removed
+    """
+    return await insert_values(DELETE_CHANGES, {"retention": f"-{int(retention)} seconds"})
+
+
+async def compact_periodically(interval: float = CHANGES_COMPACT_INTERVAL, retention: float = CHANGES_RETENTION):
+    """
+    Compacts the change log every interval seconds until cancelled
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await compact_changes(retention)
+        except Exception:
+            # the database may be busy, the next run removes the changes
+            pass
@@ -12,7 +12,155 @@ class Tables(StrEnum):
     EVENTS = 'events'
     SELECTIONS = 'selections'
 
+# Columns of every table, searches can only refer to these columns
+TABLE_COLUMNS = {
+    Tables.SPORTS: ['id', 'sport_name', 'slug', 'active'],
+    Tables.EVENTS: ['id', 'event_name', 'slug', 'active', 'type', 'sport_id', 'status', 'scheduled_start', 'actual_start'],
+    Tables.SELECTIONS: ['id', 'selection_name', 'event_id', 'price', 'active', 'outcome'],
+}
+
+# Columns that can be NULL, a search cannot be ordered on them
+NULLABLE_COLUMNS = ['actual_start', 'outcome', 'sport_id', 'event_id']
+
+# Largest page returned by a paginated search
+MAX_PAGE_SIZE = 1000
+
+# Rows read from the cursor at a time when a search is streamed
+STREAM_BATCH_SIZE = 500
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+# Child tables reference their parent by id, the name column is still accepted
+# in the api payloads and searches for compatibility
+# child table -> (name column, id column, parent table)
+PARENT_KEYS = {
+    Tables.EVENTS: ('sport_name', 'sport_id', Tables.SPORTS),
+    Tables.SELECTIONS: ('event_name', 'event_id', Tables.EVENTS),
+}
+
+# Full text index of the names of every table
+FTS_TABLES = {
+    Tables.SPORTS: 'sports_fts',
+    Tables.EVENTS: 'events_fts',
+    Tables.SELECTIONS: 'selections_fts',
+}
+
+# Number of children of every parent, in total and active, kept up to date by triggers
+# child table -> counter table
+COUNTER_TABLES = {
+    Tables.EVENTS: 'sport_counts',
+    Tables.SELECTIONS: 'event_counts',
+}
+
+# Unique name column of every table
+NAME_KEYS = {
+    Tables.SPORTS: 'sport_name',
+    Tables.EVENTS: 'event_name',
+    Tables.SELECTIONS: 'selection_name',
+}
+
+# Largest number of rows accepted by a bulk insert
+MAX_BULK_SIZE = 10000
+# Rows inserted per transaction by the offline loader
+LOAD_BATCH_SIZE = 10000
+
 VALID_EVENT_TYPE = ['preplay', 'inplay']
 VALID_EVENT_STATUS = ['pending', 'started', 'ended', 'cancelled']
 VALID_SELECTION_OUTCOME = ['unsettled', 'void', 'lose', 'win']
-VALID_CONDITIONS = ['=', '>', '<', '>=', '<=','like', 'between']
\ No newline at end of file
+VALID_CONDITIONS = ['=', '>', '<', '>=', '<=','like', 'between', 'match', 'prefix']
+# Operators on names that are looked up in the full text index of the names,
+# match finds the names containing the value and prefix the names starting with it
+NAME_INDEX_CONDITIONS = ['like', 'match', 'prefix']
+# Shortest value of a match search, the index is made of 3 character sequences
+MIN_MATCH_LENGTH = 3
+
+# Prices are stored as whole hundredths, the api sends and returns decimal prices
+PRICE_SCALE = 100
+
+# Valid decimal prices, and the most price updates accepted in one request
+MIN_PRICE = 1.01
+MAX_PRICE = 1000.0
+PRICE_TICK = 0.01
+MAX_PRICE_UPDATES = 100000
+
+DEFAULT_DB_PATH = 'sportsbook.db'
+DEFAULT_READER_CONNECTIONS = 4
+# Prepared statements kept per connection, and compiled search shapes kept per process
+STATEMENT_CACHE_SIZE = 256
+SEARCH_CACHE_SIZE = 512
+# Query results kept in memory, and for how many seconds, 0 disables the cache
+CACHE_SIZE = 10000
+CACHE_TTL = 5.0
+# Seconds between two checks for commits of other workers before a cached result is served (DB_CACHE_CHECK_INTERVAL),
+# 0 checks before every hit so a result is never served after another worker changed the database.
+# The changes committed since the last check are read from the change log this many at a time
+CACHE_CHECK_INTERVAL = 0.0
+CACHE_CHECK_BATCH = 1000
+
+# Pragmas applied to every pooled connection as soon as it is opened
+# journal_mode, synchronous and busy_timeout can be overridden with DB_JOURNAL_MODE,
+# DB_SYNCHRONOUS and DB_BUSY_TIMEOUT. WAL lets the readers run while a write is in progress
+CONNECTION_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    'foreign_keys': 'ON',
+    'temp_store': 'MEMORY',
+    'cache_size': -16000,
+}
+
+# A write that finds the database locked by another worker is retried this many times,
+# waiting WRITE_RETRY_DELAY seconds and doubling the wait every time
+WRITE_RETRIES = 5
+WRITE_RETRY_DELAY = 0.05
+
+# Single row updates by id can be batched into one transaction (DB_COALESCE_WRITES=1),
+# a batch is written after COALESCE_DELAY seconds or once COALESCE_MAX_BATCH rows are waiting
+COALESCE_DELAY = 0.005
+COALESCE_MAX_BATCH = 256
+
+# Number of uvicorn worker processes, can be overridden with WORKERS
+DEFAULT_WORKERS = 1
+
+# Changes pushed on /subscribe, a subscriber with SUBSCRIBER_QUEUE_SIZE changes waiting is dropped,
+# a comment is sent after SSE_KEEPALIVE seconds without changes
+SUBSCRIBER_QUEUE_SIZE = 1000
+SSE_KEEPALIVE = 15.0
+SSE_MEDIA_TYPE = "text/event-stream"
+
+# Change log read on /changes, a long poll waits at most CHANGES_MAX_WAIT seconds and looks for
+# changes of other workers every CHANGES_POLL_INTERVAL seconds. Entries older than CHANGES_RETENTION
+# seconds (DB_CHANGES_RETENTION) are removed every CHANGES_COMPACT_INTERVAL seconds
+CHANGES_PAGE_SIZE = 100
+CHANGES_MAX_WAIT = 30.0
+CHANGES_POLL_INTERVAL = 0.2
+CHANGES_RETENTION = 86400
+CHANGES_COMPACT_INTERVAL = 300.0
+
+# Automatic start of the pending events at their scheduled start, the scheduler wakes up at least every
+# LIFECYCLE_MAX_SLEEP seconds so a change of the system clock is noticed, and reloads the pending events every
+# LIFECYCLE_RESYNC_INTERVAL seconds (EVENT_LIFECYCLE_RESYNC) to find the ones written by other workers or the loader
+LIFECYCLE_MAX_SLEEP = 1.0
+LIFECYCLE_RESYNC_INTERVAL = 60.0
+LIFECYCLE_BATCH_SIZE = 10000
+LIFECYCLE_CLOCK_JUMP = 1.0
+
+# Prometheus metrics on /metrics, METRICS=0 turns the timing off. Latencies are counted in these
+# buckets (seconds), and statements that differ only in the number of values of an IN list are counted together
+METRIC_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4"
+
+# Statements slower than SLOW_QUERY_THRESHOLD seconds (DB_SLOW_QUERY_MS, 0 turns it off) are logged with their
+# query plan, the plan is captured once per statement. At most SLOW_QUERY_SHAPES statements are kept for /queries/slow
+SLOW_QUERY_THRESHOLD = 0.1
+SLOW_QUERY_SHAPES = 1000
+
+# Protection of the readers from expensive searches: a search that scans a table of more than SEARCH_MAX_SCAN_ROWS rows
+# without an index is rejected unless it is streamed or paginated without filters, every search is interrupted after SEARCH_TIMEOUT seconds
+# in the database (a streamed search after SEARCH_TIMEOUT seconds per batch), and a worker runs at most SEARCH_CONCURRENCY
+# searches at once. They can be overridden with SEARCH_MAX_SCAN_ROWS, SEARCH_TIMEOUT and SEARCH_CONCURRENCY
+SEARCH_MAX_SCAN_ROWS = 100000
+SEARCH_TIMEOUT = 2.0
+SEARCH_CONCURRENCY = 3
+# sqlite virtual machine steps between two checks of the deadline, and seconds the table sizes are kept for
+PROGRESS_STEPS = 10000
+TABLE_SIZE_TTL = 60.0
@@ -0,0 +1,37 @@
+"""
+This python file is used to check the counters of children kept by the triggers against the children,
+and to rebuild them from scratch when they drifted (e.g. after the counters were edited by hand)
+"""
+
+from .constants import PARENT_KEYS, COUNTER_TABLES
+from .database import fetch_values, insert_values, transaction, query_cache
+from .queries import COUNTER_MISMATCHES, DELETE_COUNTERS, REBUILD_COUNTERS
+
+
+async def check_counters(rebuild: bool = False) -> dict:
+    """
+    Compares every counter with a count of the children
+
+    Parameters
+    ----------
+    rebuild : bool
+        recount all the counters from the children, in the same transaction as the check
+
+    Returns
+    -------
+    dict
+        counter table -> counters that differed, with the counted and the actual numbers
+    """
+    mismatches = {}
+    async with transaction() as database:
+        for table_name, counter_table in COUNTER_TABLES.items():
+            names = {"table_name": table_name, "counter_table": counter_table, "id_key": PARENT_KEYS[table_name][1]}
+            mismatches[counter_table] = await fetch_values(COUNTER_MISMATCHES.format(**names), database=database)
+            if rebuild:
+                await insert_values(DELETE_COUNTERS.format(**names), database=database)
+                await insert_values(REBUILD_COUNTERS.format(**names), database=database)
+    if rebuild:
+        # counts read from the counters are cached as searches of the counted table
+        for table_name in COUNTER_TABLES:
+            query_cache.invalidate(table_name, [])
+    return mismatches
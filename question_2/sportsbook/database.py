@@ -2,90 +2,919 @@
 This python file is used to define all the database related operations
 """
 
-from databases import Database
 import aiosqlite
+import asyncio
+from collections import OrderedDict
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
+import logging
 import os
-from .queries import UPDATE_TABLE
+import re
+import sqlite3
+import time
+from .queries import UPDATE_TABLE, SELECT_CONDITION, SELECT_CHANGES_RANGE, SELECT_CHANGED_ROWS
+from .metrics import metrics
+from .slowlog import slow_queries
+from .schema import migrate
+from .exception import SearchTimeoutException
+from .constants import DEFAULT_DB_PATH, DEFAULT_READER_CONNECTIONS, CONNECTION_PRAGMAS, PARENT_KEYS, COUNTER_TABLES, FTS_TABLES, STATEMENT_CACHE_SIZE, STREAM_BATCH_SIZE
+from .constants import PROGRESS_STEPS, Tables, CACHE_SIZE, CACHE_TTL, CACHE_CHECK_INTERVAL, CACHE_CHECK_BATCH, WRITE_RETRIES, WRITE_RETRY_DELAY, COALESCE_DELAY, COALESCE_MAX_BATCH
+
+logger = logging.getLogger("sportsbook.database")
+
+
+def get_db_path() -> str:
+    """
+    Returns the path of the sqlite database configured through DB_PATH
+    """
+    return os.environ.get('DB_PATH', DEFAULT_DB_PATH)
+
+
+class ConnectionPool:
+    """
+    App lifetime pool of sqlite connections
+    We keep a fixed number of reader connections and a single writer connection,
+    sqlite allows only one writer at a time so all the writes are serialized on it.
+    One more read only connection watches for commits, so the check does not wait behind reads or writes
+    """
+
+    def __init__(self, path: str, readers: int = DEFAULT_READER_CONNECTIONS, pragmas: dict = None):
+        self.path = path
+        self.readers = readers
+        self.pragmas = CONNECTION_PRAGMAS if pragmas is None else pragmas
+        self.loop = None
+        self._readers = None
+        self._writer = None
+        self._writer_lock = None
+        self._watcher = None
+
+    async def _connect(self, read_only: bool = False) -> aiosqlite.Connection:
+        """
+        Opens a new connection in autocommit mode and applies the pragmas
+        Prepared statements are cached per connection, so queries must be built
+        with bound parameters for the same sql text to be reused
+        """
+        connection = aiosqlite.connect(self.path, isolation_level=None, cached_statements=STATEMENT_CACHE_SIZE)
+        # pooled connections live as long as the app, do not block interpreter exit on them
+        connection.daemon = True
+        await connection
+        connection.row_factory = aiosqlite.Row
+        for pragma, value in self.pragmas.items():
+            await connection.execute(f"PRAGMA {pragma} = {value}")
+        if read_only:
+            await connection.execute("PRAGMA query_only = ON")
+        return connection
+
+    async def open(self):
+        """
+        Opens all the reader connections and the writer connection
+        """
+        self.loop = asyncio.get_running_loop()
+        self._writer = await self._connect()
+        self._writer_lock = asyncio.Lock()
+        self._watcher = await self._connect(read_only=True)
+        self._readers = asyncio.Queue()
+        for _ in range(self.readers):
+            self._readers.put_nowait(await self._connect(read_only=True))
+
+    async def close(self):
+        """
+        Closes all the connections held by the pool
+        """
+        if self._writer is not None:
+            await self._writer.close()
+            self._writer = None
+        if self._watcher is not None:
+            await self._watcher.close()
+            self._watcher = None
+        while self._readers is not None and not self._readers.empty():
+            await self._readers.get_nowait().close()
+        self._readers = None
+
+    @asynccontextmanager
+    async def reader(self):
+        """
+        Borrows a read only connection and returns it to the pool once done
+        """
+        connection = await self._readers.get()
+        try:
+            yield connection
+        finally:
+            self._readers.put_nowait(connection)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of reader connections and how many are idle
+        """
+        return {"readers": self.readers, "idle_readers": self._readers.qsize() if self._readers is not None else 0,
+                "writer_busy": int(self._writer_lock is not None and self._writer_lock.locked())}
+
+    async def data_version(self) -> int:
+        """
+        Returns the data version of the watcher connection, it changes when any other connection commits,
+        the writer of this process as well as the ones of other workers
+        """
+        rows = await self._watcher.execute_fetchall("PRAGMA data_version")
+        return rows[0][0]
+
+    async def watch(self, query: str, values: list = None) -> list:
+        """
+        Runs a short read on the watcher connection, without waiting for a reader
+        """
+        return await self._watcher.execute_fetchall(query, values or ())
+
+    @asynccontextmanager
+    async def writer(self):
+        """
+        Waits for the writer connection so only one write runs at a time
+        """
+        async with self._writer_lock:
+            yield self._writer
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of query results, every entry also expires after ttl seconds
+    Rows are cached by table and id and are dropped when that row is written,
+    search results are cached by query and values and are dropped on any write to a table they read.
+    The writes of other workers are read from the change log, which holds the writes of this worker too
+    """
+
+    def __init__(self, max_size: int = CACHE_SIZE, ttl: float = CACHE_TTL, check_interval: float = CACHE_CHECK_INTERVAL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.hits = 0
+        self.misses = 0
+        self.logged_writes = 0
+        # data version of the watcher connection and last seq of the change log when they were last checked
+        self.data_version = None
+        self.seq = None
+        self._next_check = 0.0
+        # number of clears, a read that saw a clear happen meanwhile is not cached
+        self._generation = 0
+        # key -> (expiry, value, tables the value was read from)
+        self._entries = OrderedDict()
+        # table -> keys of the search results read from it
+        self._tables = {}
+        # table -> number of writes, a read that saw a write happen meanwhile is not cached
+        self._versions = {}
+
+    def versions(self, tables) -> tuple:
+        """
+        Returns the write counters of the tables, to be passed to set
+        """
+        return tuple(self._versions.get(table, 0) for table in tables) + (self._generation,)
+
+    def get(self, key):
+        """
+        Returns the cached value, or None when it is not cached or expired
+        """
+        entry = self._entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, tables, versions: tuple):
+        """
+        Caches the value unless one of the tables was written since versions were taken
+        """
+        if self.max_size <= 0 or versions != self.versions(tables):
+            return
+        self._drop(key)
+        self._entries[key] = (time.monotonic() + self.ttl, value, tables)
+        for table in tables:
+            self._tables.setdefault(table, set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._drop(next(iter(self._entries)))
+
+    def invalidate(self, table_name: str, ids=None):
+        """
+        Drops the cached rows with the given ids, all the rows of the table when ids is None,
+        and all the search results read from the table
+        """
+        self._versions[table_name] = self._versions.get(table_name, 0) + 1
+        for key in list(self._tables.get(table_name, ())):
+            self._drop(key)
+        if ids is None:
+            for key in [key for key in self._entries if key[0] == 'row' and key[1] == table_name]:
+                self._drop(key)
+        else:
+            for id in ids:
+                self._drop(('row', table_name, id))
+
+    def needs_check(self) -> bool:
+        """
+        Tells if other workers have to be checked for before serving a cached value
+        """
+        if self.max_size <= 0:
+            return False
+        # the first check takes the seq the cached values are compared to
+        return self.seq is None or (bool(self._entries) and time.monotonic() >= self._next_check)
+
+    def changed(self, changes: list):
+        """
+        Drops what the given rows of the change log wrote
+        """
+        for change in changes:
+            self.invalidate(change['table_name'], [change['row_id']])
+        self.logged_writes += len(changes)
+
+    def checked(self, data_version: int, seq: int):
+        """
+        Records the data version and the last seq of the change log seen by the last check
+        """
+        self.data_version = data_version
+        self.seq = max(seq, self.seq or 0)
+        self._next_check = time.monotonic() + self.check_interval
+
+    def clear(self):
+        """
+        Drops everything, used when the database is opened again
+        """
+        self._generation += 1
+        for table in list(self._versions):
+            self._versions[table] += 1
+        self._entries.clear()
+        self._tables.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters and the current size
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._entries), "max_size": self.max_size,
+                "logged_writes": self.logged_writes}
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            for table in entry[2]:
+                self._tables.get(table, set()).discard(key)
+
+
+query_cache = QueryCache(int(os.environ.get('DB_CACHE_SIZE', CACHE_SIZE)), float(os.environ.get('DB_CACHE_TTL', CACHE_TTL)),
+                         float(os.environ.get('DB_CACHE_CHECK_INTERVAL', CACHE_CHECK_INTERVAL)))
+
+# writes done in the running transaction, invalidated again once it commits
+_transaction_writes = ContextVar('transaction_writes', default=None)
+
+WRITE_TABLE = re.compile(r"^\s*(?:INSERT\s+INTO|UPDATE)\s+(\w+)", re.IGNORECASE)
+
+def tables_in(query: str) -> tuple:
+    """
+    Returns the tables the query refers to, a counter table stands for the table it counts
+    and a full text index for the table of the names
+    """
+    return tuple(table.value for table in Tables if re.search(rf"\b{table.value}\b", query)
+                 or (table in COUNTER_TABLES and re.search(rf"\b{COUNTER_TABLES[table]}\b", query))
+                 or re.search(rf"\b{FTS_TABLES[table]}\b", query))
+
+def record_write(query: str, ids=None):
+    """
+    Invalidates the cache for a write, ids are the rows written or None when they are not known
+    """
+    match = WRITE_TABLE.match(query)
+    if not match:
+        return
+    query_cache.invalidate(match.group(1), ids)
+    writes = _transaction_writes.get()
+    if writes is not None:
+        writes.append((match.group(1), ids))
+
+
+# functions called without arguments after every commit of this process
+commit_hooks = []
+
+_pool = None
+
+async def open_pool() -> ConnectionPool:
+    """
+    Migrates the schema and opens the pool for the running event loop
+    Called from the app startup, and lazily by get_db if the app was not started
+    (or was started on a different event loop)
+    """
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+    # the data version is per connection, what was cached before the new watcher cannot be checked
+    query_cache.clear()
+    query_cache.data_version = query_cache.seq = None
+    migrate(get_db_path())
+    readers = int(os.environ.get('DB_READERS', DEFAULT_READER_CONNECTIONS))
+    pragmas = dict(CONNECTION_PRAGMAS)
+    for pragma in ('journal_mode', 'synchronous', 'busy_timeout'):
+        pragmas[pragma] = os.environ.get(f'DB_{pragma.upper()}', pragmas[pragma])
+    pool = ConnectionPool(get_db_path(), readers=readers, pragmas=pragmas)
+    await pool.open()
+    _pool = pool
+    return pool
+
+def pool_stats() -> dict:
+    """
+    Returns the stats of the open pool, zeros when it is not open
+    """
+    if _pool is None:
+        return {"readers": 0, "idle_readers": 0, "writer_busy": 0}
+    return _pool.stats()
+
+async def close_pool():
+    """
+    Closes the pool, called from the app shutdown
+    """
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
 
 @asynccontextmanager
-async def get_db():
-    """Return a database connection for use as a dependency.
+async def get_db(write: bool = False):
+    """Return a pooled database connection for use as a dependency.
     This connection has the Row row factory automatically attached."""
-    db = os.environ.get('DB_PATH', 'sportsbook.db')
-    database = Database(f'sqlite+aiosqlite:///{db}')
-    await database.connect()
-    database.row_factory = aiosqlite.Row
+    pool = _pool
+    if pool is None or pool.loop is not asyncio.get_running_loop():
+        pool = await open_pool()
+    started = metrics.clock()
+    async with (pool.writer() if write else pool.reader()) as database:
+        metrics.observe_wait("writer" if write else "reader", started)
+        yield database
 
-    try:
+
+def is_busy(exc: Exception) -> bool:
+    """
+    Tells if the error is another connection holding the write lock
+    """
+    return isinstance(exc, sqlite3.OperationalError) and ('locked' in str(exc) or 'busy' in str(exc))
+
+async def begin(database):
+    """
+    Starts a write transaction, when other workers hold the write lock for longer than
+    busy_timeout the transaction is retried with a growing delay instead of failing
+    """
+    for attempt in range(WRITE_RETRIES):
+        try:
+            await database.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as exc:
+            if not is_busy(exc) or attempt == WRITE_RETRIES - 1:
+                raise
+            await asyncio.sleep(WRITE_RETRY_DELAY * 2 ** attempt)
+
+@asynccontextmanager
+async def transaction():
+    """
+    Runs the enclosed statements as one unit of work on the writer connection
+    Commits when the block finishes and rolls back if it raises
+    """
+    async with get_db(write=True) as database:
+        writes = []
+        token = _transaction_writes.set(writes)
+        await begin(database)
+        try:
+            yield database
+        except BaseException:
+            await database.execute("ROLLBACK")
+            raise
+        finally:
+            _transaction_writes.reset(token)
+        await database.execute("COMMIT")
+        # reads that ran before the commit may have cached the old values
+        for table_name, ids in writes:
+            query_cache.invalidate(table_name, ids)
+        for hook in commit_hooks:
+            hook()
+
+@asynccontextmanager
+async def use_db(database=None, write: bool = False):
+    """
+    Yields the given connection, or a pooled one when no connection is given
+    A write without a connection runs in its own transaction, so it takes the write lock
+    (with retries) before running instead of failing on a busy database
+    """
+    if database is not None:
         yield database
+    elif write:
+        async with transaction() as database:
+            yield database
+    else:
+        async with get_db() as database:
+            yield database
+
+
+def _clock() -> float:
+    """
+    Returns the start time of a statement, None when neither the metrics nor the slow query log need it
+    """
+    return time.perf_counter() if metrics.enabled or slow_queries.enabled else None
+
+async def _observe(query: str, values, started: float, rows: int, database):
+    """
+    Records the duration of a statement that started at started in the metrics and the slow query log
+    """
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    metrics.observe_query(query, seconds, rows)
+    await slow_queries.record(query, values, seconds, database)
+
+class Deadline:
+    """
+    Interrupts the statements of a connection that run past the deadline, through the progress handler
+    sqlite calls every PROGRESS_STEPS steps. The deadline can be moved to time several statements one by one
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.end = None
+        self.restart()
+
+    def restart(self):
+        self.end = time.monotonic() + self.seconds
+
+    def expired(self) -> bool:
+        return time.monotonic() > self.end
+
+@asynccontextmanager
+async def deadline(database, seconds: float = None):
+    """
+    Runs the enclosed statements on the connection with a deadline, yields the Deadline or None without one
+    A statement still running after seconds is interrupted and SearchTimeoutException is raised
+    """
+    if not seconds:
+        yield None
+        return
+    timer = Deadline(seconds)
+    await database.set_progress_handler(timer.expired, PROGRESS_STEPS)
+    try:
+        yield timer
+    except sqlite3.OperationalError as exc:
+        if 'interrupted' not in str(exc):
+            raise
+        raise SearchTimeoutException(f"The query took longer than {seconds} seconds") from exc
     finally:
-        await database.disconnect()
+        await database.set_progress_handler(None, 0)
 
+async def check_other_writers():
+    """
+    Drops the cached values written since the last check, so a value is not served after another worker
+    changed it. The data version tells if anything was committed, the change log tells what
+    """
+    pool = _pool
+    if pool is None or pool.loop is not asyncio.get_running_loop():
+        # opening drops the cache, so it is done before the versions of a lookup are taken
+        pool = await open_pool()
+    if not query_cache.needs_check():
+        return
+    data_version = await pool.data_version()
+    if query_cache.seq is None:
+        # nothing is cached yet, the check starts from the end of the log
+        seq = (await pool.watch(SELECT_CHANGES_RANGE))[0]['last_seq'] or 0
+        if query_cache.seq is None:
+            query_cache.checked(data_version, seq)
+        return
+    if data_version == query_cache.data_version:
+        query_cache.checked(data_version, query_cache.seq)
+        return
+    seq = query_cache.seq
+    while True:
+        changes = await pool.watch(SELECT_CHANGED_ROWS, [seq, CACHE_CHECK_BATCH])
+        query_cache.changed(changes)
+        if len(changes) < CACHE_CHECK_BATCH:
+            break
+        seq = changes[-1]['seq']
+    # the version read before the log, a commit after it is seen by the next check
+    query_cache.checked(data_version, changes[-1]['seq'] if changes else seq)
 
-async def fetch_values(query : str, values : list =None ) -> list(dict):
+async def fetch_values(query : str, values : list =None, database=None, cache : bool =False, timeout : float =None) -> list[dict]:
     """
     Executes the given query and returns all the rows that match the condition
- 
+
     Parameters
     ----------
     query : str
         query to be executes
     values : list
         if there are any values to be replaced
- 
+    database : aiosqlite.Connection
+        connection to run on, used to read inside a transaction
+    cache : bool
+        read through the query cache, the cached rows are shared between callers
+    timeout : float
+        seconds after which the query is interrupted, no limit when None
+
     Returns
     -------
     list(dict)
         The dictionary of the selected rows
     """
-    async with get_db() as database:
-        rows = await database.fetch_all(query=query, values=values)
-        return [row._asdict() for row in rows]
+    cache = cache and database is None
+    if cache:
+        await check_other_writers()
+        key = ('search', query, tuple(values or ()))
+        rows = query_cache.get(key)
+        if rows is not None:
+            return rows
+        tables = tables_in(query)
+        versions = query_cache.versions(tables)
+    async with use_db(database) as database:
+        started = _clock()
+        async with deadline(database, timeout):
+            rows = await database.execute_fetchall(query, values or ())
+        rows = [dict(row) for row in rows]
+        await _observe(query, values, started, len(rows), database)
+    if cache:
+        query_cache.set(key, rows, tables, versions)
+    return rows
+
+async def fetch_row(table_name : str, id : int) -> dict:
+    """
+    Returns the row with the given id, read through the query cache
 
-async def insert_values(query : str, values : list =None) -> int:
+    Parameters
+    ----------
+    table_name : str
+        table to read from
+    id : int
+        id of the row
+
+    Returns
+    -------
+    dict
+        The selected row, None if there is no such row
+    """
+    await check_other_writers()
+    key = ('row', table_name, id)
+    row = query_cache.get(key)
+    if row is None:
+        versions = query_cache.versions((table_name,))
+        rows = await fetch_values(SELECT_CONDITION.format(table_name=table_name, condition="id = ?"), [id])
+        if not rows:
+            return None
+        row = rows[0]
+        query_cache.set(key, row, (table_name,), versions)
+    return dict(row)
+
+async def stream_values(query : str, values : list =None, batch_size : int =STREAM_BATCH_SIZE, timeout : float =None, database=None):
+    """
+    Executes the given query and yields the rows in batches, so the whole result
+    is never held in memory. The reader connection is held until the generator is closed
+
+    Parameters
+    ----------
+    query : str
+        query to be executes
+    values : list
+        if there are any values to be replaced
+    batch_size : int
+        number of rows fetched from the cursor at a time
+    timeout : float
+        seconds after which reading one batch is interrupted, no limit when None
+    database : aiosqlite.Connection
+        connection to run on, for the caller to run its own queries between the batches
+        without waiting for a second reader
+
+    Yields
+    ------
+    list(dict)
+        The dictionary of the next batch of rows
+    """
+    async with use_db(database) as database:
+        # only the time spent in the database is counted, not the time the client takes to read the batches
+        started, busy, count = _clock(), 0.0, 0
+        async with deadline(database, timeout) as timer, database.execute(query, values or ()) as cursor:
+            while rows := await cursor.fetchmany(batch_size):
+                if started is not None:
+                    busy += time.perf_counter() - started
+                count += len(rows)
+                yield [dict(row) for row in rows]
+                started = _clock()
+                if timer is not None:
+                    timer.restart()
+            if started is not None:
+                await _observe(query, values, started - busy, count, database)
+
+async def insert_values(query : str, values : list =None, database=None) -> int:
     """
     Inserts the values into the database
- 
+
     Parameters
     ----------
     query : str
         query to be executes
     values : list
         if there are any values to be replaced
- 
+    database : aiosqlite.Connection
+        connection to run on, used to write inside a transaction
+
     Returns
     -------
     int
-        updated row id
+        inserted row id, or the number of rows changed for other statements
     """
-    async with get_db() as database:
-        return await database.execute(query=query, values=values)
+    async with use_db(database, write=True) as database:
+        started = _clock()
+        async with database.execute(query, values or ()) as cursor:
+            if query.lstrip().upper().startswith("INSERT"):
+                record_write(query, [cursor.lastrowid])
+                await _observe(query, values, started, 1, database)
+                return cursor.lastrowid
+            if "RETURNING" in query.upper():
+                rows = await cursor.fetchall()
+                record_write(query, [row['id'] for row in rows])
+                await _observe(query, values, started, len(rows), database)
+                return len(rows)
+            record_write(query)
+            await _observe(query, values, started, max(cursor.rowcount, 0), database)
+            return cursor.rowcount
 
-async def update_values(model, condition : str, table_name : str) -> int:
+async def write_returning(query : str, values : dict =None, database=None) -> list[dict]:
     """
-    Updates the values in the database and returns the updated id
- 
+    Runs a write with a RETURNING clause and returns the changed rows
+
+    Parameters
+    ----------
+    query : str
+        insert, update or delete query ending in RETURNING
+    values : dict
+        if there are any values to be replaced
+    database : aiosqlite.Connection
+        connection to run on, used to write inside a transaction
+
+    Returns
+    -------
+    list(dict)
+        the rows returned by the query
+    """
+    async with use_db(database, write=True) as database:
+        started = _clock()
+        rows = [dict(row) for row in await database.execute_fetchall(query, values or ())]
+        await _observe(query, values, started, len(rows), database)
+        record_write(query, [row['id'] for row in rows])
+        return rows
+
+async def insert_many(query : str, values : list, database) -> list[int]:
+    """
+    Inserts all the rows with one executemany, to be run inside a transaction
+
+    Parameters
+    ----------
+    query : str
+        insert query to be executed for every row
+    values : list
+        values of every row
+    database : aiosqlite.Connection
+        connection of the running transaction
+
+    Returns
+    -------
+    list(int)
+        ids of the inserted rows, in the order of values
+    """
+    table_name = WRITE_TABLE.match(query).group(1)
+    # AUTOINCREMENT ids are handed out in order and the transaction holds the write lock,
+    # so the new rows get the ids right after the current sequence
+    rows = await database.execute_fetchall("SELECT seq FROM sqlite_sequence WHERE name = ?", [table_name])
+    sequence = rows[0]['seq'] if rows else 0
+    started = _clock()
+    await database.executemany(query, values)
+    # the plan is the same for every row
+    await _observe(query, values[0] if values else None, started, len(values), database)
+    ids = list(range(sequence + 1, sequence + 1 + len(values)))
+    record_write(query, ids)
+    return ids
+
+def update_columns(table_name : str, update : dict) -> tuple[str, dict]:
+    """
+    Builds the set clause of an update from the values that are not None
+
     Parameters
     ----------
-    model : pydanticmodel
-        query to be executes
-    condition : str
-        where condition to update
     table_name : str
         table name to update the data
- 
+    update : dict
+        column -> new value, None values are left unchanged
+
     Returns
     -------
-    int
-        updated row id
+    tuple(str, dict)
+        the set clause and the values for its named parameters
     """
-    
     values = ""
     values_dict = {}
-    for key, value in model.update:
+    name_key, id_key, parent_table = PARENT_KEYS.get(table_name, (None, None, None))
+    for key, value in update.items():
         if value is not None:
-            values = f'{values}, {key}=:{key}' if values else f'{key}=:{key}'
+            # parent is given by name but stored by id
+            column = f'{id_key}=(select id from {parent_table} where {key}=:{key})' if key == name_key else f'{key}=:{key}'
+            values = f'{values}, {column}' if values else column
             values_dict[key] = value
-    query = UPDATE_TABLE.format(table_name = table_name, values = values, condition = condition)    
-    return await insert_values(query=query, values=values_dict)
\ No newline at end of file
+    return values, values_dict
+
+async def update_values(model, condition : str, table_name : str, condition_values : dict =None, database=None) -> list[dict]:
+    """
+    Updates the values in the database and returns the updated rows
+
+    Parameters
+    ----------
+    model : pydanticmodel
+        query to be executes
+    condition : str
+        where condition to update, can refer to named parameters
+    table_name : str
+        table name to update the data
+    condition_values : dict
+        values for the named parameters used in the condition
+    database : aiosqlite.Connection
+        connection to run on, used to write inside a transaction
+
+    Returns
+    -------
+    list(dict)
+        updated rows as they are after the update
+    """
+
+    values, values_dict = update_columns(table_name, dict(model.update))
+    values_dict.update(condition_values or {})
+    query = UPDATE_TABLE.format(table_name = table_name, values = values, condition = condition)
+    async with use_db(database, write=True) as database:
+        started = _clock()
+        rows = await database.execute_fetchall(query, values_dict)
+        rows = [dict(row) for row in rows]
+        await _observe(query, values_dict, started, len(rows), database)
+    record_write(query, [row['id'] for row in rows])
+    return rows
+
+
+class WriteCoalescer:
+    """
+    Write behind queue for high frequency updates of single rows by id
+    Updates are collected for delay seconds or until max_batch rows are waiting, repeated
+    updates of the same row are merged so only the last value of every column is written,
+    and the whole batch is committed in one transaction. submit returns once the batch is committed
+    Tables can register a cascade that runs inside the same transaction with the updated rows
+    """
+
+    def __init__(self, enabled: bool = False, delay: float = COALESCE_DELAY, max_batch: int = COALESCE_MAX_BATCH):
+        self.enabled = enabled
+        self.delay = delay
+        self.max_batch = max_batch
+        # table -> async function(rows, database) run after every batch that updated the table,
+        # returning the rows it changed in the parent table
+        self.cascades = {}
+        # async function(table, rows) called with the changed rows of every table once a batch is committed
+        self.on_commit = None
+        self.submitted = 0
+        self.written = 0
+        self.batches = 0
+        self.largest_batch = 0
+        self.loop = None
+        self._pending = OrderedDict()
+        self._task = None
+
+    def _start(self):
+        """
+        Starts the flushing task on the running event loop
+        """
+        self.loop = asyncio.get_running_loop()
+        self._pending = OrderedDict()
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task = self.loop.create_task(self._run())
+
+    async def submit(self, table_name: str, id: int, values: dict) -> dict:
+        """
+        Queues the update of one row and waits until it is committed
+
+        Parameters
+        ----------
+        table_name : str
+            table name to update the data
+        id : int
+            id of the row
+        values : dict
+            column -> new value, None values are left unchanged
+
+        Returns
+        -------
+        dict
+            the row after the batch was written, None if there is no row with the id
+        """
+        if self._task is None or self.loop is not asyncio.get_running_loop():
+            self._start()
+        future = self.loop.create_future()
+        update, futures = self._pending.setdefault((table_name, id), ({}, []))
+        update.update({key: value for key, value in values.items() if value is not None})
+        futures.append(future)
+        self.submitted += 1
+        self._wakeup.set()
+        if len(self._pending) >= self.max_batch:
+            self._full.set()
+        return await future
+
+    async def close(self):
+        """
+        Writes what is still queued and stops the flushing task
+        """
+        if self._task is not None and self.loop is asyncio.get_running_loop():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            if self._pending:
+                batch, self._pending = self._pending, OrderedDict()
+                await self._flush(batch)
+        self._task = None
+
+    def stats(self) -> dict:
+        """
+        Returns the queue depth and batch size counters
+        """
+        return {"enabled": self.enabled, "queue_depth": len(self._pending), "submitted": self.submitted,
+                "written": self.written, "batches": self.batches, "largest_batch": self.largest_batch,
+                "average_batch": round(self.written / self.batches, 2) if self.batches else 0}
+
+    async def _run(self):
+        """
+        Waits for the first update, then collects updates until the batch is full or delay passed
+        """
+        while True:
+            await self._wakeup.wait()
+            if len(self._pending) < self.max_batch:
+                try:
+                    await asyncio.wait_for(self._full.wait(), self.delay)
+                except asyncio.TimeoutError:
+                    pass
+            batch, self._pending = self._pending, OrderedDict()
+            self._wakeup.clear()
+            self._full.clear()
+            # a batch that started writing is finished even if the queue is closed meanwhile
+            await asyncio.shield(self._flush(batch))
+
+    async def _flush(self, batch: OrderedDict):
+        """
+        Writes the batch in one transaction, when it fails every row is written on its own
+        so only the rows at fault get the error
+        """
+        try:
+            rows, changed = await self._write(batch)
+        except Exception as exc:
+            if len(batch) == 1:
+                for future in next(iter(batch.values()))[1]:
+                    if not future.done():
+                        future.set_exception(exc)
+                return
+            for key, entry in batch.items():
+                await self._flush(OrderedDict([(key, entry)]))
+            return
+        for key, (_, futures) in batch.items():
+            for future in futures:
+                if not future.done():
+                    future.set_result(rows.get(key))
+        if self.on_commit is not None:
+            # the batch is committed already, a failing listener must not stop the queue
+            # nor keep the other tables from being notified
+            for table_name, table_rows in changed.items():
+                try:
+                    await self.on_commit(table_name, table_rows)
+                except Exception:
+                    logger.exception("Listener failed on the committed changes of %s", table_name)
+
+    async def _write(self, batch: OrderedDict) -> dict:
+        """
+        Updates every row of the batch and runs the cascades in one transaction
+        Returns (table, id) -> updated row, and table -> rows changed by the batch and the cascades
+        """
+        rows = {}
+        changed = {}
+        async with transaction() as database:
+            for (table_name, id), (update, _) in batch.items():
+                values, values_dict = update_columns(table_name, update)
+                values_dict['cond_id'] = id
+                query = UPDATE_TABLE.format(table_name=table_name, values=values, condition="id = :cond_id")
+                started = _clock()
+                updated = await database.execute_fetchall(query, values_dict)
+                await _observe(query, values_dict, started, len(updated), database)
+                record_write(query, [id])
+                if updated:
+                    rows[(table_name, id)] = dict(updated[0])
+            for (table_name, _), row in rows.items():
+                changed.setdefault(table_name, []).append(row)
+            for table_name, cascade in self.cascades.items():
+                if changed.get(table_name):
+                    parent_rows = await cascade(changed[table_name], database)
+                    if parent_rows:
+                        changed.setdefault(PARENT_KEYS[table_name][2], []).extend(parent_rows)
+        self.batches += 1
+        self.written += len(batch)
+        self.largest_batch = max(self.largest_batch, len(batch))
+        return rows, changed
+
+
+write_coalescer = WriteCoalescer(os.environ.get('DB_COALESCE_WRITES', '0') == '1',
+                                 float(os.environ.get('DB_COALESCE_DELAY', COALESCE_DELAY)),
+                                 int(os.environ.get('DB_COALESCE_MAX_BATCH', COALESCE_MAX_BATCH)))
@@ -7,3 +7,31 @@ class NotFoundException(Exception):
     Exception raised when a value is not found
     """
     pass
+
+
+class InvalidQueryException(Exception):
+    """
+    Exception raised when a search refers to an unknown table or column
+    """
+    pass
+
+
+class QueryCostException(InvalidQueryException):
+    """
+    Exception raised when a search would scan a large table without using an index
+    """
+    pass
+
+
+class SearchBusyException(Exception):
+    """
+    Exception raised when the worker already runs as many searches as it allows
+    """
+    pass
+
+
+class SearchTimeoutException(Exception):
+    """
+    Exception raised when a search runs for longer than its deadline and is interrupted
+    """
+    pass
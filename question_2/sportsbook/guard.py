@@ -0,0 +1,125 @@
+"""
+This python file is used to keep expensive searches from holding the reader connections
+A search is checked against its query plan before it runs and rejected when it would scan a large table
+without an index, it is interrupted once it runs past its deadline, and every worker runs a bounded
+number of searches at once so the other reads always find a free reader
+"""
+
+from contextlib import contextmanager
+import os
+import time
+
+from fastapi.responses import StreamingResponse
+
+from .constants import Tables, SEARCH_MAX_SCAN_ROWS, SEARCH_CONCURRENCY, TABLE_SIZE_TTL, SEARCH_CACHE_SIZE
+from .database import fetch_values
+from .exception import QueryCostException, SearchBusyException
+
+
+class SearchLimiter:
+    """
+    Bounds the number of searches running at once, a search over the limit is rejected right away
+    instead of waiting for a reader connection
+    """
+
+    def __init__(self, limit: int = SEARCH_CONCURRENCY):
+        self.limit = limit
+        self.running = 0
+        self.rejected = 0
+
+    def acquire(self):
+        if self.running >= self.limit:
+            self.rejected += 1
+            raise SearchBusyException(f"Too many searches running, at most {self.limit} at once")
+        self.running += 1
+
+    def release(self):
+        self.running -= 1
+
+    @contextmanager
+    def slot(self):
+        """
+        Holds one of the search slots for the enclosed block
+        """
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "running": self.running, "rejected": self.rejected}
+
+
+search_limiter = SearchLimiter(int(os.environ.get('SEARCH_CONCURRENCY', SEARCH_CONCURRENCY)))
+
+
+class SearchStreamingResponse(StreamingResponse):
+    """
+    Streamed search holding the search slot taken before it was returned, the slot is released once the
+    response is sent or fails, also when the body was never read e.g. the client left before it
+    """
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            search_limiter.release()
+
+# sql of a compiled search -> tables its plan scans without an index
+_scans = {}
+# table -> (expiry, number of rows)
+_sizes = {}
+
+
+async def scanned_tables(query: str, values: list) -> tuple:
+    """
+    Returns the tables the query plan reads in full, the plan is kept per compiled search
+    "SCAN events" reads the whole table, as does "SCAN events USING INDEX ..." in index order. The tables
+    looked up through an index ("SEARCH selections ...") after a scan are joined to every scanned row,
+    so they are read in full too, e.g. all the selections of all the events
+    """
+    scans = _scans.get(query)
+    if scans is None:
+        plan = await fetch_values(f"EXPLAIN QUERY PLAN {query}", values)
+        scans, scanning = set(), False
+        for words in (row['detail'].split() for row in plan):
+            if len(words) < 2 or words[1] not in list(Tables):
+                continue
+            scanning = scanning or words[0] == "SCAN"
+            if scanning:
+                scans.add(words[1])
+        scans = tuple(sorted(scans))
+        if len(_scans) >= SEARCH_CACHE_SIZE:
+            _scans.clear()
+        _scans[query] = scans
+    return scans
+
+async def table_size(table_name: str) -> int:
+    """
+    Returns about how many rows the table has, the largest id as rows are seldom deleted
+    """
+    size = _sizes.get(table_name)
+    if size is None or size[0] < time.monotonic():
+        rows = await fetch_values(f"SELECT coalesce(max(id), 0) AS size FROM {table_name}")
+        size = _sizes[table_name] = (time.monotonic() + TABLE_SIZE_TTL, rows[0]['size'])
+    return size[1]
+
+async def check_cost(query: str, values: list, max_rows: int = None):
+    """
+    Rejects the search when it would scan a table larger than max_rows without an index
+
+    Parameters
+    ----------
+    query : str
+        compiled search
+    values : list
+        values of the search
+    max_rows : int
+        largest table that can be scanned, SEARCH_MAX_SCAN_ROWS by default
+    """
+    max_rows = int(os.environ.get('SEARCH_MAX_SCAN_ROWS', SEARCH_MAX_SCAN_ROWS)) if max_rows is None else max_rows
+    for table_name in await scanned_tables(query, values):
+        if await table_size(table_name) > max_rows:
+            raise QueryCostException(f"The search reads all the {table_name} without an index, "
+                                     f"filter on an indexed column, or paginate it with limit and no filters")
@@ -0,0 +1,212 @@
+"""
+This python file is used to start the pending events at their scheduled start
+The scheduler keeps the scheduled starts of the pending events in a min-heap and sleeps until the next one,
+all the events due at that time are started in one transaction. The heap is loaded from the table on startup
+and kept up to date by the endpoints that write events
+"""
+
+import asyncio
+import heapq
+import json
+import time
+from datetime import datetime, timezone
+
+from .constants import Tables, LIFECYCLE_MAX_SLEEP, LIFECYCLE_RESYNC_INTERVAL, LIFECYCLE_BATCH_SIZE, LIFECYCLE_CLOCK_JUMP
+from .database import fetch_values, write_returning, transaction
+from .pubsub import broker
+from .queries import PENDING_EVENTS, START_EVENTS
+
+
+def start_timestamp(value) -> float:
+    """
+    Returns the scheduled start as a unix timestamp, times without a timezone are UTC
+    None if the value is not a date
+    """
+    if not isinstance(value, datetime):
+        try:
+            value = datetime.fromisoformat(str(value))
+        except ValueError:
+            return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+
+class LifecycleScheduler:
+    """
+    Starts the pending events when their scheduled start is reached
+    An event rescheduled or started by hand keeps its old entry in the heap, the entry is skipped
+    when it does not match the latest scheduled start of the event anymore
+    """
+
+    def __init__(self, max_sleep: float = LIFECYCLE_MAX_SLEEP, resync_interval: float = LIFECYCLE_RESYNC_INTERVAL,
+                 batch_size: int = LIFECYCLE_BATCH_SIZE):
+        self.max_sleep = max_sleep
+        self.resync_interval = resync_interval
+        self.batch_size = batch_size
+        self._heap = []
+        self._scheduled = {}
+        self._wakeup = None
+        self._task = None
+        self._written = None
+        self.started = 0
+        self.batches = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+        self.clock_jumps = 0
+
+    def schedule(self, rows: list[dict]):
+        """
+        Updates the scheduled starts from written events, rows are events with at least their id and status
+        """
+        earliest = self._heap[0][0] if self._heap else None
+        for row in rows:
+            if self._written is not None:
+                self._written[row['id']] = row
+            timestamp = start_timestamp(row.get('scheduled_start')) if row.get('status') == 'pending' else None
+            if timestamp is None:
+                self._scheduled.pop(row['id'], None)
+                continue
+            self._scheduled[row['id']] = timestamp
+            heapq.heappush(self._heap, (timestamp, row['id']))
+        # the scheduler sleeps until the earliest start, so it has to wake up if that moved earlier
+        if self._wakeup is not None and self._heap and (earliest is None or self._heap[0][0] < earliest):
+            self._wakeup.set()
+
+    async def load(self):
+        """
+        Reloads the scheduled starts of all the pending events
+        """
+        # events written while the table is read may be missing from the rows, they are scheduled again after
+        self._written = {}
+        try:
+            rows = await fetch_values(PENDING_EVENTS)
+        finally:
+            written, self._written = self._written, None
+        self._scheduled = {}
+        self._heap = []
+        self.schedule([{**row, 'status': 'pending'} for row in rows])
+        self.schedule(list(written.values()))
+
+    def _pop_due(self, now: float) -> list[tuple]:
+        """
+        Removes the due events from the heap, returns their (scheduled start, id)
+        """
+        due = []
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+            timestamp, id = heapq.heappop(self._heap)
+            if self._scheduled.get(id) == timestamp:
+                del self._scheduled[id]
+                due.append((timestamp, id))
+        return due
+
+    async def start_due(self, now: float = None) -> list[dict]:
+        """
+        Starts all the events due at now in one transaction, and publishes them
+
+        Parameters
+        ----------
+        now : float
+            unix timestamp, the current time by default
+
+        Returns
+        -------
+        list(dict)
+            the started events
+        """
+        now = time.time() if now is None else now
+        due = self._pop_due(now)
+        if not due:
+            return []
+        # the same text as the dates written through the api, so date searches compare them alike
+        actual_start = str(datetime.fromtimestamp(now, timezone.utc).replace(microsecond=0))
+        try:
+            async with transaction() as database:
+                rows = await write_returning(START_EVENTS, {"ids": json.dumps([id for _, id in due]), "now": actual_start}, database)
+        except Exception:
+            # put them back to be started on the next run
+            self.schedule([{"id": id, "status": "pending", "scheduled_start": datetime.fromtimestamp(timestamp, timezone.utc)}
+                           for timestamp, id in due if id not in self._scheduled])
+            raise
+        # events started by another worker meanwhile are not returned
+        scheduled = {id: timestamp for timestamp, id in due}
+        lags = [now - scheduled[row['id']] for row in rows]
+        self.batches += 1
+        if lags:
+            self.started += len(lags)
+            self.last_lag = max(lags)
+            self.max_lag = max(self.max_lag, self.last_lag)
+            self.total_lag += sum(lags)
+        await broker.publish(Tables.EVENTS, rows)
+        return rows
+
+    async def run(self):
+        """
+        Starts the due events until cancelled
+        The wall clock decides which events are due and the sleeps are capped at max_sleep,
+        so after the clock jumps the events are started on time for the new clock
+        """
+        loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        await self.load()
+        next_resync = loop.time() + self.resync_interval
+        offset = time.time() - loop.time()
+        while True:
+            # the wall clock moved apart from the monotonic clock of the loop
+            if abs(time.time() - loop.time() - offset) > LIFECYCLE_CLOCK_JUMP:
+                self.clock_jumps += 1
+            offset = time.time() - loop.time()
+            try:
+                if loop.time() >= next_resync:
+                    next_resync = loop.time() + self.resync_interval
+                    await self.load()
+                if await self.start_due():
+                    continue
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # the database may be busy, the events are started on the next run
+                pass
+            self._wakeup.clear()
+            sleep = self.max_sleep if not self._heap else min(self.max_sleep, max(self._heap[0][0] - time.time(), 0))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), sleep)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        """
+        Runs the scheduler in the background, called on app startup
+        """
+        self._task = asyncio.create_task(self.run())
+
+    async def close(self):
+        """
+        Stops the scheduler, called on app shutdown
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._wakeup = None
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of the scheduler, the lags are the seconds between the scheduled
+        and the actual start of the events
+        """
+        next_start = None
+        while self._heap and self._scheduled.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        if self._heap:
+            next_start = datetime.fromtimestamp(self._heap[0][0], timezone.utc).isoformat()
+        return {"pending": len(self._scheduled), "next_start": next_start, "started": self.started, "batches": self.batches,
+                "last_lag": round(self.last_lag, 3), "max_lag": round(self.max_lag, 3),
+                "mean_lag": round(self.total_lag / self.started, 3) if self.started else 0.0, "clock_jumps": self.clock_jumps}
+
+
+lifecycle = LifecycleScheduler()
@@ -0,0 +1,179 @@
+"""
+This python file is used to load sports, events and selections from csv or ndjson files
+straight into the database, without going through the api
+
+    python -m sportsbook load --sports sports.csv --events events.ndjson --selections selections.csv
+"""
+
+import csv
+import json
+import sqlite3
+import time
+from itertools import islice
+
+from pydantic import ValidationError
+
+from .constants import Tables, PARENT_KEYS, NAME_KEYS, LOAD_BATCH_SIZE
+from .models import Sports, Event, Selection
+from .queries import INSERT_SPORT, INSERT_EVENT, INSERT_SELECTION
+from .schema import migrate
+
+# table -> (model, insert query), in the order the tables have to be loaded
+LOADERS = {
+    Tables.SPORTS: (Sports, INSERT_SPORT),
+    Tables.EVENTS: (Event, INSERT_EVENT),
+    Tables.SELECTIONS: (Selection, INSERT_SELECTION),
+}
+
+
+def read_rows(path: str):
+    """
+    Yields the rows of a csv file, or of a newline delimited json file (.ndjson or .jsonl)
+    Empty csv fields are read as missing values
+    """
+    with open(path, newline='', encoding='utf-8') as file:
+        if path.endswith(('.ndjson', '.jsonl')):
+            for line in file:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            for row in csv.DictReader(file):
+                yield {key: value for key, value in row.items() if value != ''}
+
+
+class Loader:
+    """
+    Loads files into the database in large batched transactions
+    The journal is switched to WAL and synchronous to OFF while loading
+    """
+
+    def __init__(self, path: str, batch_size: int = LOAD_BATCH_SIZE, out=print):
+        self.path = path
+        self.batch_size = batch_size
+        self.out = out
+        self.connection = None
+        # parent table -> name -> id
+        self.ids = {}
+
+    def __enter__(self):
+        migrate(self.path)
+        self.connection = sqlite3.connect(self.path, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = OFF")
+        for table_name in (Tables.SPORTS, Tables.EVENTS):
+            name_key = NAME_KEYS[table_name]
+            self.ids[table_name] = dict(self.connection.execute(f"SELECT {name_key}, id FROM {table_name}"))
+        return self
+
+    def __exit__(self, *exc):
+        # synchronous only applies to this connection, the api connections keep their own setting
+        self.connection.close()
+
+    def load(self, table_name: str, path: str) -> dict:
+        """
+        Loads one file into the given table
+
+        Parameters
+        ----------
+        table_name : str
+            table the rows are inserted in
+        path : str
+            csv or ndjson file
+
+        Returns
+        -------
+        dict
+            number of rows loaded and rejected, and rows per second
+        """
+        model, _ = LOADERS[table_name]
+        start = time.perf_counter()
+        loaded = rejected = 0
+        rows = read_rows(path)
+        while batch := list(islice(rows, self.batch_size)):
+            values = []
+            first = loaded + rejected + 1
+            for number, row in enumerate(batch, start=first):
+                try:
+                    values.append(self._values(table_name, dict(model.model_validate(row))))
+                except ValidationError as exc:
+                    rejected += 1
+                    self.out(f"{path}:{number}: {exc.errors()[0]['msg']}")
+                except LookupError as exc:
+                    rejected += 1
+                    self.out(f"{path}:{number}: {exc.args[0]}")
+            inserted = self._insert(table_name, values)
+            loaded += inserted
+            rejected += len(values) - inserted
+        elapsed = time.perf_counter() - start
+        result = {"table": table_name, "loaded": loaded, "rejected": rejected,
+                  "seconds": round(elapsed, 3), "rows_per_second": round(loaded / elapsed) if elapsed else loaded}
+        self.out(f"{table_name}: loaded {loaded} rejected {rejected} in {elapsed:.2f}s ({result['rows_per_second']} rows/sec)")
+        return result
+
+    def _values(self, table_name: str, values: dict) -> dict:
+        """
+        Replaces the parent name by its id, raises LookupError when the parent does not exist
+        """
+        if table_name in PARENT_KEYS:
+            name_key, id_key, parent_table = PARENT_KEYS[table_name]
+            name = values.pop(name_key)
+            if name not in self.ids[parent_table]:
+                raise LookupError(f"{parent_table} {name} not found")
+            values[id_key] = self.ids[parent_table][name]
+        return values
+
+    def _insert(self, table_name: str, values: list) -> int:
+        """
+        Inserts one batch in one transaction, if the batch fails the rows are inserted one by one
+        so only the failing rows are rejected. Returns the number of rows inserted
+        """
+        _, query = LOADERS[table_name]
+        try:
+            self.connection.execute("BEGIN")
+            self.connection.executemany(query, values)
+            self.connection.execute("COMMIT")
+            inserted = values
+        except sqlite3.IntegrityError:
+            self.connection.execute("ROLLBACK")
+            inserted = []
+            self.connection.execute("BEGIN")
+            for row in values:
+                try:
+                    self.connection.execute(query, row)
+                    inserted.append(row)
+                except sqlite3.IntegrityError as exc:
+                    self.out(f"{table_name} {row[NAME_KEYS[table_name]]}: {exc}")
+            self.connection.execute("COMMIT")
+        if table_name in self.ids and inserted:
+            name_key = NAME_KEYS[table_name]
+            names = [row[name_key] for row in inserted]
+            placeholders = ", ".join("?" * len(names))
+            self.ids[table_name].update(self.connection.execute(
+                f"SELECT {name_key}, id FROM {table_name} WHERE {name_key} IN ({placeholders})", names))
+        return len(inserted)
+
+
+def load_files(path: str, files: dict, batch_size: int = LOAD_BATCH_SIZE, out=print) -> list:
+    """
+    Loads the files of every table into the database, parents first
+
+    Parameters
+    ----------
+    path : str
+        path of the sqlite database
+    files : dict
+        table name -> list of files to load in it
+    batch_size : int
+        rows inserted per transaction
+
+    Returns
+    -------
+    list
+        result of every file loaded
+    """
+    results = []
+    with Loader(path, batch_size, out) as loader:
+        for table_name in LOADERS:
+            for file in files.get(table_name) or []:
+                results.append(loader.load(table_name, file))
+    return results
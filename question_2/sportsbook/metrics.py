@@ -0,0 +1,179 @@
+"""
+This python file is used to measure where the time goes and export it on /metrics in the Prometheus text format
+Requests are timed per route by the MetricsMiddleware and statements per sql template by the database layer,
+with the rows they returned and the time spent waiting for a pooled connection.
+When metrics are disabled the timing calls return right away
+"""
+
+from bisect import bisect_left
+import os
+import re
+import time
+
+from .constants import METRIC_BUCKETS
+
+# an IN list of placeholders, its length depends on the values
+PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_sql(query: str) -> str:
+    """
+    Returns the sql template the query is counted under: whitespace collapsed and IN lists of
+    placeholders written as (?...), so the same statement with more values is the same template
+    """
+    return PLACEHOLDER_LIST.sub("(?...)", WHITESPACE.sub(" ", query).strip())
+
+
+def _labels(labels: tuple, names: tuple) -> str:
+    """
+    Formats the label values as {name="value",...}, escaped as the text format requires
+    """
+    values = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, values)) + "}"
+
+
+class Histogram:
+    """
+    Latency histogram with one series per combination of label values
+    """
+
+    def __init__(self, name: str, help: str, label_names: tuple, buckets: tuple = METRIC_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        # label values -> [count per bucket, sum, count]
+        self.series = {}
+
+    def observe(self, labels: tuple, value: float):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * len(self.buckets), 0.0, 0]
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[0][index] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self.series.items():
+            cumulative = 0
+            for bucket, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels(labels + (bucket,), self.label_names + ('le',))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(labels + ('+Inf',), self.label_names + ('le',))} {count}")
+            lines.append(f"{self.name}_sum{_labels(labels, self.label_names)} {total}")
+            lines.append(f"{self.name}_count{_labels(labels, self.label_names)} {count}")
+        return lines
+
+
+class Counter:
+    """
+    Counter with one series per combination of label values
+    """
+
+    def __init__(self, name: str, help: str, label_names: tuple):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.series = {}
+
+    def inc(self, labels: tuple, value: float = 1):
+        self.series[labels] = self.series.get(labels, 0) + value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_labels(labels, self.label_names)} {value}" for labels, value in self.series.items()]
+        return lines
+
+
+class Metrics:
+    """
+    Registry of the request and database metrics of this worker
+    """
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.requests = Histogram("sportsbook_request_duration_seconds", "Time to answer a request", ("method", "route", "status"))
+        self.queries = Histogram("sportsbook_query_duration_seconds", "Time to run a statement", ("statement",))
+        self.rows = Counter("sportsbook_query_rows_total", "Rows returned or written by a statement", ("statement",))
+        self.waits = Histogram("sportsbook_connection_wait_seconds", "Time waited for a pooled connection", ("connection",))
+        self._templates = {}
+
+    def clock(self) -> float:
+        """
+        Returns the start time of a measure, None when metrics are disabled
+        """
+        return time.perf_counter() if self.enabled else None
+
+    def observe_request(self, method: str, route: str, status: int, started: float):
+        if started is not None:
+            self.requests.observe((method, route, status), time.perf_counter() - started)
+
+    def observe_query(self, query: str, seconds: float, rows: int = 0):
+        if not self.enabled:
+            return
+        statement = self._templates.get(query)
+        if statement is None:
+            statement = self._templates[query] = normalize_sql(query)
+        self.queries.observe((statement,), seconds)
+        self.rows.inc((statement,), rows)
+
+    def observe_wait(self, connection: str, started: float):
+        if started is not None:
+            self.waits.observe((connection,), time.perf_counter() - started)
+
+    def render(self, gauges: dict) -> str:
+        """
+        Returns all the metrics in the Prometheus text format
+
+        Parameters
+        ----------
+        gauges : dict
+            name -> (help, value) of the current values to export with the metrics, e.g. pool and cache sizes
+
+        Returns
+        -------
+        str
+            the metrics, one sample per line
+        """
+        lines = []
+        for name, (help, value) in gauges.items():
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name} {value}"]
+        for metric in (self.requests, self.queries, self.rows, self.waits):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware timing every http request by method, route template and status
+    """
+
+    def __init__(self, app, registry: Metrics = None):
+        self.app = app
+        self.registry = registry or metrics
+
+    async def __call__(self, scope, receive, send):
+        started = self.registry.clock() if scope["type"] == "http" else None
+        if started is None:
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            # the router sets the matched route, ids in the path are not turned into labels
+            route = scope.get("route")
+            self.registry.observe_request(scope["method"], route.path if route is not None else "unmatched", status, started)
+
+
+metrics = Metrics(os.environ.get('METRICS', '1') == '1')
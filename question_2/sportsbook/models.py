@@ -5,10 +5,50 @@ This python file is used to define all the pydantic models used in this project
 from pydantic import BaseModel, field_validator, model_validator
 from typing import Optional, List, Any, Union
 from datetime import datetime, timezone
+from decimal import Decimal
+import math
 import re
 import pytz
 
-from .constants import VALID_EVENT_TYPE, VALID_EVENT_STATUS, VALID_SELECTION_OUTCOME, VALID_CONDITIONS
+from .constants import Tables, VALID_EVENT_TYPE, VALID_EVENT_STATUS, VALID_SELECTION_OUTCOME, VALID_CONDITIONS, PRICE_SCALE, \
+    MIN_PRICE, MAX_PRICE, PRICE_TICK
+
+
+def price_to_db(price: float) -> int:
+    """
+    Returns the decimal price as the whole number of hundredths it is stored as
+    """
+    return int(round(Decimal(str(price)) * PRICE_SCALE))
+
+def validate_price(price: float) -> int:
+    """
+    Returns the price as it is stored, the same rules as the bulk price updates:
+    a finite number within MIN_PRICE and MAX_PRICE and a whole number of PRICE_TICK
+    The ValueError is reported by pydantic as a 422, prices are never rounded to fit
+    """
+    if not math.isfinite(price):
+        raise ValueError("price should be a number")
+    if price < MIN_PRICE or price > MAX_PRICE:
+        raise ValueError(f"price should be between {MIN_PRICE} and {MAX_PRICE}")
+    if Decimal(str(price)) % Decimal(str(PRICE_TICK)) != 0:
+        raise ValueError(f"price should be a multiple of {PRICE_TICK}")
+    return price_to_db(price)
+
+def price_from_db(price: int) -> float:
+    """
+    Returns the stored price as a decimal price
+    """
+    return price / PRICE_SCALE if price is not None else None
+
+def rows_from_db(table_name: str, rows: list[dict]) -> list[dict]:
+    """
+    Returns copies of the rows with the stored prices turned into decimal prices
+    The given rows may be shared through the query cache, so they are not changed
+    """
+    if table_name != Tables.SELECTIONS or not rows or 'price' not in rows[0]:
+        return rows
+    return [{**row, 'price': price_from_db(row['price'])} for row in rows]
+
 
 class Sports(BaseModel):
     """
@@ -163,6 +203,10 @@ class Selection(BaseModel):
         if re.search("[^a-zA-Z0-9s]", value):
             raise ValueError("Selection  name cannot contain special characters")
         return value
+
+    @field_validator("price")
+    def validate_price(cls, value):
+        return validate_price(value)
     
     @field_validator("outcome")
     def validate_outcome(cls, value):
@@ -182,6 +226,10 @@ class SelectionUpdateValues(BaseModel):
     active: Optional[bool] = None
     outcome: Optional[str] = None
 
+    @field_validator("price")
+    def validate_price(cls, value):
+        return validate_price(value) if value is not None else None
+
 class SelectionUpdateConditions(BaseModel):
     """
     Pydantic model to update selection table on given condition
@@ -209,13 +257,50 @@ class SelectionUpdate(BaseModel):
             raise ValueError("Name cannot be updated when condition is name")
         return values
     
+class SelectionPrices(BaseModel):
+    """
+    Pydantic model to update the prices of many selections, as parallel arrays
+    """
+    id: List[int]
+    price: List[float]
+
+    @model_validator(mode='after')
+    def validate_prices(self):
+        if len(self.id) != len(self.price):
+            raise ValueError("id and price should have the same length")
+        return self
+
+class Settlement(BaseModel):
+    """
+    Pydantic model to settle all the selections of an event
+    The winners win, the void selections are void and all the others lose,
+    void_all voids every selection e.g. when the event is abandoned
+    """
+    winners: List[int] = []
+    void: List[int] = []
+    void_all: bool = False
+
+    @model_validator(mode='after')
+    def validate_settlement(self):
+        if set(self.winners) & set(self.void):
+            raise ValueError("A selection cannot both win and be void")
+        if self.void_all and self.winners:
+            raise ValueError("Winners cannot be given when all the selections are void")
+        return self
+
+class EventSettlement(Settlement):
+    """
+    Pydantic model to settle one event of a batch
+    """
+    event_id: int
+
 class Select(BaseModel):
     """
     Pydantic model for select statement
     """
     table_name: Optional[str] = ''
     join_key: Optional[str] = ''
-    keys: Union[List[str], str, None]
+    keys: Union[List[str], str, None] = None
 
 class Conditions(BaseModel):
     """
@@ -226,11 +311,12 @@ class Conditions(BaseModel):
     operator: str
 
     @field_validator('operator')
-    def validate_operator(cls, value, values):
+    def validate_operator(cls, value, info):
         if value not in VALID_CONDITIONS:
             raise ValueError(f'Valid operator are {VALID_CONDITIONS}')
-        if value == 'between' and (type(values.get('value')) != list or len(values.get('value'))!= 2):
+        if value == 'between' and (type(info.data.get('value')) != list or len(info.data.get('value'))!= 2):
             raise ValueError('between should have only two values')
+        return value
 
 class ConditionsDate(BaseModel):
     """
@@ -241,14 +327,15 @@ class ConditionsDate(BaseModel):
     operator: str
 
     @field_validator('operator')
-    def validate_operator(cls, value, values):
+    def validate_operator(cls, value, info):
         if value not in VALID_CONDITIONS:
             raise ValueError(f'Valid operator are {VALID_CONDITIONS}')
-        if value == 'between' and (type(values.get('value')) != list or len(values.get('value'))!= 2):
+        if value == 'between' and (type(info.data.get('value')) != list or len(info.data.get('value'))!= 2):
             raise ValueError('between should have only two values')
+        return value
         
     @field_validator('value')
-    def validate_operator(cls, value):
+    def validate_value(cls, value):
         if type(value) == list:
             return [date.astimezone(pytz.utc) for date in value]
         return value.astimezone(pytz.utc)
@@ -260,4 +347,18 @@ class Search(BaseModel):
     table_name: str
     conditions: Optional[List[Conditions]] = []
     conditions_date: Optional[List[ConditionsDate]] = []
-    select: Optional[Select] = None
\ No newline at end of file
+    select: Optional[Select] = None
+    # keyset pagination, a search with any of these returns one page and the cursor of the next page
+    limit: Optional[int] = None
+    order_by: Optional[str] = None
+    cursor: Optional[str] = None
+
+    @field_validator("limit")
+    def validate_limit(cls, value):
+        if value is not None and value < 1:
+            raise ValueError("limit should be greater than 0")
+        return value
+
+    @property
+    def paginated(self) -> bool:
+        return self.limit is not None or self.order_by is not None or self.cursor is not None
\ No newline at end of file
@@ -0,0 +1,146 @@
+"""
+This python file is used to resolve the names of sports and events to their ids
+Events and selections reference their parent by id, while the api still talks in names
+"""
+
+import time
+
+from .constants import Tables, PARENT_KEYS, CACHE_TTL
+from .database import fetch_values
+
+
+class NameMap:
+    """
+    In memory id <-> name map of a parent table
+    Names not in the map are looked up in the database and remembered,
+    the write path keeps the map in sync on inserts and renames.
+    Other workers can rename rows too, so entries are looked up again after ttl seconds
+    """
+
+    def __init__(self, table_name: str, name_key: str, ttl: float = CACHE_TTL):
+        self.table_name = table_name
+        self.name_key = name_key
+        self.ttl = ttl
+        self._ids = {}
+        self._names = {}
+        self._expiry = {}
+
+    def set(self, id: int, name: str):
+        """
+        Records the current name of the row with the given id
+        """
+        old_name = self._names.get(id)
+        if old_name is not None and self._ids.get(old_name) == id:
+            del self._ids[old_name]
+        self._ids[name] = id
+        self._names[id] = name
+        self._expiry[id] = time.monotonic() + self.ttl
+
+    def _expire(self, id: int):
+        """
+        Forgets the row if its entry is older than ttl
+        """
+        if id in self._expiry and self._expiry[id] < time.monotonic():
+            name = self._names.pop(id)
+            if self._ids.get(name) == id:
+                del self._ids[name]
+            del self._expiry[id]
+
+    async def get_id(self, name: str, database=None) -> int:
+        """
+        Returns the id of the row with the given name, or None if there is no such row
+
+        Parameters
+        ----------
+        name : str
+            name of the sport or event
+        database : aiosqlite.Connection
+            connection to run on when the name is not in the map yet
+
+        Returns
+        -------
+        int
+            id of the row
+        """
+        if name in self._ids:
+            self._expire(self._ids[name])
+        if name not in self._ids:
+            rows = await fetch_values(f"SELECT id, {self.name_key} FROM {self.table_name} WHERE {self.name_key} = :name",
+                                      {"name": name}, database)
+            if not rows:
+                return None
+            self.set(rows[0]['id'], rows[0][self.name_key])
+        return self._ids[name]
+
+    async def get_names(self, ids, database=None) -> dict:
+        """
+        Returns the names of all the given ids, missing ids are loaded with one query
+
+        Parameters
+        ----------
+        ids : iterable
+            ids of the sports or events
+        database : aiosqlite.Connection
+            connection to run on for the ids not in the map yet
+
+        Returns
+        -------
+        dict
+            id to name of every id that exists
+        """
+        for id in ids:
+            self._expire(id)
+        missing = {id for id in ids if id is not None and id not in self._names}
+        if missing:
+            placeholders = ", ".join("?" * len(missing))
+            rows = await fetch_values(f"SELECT id, {self.name_key} FROM {self.table_name} WHERE id IN ({placeholders})",
+                                      list(missing), database)
+            for row in rows:
+                self.set(row['id'], row[self.name_key])
+        return {id: self._names[id] for id in ids if id in self._names}
+
+
+sport_names = NameMap(Tables.SPORTS, 'sport_name')
+event_names = NameMap(Tables.EVENTS, 'event_name')
+
+# parent table -> name map
+NAME_MAPS = {
+    Tables.SPORTS: sport_names,
+    Tables.EVENTS: event_names,
+}
+
+
+async def add_parent_names(table_name: str, rows: list[dict], database=None, keys: list = None) -> list[dict]:
+    """
+    Adds the parent name next to the parent id of the given rows,
+    so the rows look like they did when the parent was referenced by name
+
+    Parameters
+    ----------
+    table_name : str
+        table the rows are selected from
+    rows : list(dict)
+        selected rows
+    database : aiosqlite.Connection
+        connection to run on for the names not in the map yet
+    keys : list(str)
+        keys the caller selected, the parent id is left out when only the parent name was selected
+
+    Returns
+    -------
+    list(dict)
+        copies of the rows with the parent name, the given rows may be shared through the query cache
+        so they are not changed
+    """
+    if table_name not in PARENT_KEYS or not rows:
+        return rows
+    name_key, id_key, parent_table = PARENT_KEYS[table_name]
+    if id_key not in rows[0]:
+        return rows
+    names = await NAME_MAPS[parent_table].get_names({row[id_key] for row in rows}, database)
+    rows = [{**row, name_key: names.get(row[id_key])} for row in rows]
+    # the parent id was selected only to look the name up
+    if keys is not None and id_key not in keys:
+        for row in rows:
+            del row[id_key]
+    return rows
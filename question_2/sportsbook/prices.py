@@ -0,0 +1,65 @@
+"""
+This python file is used to validate and apply price updates in bulk
+Price feeds send parallel arrays of selection ids and prices, they are validated as arrays
+and written with one UPDATE joined to the arrays
+"""
+
+import json
+
+import numpy as np
+
+from .constants import MIN_PRICE, MAX_PRICE, PRICE_TICK, PRICE_SCALE
+from .database import write_returning
+from .queries import UPDATE_PRICES
+
+
+def validate_prices(prices: np.ndarray) -> np.ndarray:
+    """
+    Returns for every price the reason it is rejected, or an empty string when it is valid
+    A price has to be within MIN_PRICE and MAX_PRICE and a whole number of PRICE_TICK
+    """
+    errors = np.full(len(prices), "", dtype=object)
+    ticks = prices / PRICE_TICK
+    errors[np.abs(ticks - np.round(ticks)) > 1e-6] = f"price should be a multiple of {PRICE_TICK}"
+    errors[(prices < MIN_PRICE) | (prices > MAX_PRICE)] = f"price should be between {MIN_PRICE} and {MAX_PRICE}"
+    errors[~np.isfinite(prices)] = "price should be a number"
+    return errors
+
+
+async def update_prices(ids: list, prices: list, database) -> tuple[list, list]:
+    """
+    Validates the prices and updates the valid ones with one statement, to be run inside a transaction
+    When an id is given more than once its last price is used
+
+    Parameters
+    ----------
+    ids : list
+        ids of the selections
+    prices : list
+        new price of every selection
+    database : aiosqlite.Connection
+        connection of the running transaction
+
+    Returns
+    -------
+    tuple(list, list)
+        the updated selections, and {"id", "error"} of every id that was not updated
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    prices = np.asarray(prices, dtype=np.float64)
+    # keep the last update of every id
+    _, last = np.unique(ids[::-1], return_index=True)
+    keep = np.sort(len(ids) - 1 - last)
+    ids, prices = ids[keep], prices[keep]
+
+    errors = validate_prices(prices)
+    valid = errors == ""
+    rejected = [{"id": id, "error": error} for id, error in zip(ids[~valid].tolist(), errors[~valid].tolist())]
+    rows = []
+    if valid.any():
+        # stored as whole hundredths
+        pairs = zip(ids[valid].tolist(), np.rint(prices[valid] * PRICE_SCALE).astype(np.int64).tolist())
+        rows = await write_returning(UPDATE_PRICES, {"prices": json.dumps(list(pairs))}, database)
+        missing = np.setdiff1d(ids[valid], np.fromiter((row['id'] for row in rows), dtype=np.int64, count=len(rows)))
+        rejected += [{"id": id, "error": "Selection not found"} for id in missing.tolist()]
+    return rows, rejected
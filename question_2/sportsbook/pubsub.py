@@ -0,0 +1,138 @@
+"""
+This python file is used to push the changes of sports, events and selections to subscribed clients
+The write endpoints publish the updated rows after commit, every subscriber gets the rows
+of the sports, events and selections it subscribed to on its own bounded queue
+"""
+
+import asyncio
+import json
+
+from .constants import Tables, SUBSCRIBER_QUEUE_SIZE, SSE_KEEPALIVE
+from .database import fetch_values
+from .names import add_parent_names
+from .models import rows_from_db
+
+
+class Subscription:
+    """
+    Queue of the changes one client subscribed to
+    topics is a set of (table name, id), a sport covers its events and their selections
+    and an event covers its selections
+    """
+
+    def __init__(self, topics: set, size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.topics = topics
+        self.queue = asyncio.Queue(size)
+        self.dropped = False
+
+    def put(self, message: dict):
+        """
+        Queues the message, a subscriber whose queue is full is too slow to keep up and is dropped
+        """
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.dropped = True
+
+    async def get(self) -> dict:
+        return await self.queue.get()
+
+
+class Broker:
+    """
+    In process publish / subscribe bus, only the changes made by this worker are published
+    """
+
+    def __init__(self, size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.size = size
+        self.subscriptions = set()
+        self.published = 0
+        self.dropped = 0
+
+    def subscribe(self, topics: set) -> Subscription:
+        """
+        Registers a new subscriber to the given (table name, id) topics
+        """
+        subscription = Subscription(topics, self.size)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+
+    def _subscribed(self, table_name: str) -> bool:
+        return any(table_name == topic[0] for subscription in self.subscriptions for topic in subscription.topics)
+
+    async def publish(self, table_name: str, rows: list[dict], database=None):
+        """
+        Sends the changed rows to every subscriber of the row, of its event or of its sport
+
+        Parameters
+        ----------
+        table_name : str
+            table the rows were changed in
+        rows : list(dict)
+            changed rows, at least their id and parent id
+        database : aiosqlite.Connection
+            connection to run on to find the sports of the events of changed selections
+        """
+        if not self.subscriptions or not rows:
+            return
+        rows = await add_parent_names(table_name, rows_from_db(table_name, rows), database)
+        sports = {}
+        if table_name == Tables.SELECTIONS and self._subscribed(Tables.SPORTS):
+            event_ids = list({row['event_id'] for row in rows if row.get('event_id') is not None})
+            placeholders = ", ".join("?" * len(event_ids))
+            sports = {row['id']: row['sport_id'] for row in await fetch_values(
+                f"SELECT id, sport_id FROM events WHERE id IN ({placeholders})", event_ids, database)} if event_ids else {}
+        for row in rows:
+            topics = {(table_name, row['id'])}
+            if table_name == Tables.EVENTS:
+                topics.add((Tables.SPORTS, row.get('sport_id')))
+            elif table_name == Tables.SELECTIONS:
+                topics.add((Tables.EVENTS, row.get('event_id')))
+                topics.add((Tables.SPORTS, sports.get(row.get('event_id'))))
+            message = {"table": table_name, "row": row}
+            for subscription in list(self.subscriptions):
+                if subscription.topics & topics:
+                    subscription.put(message)
+                    self.published += 1
+                    if subscription.dropped:
+                        self.dropped += 1
+                        self.unsubscribe(subscription)
+
+    def stats(self) -> dict:
+        return {"subscribers": len(self.subscriptions), "published": self.published, "dropped": self.dropped}
+
+
+broker = Broker()
+
+
+def format_event(message: dict) -> str:
+    """
+    Encodes a message as one server-sent event, the event type is the table name
+    """
+    return f"event: {message['table']}\ndata: {json.dumps(message['row'], default=str)}\n\n"
+
+
+async def stream_events(subscription: Subscription, keepalive: float = SSE_KEEPALIVE):
+    """
+    Yields the messages of the subscription as server-sent events until the client disconnects
+    A comment is sent every keepalive seconds without changes so proxies keep the connection open,
+    a dropped subscriber gets a last dropped event and should subscribe again and resync with /search
+    """
+    try:
+        while True:
+            try:
+                message = await asyncio.wait_for(subscription.get(), keepalive)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            yield format_event(message)
+            if subscription.dropped and subscription.queue.empty():
+                yield "event: dropped\ndata: {}\n\n"
+                return
+    finally:
+        broker.unsubscribe(subscription)
@@ -1,92 +1,408 @@
 """
 This python file is used to declare or build the queries used to perform operations
 """
+from functools import lru_cache
+import base64
+from decimal import Decimal
+import json
+import math
+
 from .models import Search
+from .constants import Tables, PARENT_KEYS, COUNTER_TABLES, FTS_TABLES, NAME_KEYS, NAME_INDEX_CONDITIONS, MIN_MATCH_LENGTH, TABLE_COLUMNS, VALID_CONDITIONS, SEARCH_CACHE_SIZE, NULLABLE_COLUMNS, MAX_PAGE_SIZE, PRICE_SCALE
+from .exception import InvalidQueryException
 
-UPDATE_TABLE = "UPDATE {table_name} set {values} WHERE {condition}"
+UPDATE_TABLE = "UPDATE {table_name} set {values} WHERE {condition} RETURNING *"
 SELECT_ALL = "SELECT * from {table_name}"
 SELECT_CONDITION = "SELECT * from {table_name} WHERE {condition}" 
 
 INSERT_SPORT = "INSERT INTO sports(sport_name, slug, active) VALUES (:sport_name, :slug, :active)"
-UPDATE_SPORT_EVENT = 'UPDATE sports set active = false WHERE (select count(*) from events e where e.sport_name like "{sport_name}" and e.active = true) = 0'
-UPDATE_SPORT_NAME = 'UPDATE events set sport_name = "{sport_name}" WHERE sport_name = "{sport_name_old}"'
+# :sport_ids and :event_ids are json arrays of the parents to check
+UPDATE_SPORT_EVENT = 'UPDATE sports set active = false WHERE id IN (select value from json_each(:sport_ids)) and active = true and coalesce((select active from sport_counts where sport_id = sports.id), 0) = 0 RETURNING *'
+
+INSERT_EVENT = "INSERT INTO events(event_name, slug, active, type, sport_id, status, scheduled_start, actual_start) VALUES (:event_name, :slug, :active, :type, :sport_id, :status, :scheduled_start, :actual_start)"
+UPDATE_EVENT_SELECTION = 'UPDATE events set active = false WHERE id IN (select value from json_each(:event_ids)) and active = true and coalesce((select active from event_counts where event_id = events.id), 0) = 0 RETURNING *'
+
+INSERT_SELECTION = "INSERT INTO selections(selection_name, event_id, price, active, outcome) VALUES (:selection_name, :event_id, :price, :active, :outcome)"
+
+SELECT_CHANGES = "SELECT seq, table_name, row_id, operation, data, changed_at FROM changes WHERE seq > ? ORDER BY seq LIMIT ?"
+SELECT_CHANGES_RANGE = "SELECT min(seq) AS first_seq, (SELECT seq FROM sqlite_sequence WHERE name = 'changes') AS last_seq FROM changes"
+SELECT_CHANGED_ROWS = "SELECT seq, table_name, row_id FROM changes WHERE seq > ? ORDER BY seq LIMIT ?"
+DELETE_CHANGES = "DELETE FROM changes WHERE changed_at < datetime('now', :retention)"
+
+# Settles every selection of an event in one statement, :winners and :void are json arrays of selection ids
+SETTLE_SELECTIONS = """UPDATE selections SET active = false, outcome = CASE
+WHEN :void_all THEN 'void'
+WHEN id IN (SELECT value FROM json_each(:winners)) THEN 'win'
+WHEN id IN (SELECT value FROM json_each(:void)) THEN 'void'
+ELSE 'lose' END
+WHERE event_id = :event_id RETURNING *"""
+SETTLE_EVENT = "UPDATE events SET status = 'ended', active = false WHERE id = :event_id RETURNING *"
+
+# Sets the prices of many selections at once, :prices is a json array of [id, price] pairs
+UPDATE_PRICES = """UPDATE selections SET price = p.price
+FROM (SELECT value ->> 0 AS id, value ->> 1 AS price FROM json_each(:prices)) AS p
+WHERE selections.id = p.id RETURNING id, event_id, price"""
 
-INSERT_EVENT = "INSERT INTO events(event_name, slug, active, type, sport_name, status, scheduled_start, actual_start) VALUES (:event_name, :slug, :active, :type, :sport_name, :status, :scheduled_start, :actual_start)"
-UPDATE_EVENT_SELECTION = 'UPDATE events set active = false WHERE (select count(*) from selections s where s.event_name = "{event_name}" and s.active = false) = 0'
-UPDATE_EVENT_NAME = 'UPDATE selections set event_name = "{event_name}" WHERE event_name = "{event_name_old}"'
+# Prices of the active selections of some events, for their books
+BOOK_SELECTIONS = "SELECT event_id, id, price FROM selections WHERE event_id IN ({placeholders}) AND active = true ORDER BY event_id, id"
 
-INSERT_SELECTION = "INSERT INTO selections(selection_name, event_name, price, active, outcome) VALUES (:selection_name, :event_name, :price, :active, :outcome)"
+# Pending events for the lifecycle scheduler, and the start of the due ones
+# the scheduled start is checked again so an event rescheduled meanwhile is not started early
+PENDING_EVENTS = "SELECT id, scheduled_start FROM events WHERE status = 'pending'"
+START_EVENTS = "UPDATE events SET status = 'started', actual_start = :now WHERE id IN (SELECT value FROM json_each(:ids)) AND status = 'pending' AND datetime(scheduled_start) <= datetime(:now) RETURNING *"
 
-def build_search_query(search_model: Search) -> str:
+# Children of many parents of a tree, ordered by parent so they are attached in one pass
+TREE_CHILDREN = "SELECT * FROM {table_name} WHERE {id_key} IN (SELECT value FROM json_each(?1)) AND (?2 = 0 OR active = true){condition} ORDER BY {id_key}, id"
+TREE_STATUS_CONDITION = " AND status IN (SELECT value FROM json_each(?3))"
+
+# Counters that differ from the children, and the rebuild of the counters from the children
+COUNTER_MISMATCHES = """WITH expected AS (SELECT {id_key}, count(*) AS total, sum(active = 1) AS active FROM {table_name} WHERE {id_key} IS NOT NULL GROUP BY {id_key})
+SELECT coalesce(e.{id_key}, c.{id_key}) AS {id_key}, coalesce(c.total, 0) AS counted_total, coalesce(c.active, 0) AS counted_active, coalesce(e.total, 0) AS total, coalesce(e.active, 0) AS active
+FROM expected e FULL JOIN {counter_table} c ON c.{id_key} = e.{id_key}
+WHERE coalesce(c.total, 0) != coalesce(e.total, 0) OR coalesce(c.active, 0) != coalesce(e.active, 0)"""
+DELETE_COUNTERS = "DELETE FROM {counter_table}"
+REBUILD_COUNTERS = "INSERT INTO {counter_table} ({id_key}, total, active) SELECT {id_key}, count(*), sum(active = 1) FROM {table_name} WHERE {id_key} IS NOT NULL GROUP BY {id_key}"
+
+# Count of the children of one parent read from its counter, {active} and {parent} are
+# numbered placeholders as the conditions can come in any order
+COUNT_CHILDREN = "SELECT coalesce((SELECT {count} FROM {counter_table} WHERE {id_key} = {parent}), 0) AS count"
+
+# Condition on the parent name of a child table, {operator} is one of VALID_CONDITIONS
+PARENT_NAME_CONDITION = "{table_name}.{id_key} IN (select id from {parent_table} where {name_key} {operator} {value})"
+
+# Condition on a name looked up in the full text index of the names, {match} is a MATCH or LIKE on the index
+NAME_INDEX_CONDITION = "{column} IN (SELECT rowid FROM {fts_table} WHERE {match})"
+
+def search_shape(search_model: Search) -> tuple:
     """
-    Builds sql query from pydantic model Search
+    Returns the shape of the search, everything that decides the sql text but not the values
+    Two searches with the same shape are compiled to the same sql template
+    """
+    select = search_model.select
+    keys = None
+    if select and select.keys:
+        keys = tuple(select.keys) if type(select.keys) == list else select.keys.lower()
+    return (search_model.table_name,
+            select.table_name if select and select.table_name else '',
+            select.join_key if select and select.join_key else '',
+            keys,
+            tuple((condition.key, condition.operator) for condition in search_model.conditions),
+            tuple((condition.key, condition.operator) for condition in search_model.conditions_date),
+            (search_model.order_by or 'id') if search_model.paginated else None,
+            search_model.cursor is not None)
+
+def selected_keys(search_model: Search) -> list:
+    """
+    Returns the keys the search selects, None when it selects every column or counts
+    """
+    select = search_model.select
+    return select.keys if select and type(select.keys) == list else None
+
+def _price_value(operator: str, value, position: int = 0):
+    """
+    Returns the price of a condition as the whole hundredths it is compared to, position is the index of
+    the value in a between. A price between two ticks is not rounded to the nearest one: a bound moves to
+    the first tick on its side, and an equality binds NULL as it matches no stored price
+    """
+    if type(value) not in (int, float):
+        return value
+    if not math.isfinite(value):
+        raise InvalidQueryException("The value of price should be a number")
+    hundredths = Decimal(str(value)) * PRICE_SCALE
+    if hundredths == hundredths.to_integral_value():
+        return int(hundredths)
+    # price > 1.504 is price > 1.50 and price >= 1.504 is price >= 1.51
+    if operator in ('>', '<=') or (operator == 'between' and position == 1):
+        return math.floor(hundredths)
+    if operator in ('>=', '<') or (operator == 'between' and position == 0):
+        return math.ceil(hundredths)
+    return None
+
+def search_values(search_model: Search) -> list:
+    """
+    Returns the values to be bound to the compiled search, in the order of the placeholders
+    """
+    values = []
+    for condition in search_model.conditions:
+        condition_values = condition.value if condition.operator == "between" else [condition.value]
+        # only single values can be bound, a list or object would reach sqlite as is
+        if any(value is not None and type(value) not in (str, int, float, bool) for value in condition_values):
+            raise InvalidQueryException(f"The value of {condition.key} {condition.operator} should be a single number, text or boolean")
+        if condition.operator != "between":
+            condition_values = [name_value(condition.operator, condition.value)]
+        # prices are stored as whole hundredths
+        if search_model.table_name == Tables.SELECTIONS and condition.key == 'price':
+            condition_values = [_price_value(condition.operator, value, position) for position, value in enumerate(condition_values)]
+        values.extend(condition_values)
+    for condition in search_model.conditions_date:
+        dates = condition.value if condition.operator == "between" else [condition.value]
+        if condition.operator != "between" and type(condition.value) == list:
+            raise InvalidQueryException(f"The value of {condition.key} {condition.operator} should be a single date")
+        # dates are stored as text, compare them as the same text
+        values.extend(str(date) for date in dates)
+    rank = _rank_condition(*search_shape(search_model)[:5], search_model.paginated)
+    if rank is not None and search_model.conditions[rank].operator == 'match':
+        values.append(search_model.conditions[rank].value)
+    if search_model.paginated:
+        if search_model.cursor is not None:
+            values.extend(decode_cursor(search_model.cursor, search_model.order_by or 'id'))
+        # one extra row tells if there is a next page
+        values.append(page_size(search_model) + 1)
+    return values
+
+def page_size(search_model: Search) -> int:
+    """
+    Returns the number of rows in a page, capped to MAX_PAGE_SIZE
+    """
+    return min(search_model.limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+
+def encode_cursor(row: dict, order_by: str) -> str:
+    """
+    Returns the opaque cursor pointing after the given row
+    """
+    position = [row['id']] if order_by == 'id' else [row[order_by], row['id']]
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+def decode_cursor(cursor: str, order_by: str) -> list:
+    """
+    Returns the values of the sort key and id the cursor points after
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        raise InvalidQueryException("Invalid cursor")
+    if type(position) != list or len(position) != (1 if order_by == 'id' else 2):
+        raise InvalidQueryException("Invalid cursor")
+    # the cursor only ever holds the values of a row
+    if any(type(value) not in (str, int, float) for value in position):
+        raise InvalidQueryException("Invalid cursor")
+    return position
+
+def _check_column(table_name: str, key: str):
+    """
+    Raises InvalidQueryException unless the key is a column of the table,
+    the parent name of a child table is accepted as well
+    """
+    if table_name not in TABLE_COLUMNS:
+        raise InvalidQueryException(f"Unknown table {table_name}")
+    if key not in TABLE_COLUMNS[table_name] and key != PARENT_KEYS.get(table_name, (None,))[0]:
+        raise InvalidQueryException(f"Unknown column {key} in {table_name}")
+
+def _is_name(table_name: str, key: str) -> bool:
+    """
+    Returns if the key is the name of the table or the name of its parent
+    """
+    return key == NAME_KEYS.get(table_name) or key == PARENT_KEYS.get(table_name, (None,))[0]
+
+def name_condition(table_name: str, key: str, operator: str, value: str = "?") -> str:
+    """
+    Builds a like, match or prefix condition on the name of the table, or of its parent,
+    that is looked up in the full text index of the names instead of scanning the table
+
+    Parameters
+    ----------
+    table_name : str
+        table the condition is on
+    key : str
+        name column of the table or of its parent
+    operator : str
+        one of NAME_INDEX_CONDITIONS
+    value : str
+        placeholder of the value
+
+    Returns
+    -------
+    str
+        the sql condition
+    """
+    if key == NAME_KEYS.get(table_name):
+        column, indexed_table = f"{table_name}.id", table_name
+    elif key == PARENT_KEYS.get(table_name, (None,))[0]:
+        _, id_key, indexed_table = PARENT_KEYS[table_name]
+        column = f"{table_name}.{id_key}"
+    else:
+        raise InvalidQueryException(f"{operator} can only be used on names")
+    fts_table = FTS_TABLES[indexed_table]
+    # match finds the value anywhere in the name, prefix and like values are like patterns
+    match = f"{fts_table} MATCH {value}" if operator == 'match' else f"{key} LIKE {value}"
+    return NAME_INDEX_CONDITION.format(column=column, fts_table=fts_table, match=match)
+
+def name_value(operator: str, value):
+    """
+    Returns the value to bind to a match or prefix condition, other values are returned as they are
+    """
+    if operator == 'match':
+        if type(value) != str or len(value) < MIN_MATCH_LENGTH:
+            raise InvalidQueryException(f"match needs at least {MIN_MATCH_LENGTH} characters")
+        # quoted so the value is searched as it is and not as a full text query
+        return '"' + value.replace('"', '""') + '"'
+    if operator == 'prefix':
+        if type(value) != str:
+            raise InvalidQueryException("prefix needs a text value")
+        return value + '%'
+    return value
+
+def _rank_condition(table_name: str, select_table_name: str, join_key: str, keys, conditions: tuple, paginated: bool) -> int:
+    """
+    Returns the position of the match or prefix condition on the name of the table the results are
+    ranked by, or None when they are not ranked. Paginated searches keep their own order
+    """
+    if paginated or keys == "count" or (select_table_name and select_table_name != table_name):
+        return None
+    for position, (key, operator) in enumerate(conditions):
+        if operator in ('match', 'prefix') and key == NAME_KEYS.get(table_name):
+            return position
+    return None
+
+def _where_column(table_name: str, key: str, operator: str) -> str:
+    """
+    Builds the condition on one column with placeholders for its values,
+    a condition on the parent name of a child table is turned into a condition on the parent id
+    """
+    value = "? AND ?" if operator == "between" else "?"
+    if operator in NAME_INDEX_CONDITIONS and (_is_name(table_name, key) or operator != 'like'):
+        return name_condition(table_name, key, operator)
+    if table_name in PARENT_KEYS and key == PARENT_KEYS[table_name][0]:
+        name_key, id_key, parent_table = PARENT_KEYS[table_name]
+        return PARENT_NAME_CONDITION.format(table_name=table_name, id_key=id_key, parent_table=parent_table,
+                                            name_key=name_key, operator=operator, value=value)
+    return f"{table_name}.{key} {operator} {value}"
+
+def _select_keys(table_name: str, keys: tuple) -> list:
+    """
+    Selects the parent id in place of the parent name, the name is added back to the rows afterwards
+    """
+    for key in keys:
+        _check_column(table_name, key)
+    if table_name not in PARENT_KEYS:
+        return list(keys)
+    name_key, id_key, _ = PARENT_KEYS[table_name]
+    return [id_key if key == name_key else key for key in keys]
+
+def _join_condition(table_name: str, select_table_name: str, join_key: str) -> str:
+    """
+    Joins a child table to its parent on the parent id, when the join key is the parent name or id
+    Any other join key has to be a column of both the tables
+    """
+    for child, parent in ((table_name, select_table_name), (select_table_name, table_name)):
+        if child in PARENT_KEYS and PARENT_KEYS[child][2] == parent and join_key in PARENT_KEYS[child][:2]:
+            return f"{child}.{PARENT_KEYS[child][1]}={parent}.id"
+    if join_key not in TABLE_COLUMNS[table_name] or join_key not in TABLE_COLUMNS[select_table_name]:
+        raise InvalidQueryException(f"Cannot join {table_name} and {select_table_name} on {join_key}")
+    return f"{table_name}.{join_key}={select_table_name}.{join_key}"
+
+def _count_children(table_name: str, conditions: tuple) -> str:
+    """
+    Returns the query reading the count from the counters when the search counts the children
+    of one parent, given by id or name, optionally only the active or inactive ones. None otherwise
+    """
+    if table_name not in COUNTER_TABLES or not 1 <= len(conditions) <= 2:
+        return None
+    name_key, id_key, parent_table = PARENT_KEYS[table_name]
+    positions = {key: position for position, (key, operator) in enumerate(conditions, start=1) if operator == '='}
+    if len(positions) != len(conditions) or set(positions) - {'active', id_key, name_key} or (id_key in positions) == (name_key in positions):
+        return None
+    if id_key in positions:
+        parent = f"?{positions[id_key]}"
+    else:
+        parent = f"(SELECT id FROM {parent_table} WHERE {name_key} = ?{positions[name_key]})"
+    # active = ? matches nothing when the value is not a boolean
+    count = f"CASE ?{positions['active']} WHEN 1 THEN active WHEN 0 THEN total - active ELSE 0 END" if 'active' in positions else "total"
+    return COUNT_CHILDREN.format(count=count, counter_table=COUNTER_TABLES[table_name], id_key=id_key, parent=parent)
+
+@lru_cache(maxsize=SEARCH_CACHE_SIZE)
+def compile_search(shape: tuple) -> str:
+    """
+    Compiles the shape of a search to a sql template with ? placeholders for the values
     We allow simple select from a given table and also select keys from the parent table by mentioning join key
     TODO: There is a scope to update the request to select keys from both parent and child table
- 
+
     Parameters
     ----------
-    search_model : Search
-        pydantic model that needs to be converted to sql
- 
+    shape : tuple
+        shape of the search as returned by search_shape
+
     Returns
     -------
     str
-        returns the sql query
-    """
-    search_query = ""
-    table_name = search_model.table_name
-    select_table_name = ""
-
-    # check if the select table name matches the given table name
-    # other wise create the join query
-    if search_model.select:
-        keys = search_model.select.keys
-        if search_model.select.table_name and search_model.select.table_name != search_model.table_name:
-            select_table_name = search_model.select.table_name
-            if keys:
-                if type(keys) == list:
-                    search_query = f"SELECT DISTINCT {', '.join('select_table_name' + key for key in search_model.select.keys)} FROM {select_table_name}"
-                elif type(keys) == str and keys.lower() == "count":
-                    search_query = f"SELECT COUNT(DISTINCT {select_table_name}.id) as count from {select_table_name}"
-            else:
-                search_query = f"SELECT DISTINCT {select_table_name}.* from {select_table_name}"
-            search_query = f"{search_query} JOIN {table_name} ON {table_name}.{search_model.select.join_key}={select_table_name}.{search_model.select.join_key}" 
-        elif keys:
-                if type(keys) == list:
-                    search_query = f"SELECT {', '.join(key for key in search_model.select.keys)} FROM {table_name}"
-                elif type(keys) == str and keys.lower() == "count":
-                     search_query = f"SELECT COUNT(*) as count FROM {table_name}"
-        else:
-            search_query = f"SELECT * FROM {table_name}"
+        returns the sql template
+    """
+    table_name, select_table_name, join_key, keys, conditions, conditions_date, order_by, has_cursor = shape
+    if table_name not in TABLE_COLUMNS:
+        raise InvalidQueryException(f"Unknown table {table_name}")
+    if select_table_name == table_name:
+        select_table_name = ""
+    if select_table_name and select_table_name not in TABLE_COLUMNS:
+        raise InvalidQueryException(f"Unknown table {select_table_name}")
+
+    # select from the parent table through a join, otherwise from the same table
+    from_table_name = select_table_name or table_name
+    if order_by:
+        _check_column(from_table_name, order_by)
+        if order_by in NULLABLE_COLUMNS or order_by not in TABLE_COLUMNS[from_table_name]:
+            raise InvalidQueryException(f"Cannot order by {order_by}")
+        if keys == "count":
+            raise InvalidQueryException("Count cannot be paginated")
+        # the cursor of the next page is built from the sort key and id of the last row
+        if type(keys) == tuple:
+            keys = keys + tuple(key for key in ('id', order_by) if key not in keys)
+    if keys == "count" and not select_table_name and not conditions_date:
+        count_query = _count_children(table_name, conditions)
+        if count_query:
+            return count_query
+    if keys == "count":
+        columns = f"COUNT(DISTINCT {from_table_name}.id) as count" if select_table_name else "COUNT(*) as count"
+    elif type(keys) == tuple:
+        columns = ", ".join(f"{from_table_name}.{key}" for key in _select_keys(from_table_name, keys))
     else:
-        search_query = f"SELECT * from {table_name}"
-    
+        columns = f"{from_table_name}.*"
+    distinct = "DISTINCT " if select_table_name and keys != "count" else ""
+    search_query = f"SELECT {distinct}{columns} FROM {from_table_name}"
+    if select_table_name:
+        search_query = f"{search_query} JOIN {table_name} ON {_join_condition(table_name, select_table_name, join_key)}"
+
     # Generate the where condition by iterating through all the conditions
-    where_condition = ""
-    for condition in search_model.conditions:
-        if not select_table_name:
-            where_condition = f" {where_condition} {condition.key} "
-        else:
-            where_condition = f" {where_condition} {table_name}.{condition.key} "             
-        if type(condition.value) == str:
-                where_condition = f'{where_condition} {condition.operator} "{condition.value}"'
-        elif condition.operator == "between" and type(condition.value[0]) == str:
-             where_condition = f'{where_condition} {condition.operator} "{condition.value[0]}" AND "{condition.value[-1]}" '
-        elif condition.operator == "between" and type(condition.value[0]) != str:
-             where_condition = f'{where_condition} {condition.operator} {condition.value[0]} AND {condition.value[-1]} '
-        else:
-            where_condition = f'{where_condition} {condition.operator} {condition.value}'
-    
-    # We have separate field for date search - to make things simpler 
-    for condition in search_model.conditions_date:
-        if not select_table_name:
-            where_condition = f" {where_condition} {condition.key} "
-        else:
-            where_condition = f" {where_condition} {table_name}.{condition.key} "             
-        if condition.operator == "between":
-             where_condition = f'{where_condition} {condition.operator} "{condition.value[0]}" AND "{condition.value[-1]}" '
-        else:
-            where_condition = f'{where_condition} {condition.operator} "{condition.value}"'
-
-    return search_query if not where_condition else f"{search_query} WHERE {where_condition}"
-    
\ No newline at end of file
+    # We have separate field for date search - to make things simpler
+    where_conditions = []
+    for key, operator in conditions + conditions_date:
+        if operator not in VALID_CONDITIONS:
+            raise InvalidQueryException(f"Valid operator are {VALID_CONDITIONS}")
+        _check_column(table_name, key)
+        where_conditions.append(_where_column(table_name, key, operator))
+
+    # pages are read after the last row of the previous page rather than with an offset
+    if has_cursor:
+        position = f"{from_table_name}.id" if order_by == 'id' else f"({from_table_name}.{order_by}, {from_table_name}.id)"
+        where_conditions.append(f"{position} > {'?' if order_by == 'id' else '(?, ?)'}")
+
+    if where_conditions:
+        search_query = f"{search_query} WHERE {' AND '.join(where_conditions)}"
+    # names found by match or prefix come best match first: the names where the value is found earlier,
+    # then the shorter names
+    rank = _rank_condition(table_name, select_table_name, join_key, keys, conditions, bool(order_by))
+    if rank is not None:
+        name = f"{table_name}.{conditions[rank][0]}"
+        position = f"instr(lower({name}), lower(?)), " if conditions[rank][1] == 'match' else ""
+        search_query = f"{search_query} ORDER BY {position}length({name}), {name}"
+    if order_by:
+        order = f"{from_table_name}.id" if order_by == 'id' else f"{from_table_name}.{order_by}, {from_table_name}.id"
+        search_query = f"{search_query} ORDER BY {order} LIMIT ?"
+    return search_query
+
+def build_search_query(search_model: Search) -> tuple[str, list]:
+    """
+    Builds sql query from pydantic model Search
+    The sql text only depends on the shape of the search so it is compiled once per shape,
+    the values are bound as parameters
+
+    Parameters
+    ----------
+    search_model : Search
+        pydantic model that needs to be converted to sql
+
+    Returns
+    -------
+    tuple(str, list)
+        returns the sql query and the values to bind to it
+    """
+    return compile_search(search_shape(search_model)), search_values(search_model)
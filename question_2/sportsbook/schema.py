@@ -0,0 +1,145 @@
+"""
+This python file is used to create and migrate the database schema
+Every entry of MIGRATIONS is one schema version, the version applied last is
+stored in the database with PRAGMA user_version so every migration runs only once
+"""
+
+import sqlite3
+
+MIGRATIONS = [
+    # 1 - tables
+    [
+        """CREATE TABLE IF NOT EXISTS sports (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, sport_name VARCHAR(100) NOT NULL UNIQUE, slug VARCHAR(100) NOT NULL, active BOOLEAN NOT NULL)""",
+        """CREATE TABLE IF NOT EXISTS events (id INTEGER PRIMARY KEY AUTOINCREMENT, event_name VARCHAR(100) NOT NULL UNIQUE, slug VARCHAR(100) NOT NULL, active BOOLEAN NOT NULL, type VARCHAR(20) NOT NULL, sport_name VARCHAR(100) NOT NULL, status VARCHAR(20) NOT NULL, scheduled_start DATETIME NOT NULL, actual_start DATETIME, CONSTRAINT fk_sports FOREIGN KEY (sport_name) REFERENCES sports(name))""",
+        """CREATE TABLE IF NOT EXISTS selections (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, selection_name VARCHAR(100) NOT NULL UNIQUE, event_name VARCHAR(100) NOT NULL, price DECIMAL NOT NULL,active BOOLEAN not NULL, outcome VARCHAR(20), CONSTRAINT fk_events FOREIGN KEY (event_name) REFERENCES events(event_name))""",
+    ],
+    # 2 - indexes for the deactivation cascades and the common search filters
+    [
+        "CREATE INDEX IF NOT EXISTS idx_events_sport_active ON events(sport_name, active)",
+        "CREATE INDEX IF NOT EXISTS idx_selections_event_active ON selections(event_name, active)",
+        "CREATE INDEX IF NOT EXISTS idx_events_status_start ON events(status, scheduled_start)",
+        "CREATE INDEX IF NOT EXISTS idx_events_start ON events(scheduled_start)",
+        "CREATE INDEX IF NOT EXISTS idx_selections_outcome ON selections(outcome)",
+        "CREATE INDEX IF NOT EXISTS idx_sports_active ON sports(active)",
+    ],
+    # 3 - reference the parent rows by integer id instead of by name
+    # children whose parent name did not exist keep a NULL id
+    [
+        """CREATE TABLE selections_new (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, selection_name VARCHAR(100) NOT NULL UNIQUE, event_id INTEGER, price DECIMAL NOT NULL, active BOOLEAN NOT NULL, outcome VARCHAR(20), CONSTRAINT fk_events FOREIGN KEY (event_id) REFERENCES events(id))""",
+        """INSERT INTO selections_new (id, selection_name, event_id, price, active, outcome) SELECT s.id, s.selection_name, e.id, s.price, s.active, s.outcome FROM selections s LEFT JOIN events e ON e.event_name = s.event_name""",
+        """CREATE TABLE events_new (id INTEGER PRIMARY KEY AUTOINCREMENT, event_name VARCHAR(100) NOT NULL UNIQUE, slug VARCHAR(100) NOT NULL, active BOOLEAN NOT NULL, type VARCHAR(20) NOT NULL, sport_id INTEGER, status VARCHAR(20) NOT NULL, scheduled_start DATETIME NOT NULL, actual_start DATETIME, CONSTRAINT fk_sports FOREIGN KEY (sport_id) REFERENCES sports(id))""",
+        """INSERT INTO events_new (id, event_name, slug, active, type, sport_id, status, scheduled_start, actual_start) SELECT e.id, e.event_name, e.slug, e.active, e.type, s.id, e.status, e.scheduled_start, e.actual_start FROM events e LEFT JOIN sports s ON s.sport_name = e.sport_name""",
+        "DROP TABLE selections",
+        "DROP TABLE events",
+        "ALTER TABLE events_new RENAME TO events",
+        "ALTER TABLE selections_new RENAME TO selections",
+        "CREATE INDEX idx_events_sport_active ON events(sport_id, active)",
+        "CREATE INDEX idx_events_status_start ON events(status, scheduled_start)",
+        "CREATE INDEX idx_events_start ON events(scheduled_start)",
+        "CREATE INDEX idx_selections_event_active ON selections(event_id, active)",
+        "CREATE INDEX idx_selections_outcome ON selections(outcome)",
+    ],
+    # 4 - change log of every row written, filled by triggers in the same transaction as the write
+    # seq is AUTOINCREMENT so it keeps increasing after old entries are compacted
+    [
+        """CREATE TABLE changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, table_name VARCHAR(20) NOT NULL, row_id INTEGER NOT NULL, operation VARCHAR(10) NOT NULL, data TEXT, changed_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP)""",
+        "CREATE INDEX idx_changes_changed_at ON changes(changed_at)",
+        """CREATE TRIGGER sports_insert_change AFTER INSERT ON sports BEGIN INSERT INTO changes (table_name, row_id, operation, data) VALUES ('sports', NEW.id, 'insert', json_object('id', NEW.id, 'sport_name', NEW.sport_name, 'slug', NEW.slug, 'active', NEW.active)); END""",
+        """CREATE TRIGGER sports_update_change AFTER UPDATE ON sports BEGIN INSERT INTO changes (table_name, row_id, operation, data) VALUES ('sports', NEW.id, 'update', json_object('id', NEW.id, 'sport_name', NEW.sport_name, 'slug', NEW.slug, 'active', NEW.active)); END""",
+        """CREATE TRIGGER sports_delete_change AFTER DELETE ON sports BEGIN INSERT INTO changes (table_name, row_id, operation) VALUES ('sports', OLD.id, 'delete'); END""",
+        """CREATE TRIGGER events_insert_change AFTER INSERT ON events BEGIN INSERT INTO changes (table_name, row_id, operation, data) VALUES ('events', NEW.id, 'insert', json_object('id', NEW.id, 'event_name', NEW.event_name, 'slug', NEW.slug, 'active', NEW.active, 'type', NEW.type, 'sport_id', NEW.sport_id, 'status', NEW.status, 'scheduled_start', NEW.scheduled_start, 'actual_start', NEW.actual_start)); END""",
+        """CREATE TRIGGER events_update_change AFTER UPDATE ON events BEGIN INSERT INTO changes (table_name, row_id, operation, data) VALUES ('events', NEW.id, 'update', json_object('id', NEW.id, 'event_name', NEW.event_name, 'slug', NEW.slug, 'active', NEW.active, 'type', NEW.type, 'sport_id', NEW.sport_id, 'status', NEW.status, 'scheduled_start', NEW.scheduled_start, 'actual_start', NEW.actual_start)); END""",
+        """CREATE TRIGGER events_delete_change AFTER DELETE ON events BEGIN INSERT INTO changes (table_name, row_id, operation) VALUES ('events', OLD.id, 'delete'); END""",
+        """CREATE TRIGGER selections_insert_change AFTER INSERT ON selections BEGIN INSERT INTO changes (table_name, row_id, operation, data) VALUES ('selections', NEW.id, 'insert', json_object('id', NEW.id, 'selection_name', NEW.selection_name, 'event_id', NEW.event_id, 'price', NEW.price, 'active', NEW.active, 'outcome', NEW.outcome)); END""",
+        """CREATE TRIGGER selections_update_change AFTER UPDATE ON selections BEGIN INSERT INTO changes (table_name, row_id, operation, data) VALUES ('selections', NEW.id, 'update', json_object('id', NEW.id, 'selection_name', NEW.selection_name, 'event_id', NEW.event_id, 'price', NEW.price, 'active', NEW.active, 'outcome', NEW.outcome)); END""",
+        """CREATE TRIGGER selections_delete_change AFTER DELETE ON selections BEGIN INSERT INTO changes (table_name, row_id, operation) VALUES ('selections', OLD.id, 'delete'); END""",
+    ],
+    # 5 - number of events of every sport and selections of every event, in total and active,
+    # kept up to date by triggers so the deactivation cascades do not count the children
+    [
+        """CREATE TABLE sport_counts (sport_id INTEGER PRIMARY KEY, total INTEGER NOT NULL DEFAULT 0, active INTEGER NOT NULL DEFAULT 0)""",
+        """INSERT INTO sport_counts (sport_id, total, active) SELECT sport_id, count(*), sum(active = 1) FROM events WHERE sport_id IS NOT NULL GROUP BY sport_id""",
+        """CREATE TRIGGER events_insert_count AFTER INSERT ON events WHEN NEW.sport_id IS NOT NULL BEGIN INSERT INTO sport_counts (sport_id, total, active) VALUES (NEW.sport_id, 1, NEW.active = 1) ON CONFLICT (sport_id) DO UPDATE SET total = total + 1, active = active + excluded.active; END""",
+        """CREATE TRIGGER events_delete_count AFTER DELETE ON events WHEN OLD.sport_id IS NOT NULL BEGIN UPDATE sport_counts SET total = total - 1, active = active - (OLD.active = 1) WHERE sport_id = OLD.sport_id; END""",
+        """CREATE TRIGGER events_update_count AFTER UPDATE OF sport_id, active ON events WHEN OLD.sport_id IS NOT NEW.sport_id OR OLD.active IS NOT NEW.active BEGIN UPDATE sport_counts SET total = total - 1, active = active - (OLD.active = 1) WHERE sport_id = OLD.sport_id; INSERT INTO sport_counts (sport_id, total, active) SELECT NEW.sport_id, 1, NEW.active = 1 WHERE NEW.sport_id IS NOT NULL ON CONFLICT (sport_id) DO UPDATE SET total = total + 1, active = active + excluded.active; END""",
+        """CREATE TABLE event_counts (event_id INTEGER PRIMARY KEY, total INTEGER NOT NULL DEFAULT 0, active INTEGER NOT NULL DEFAULT 0)""",
+        """INSERT INTO event_counts (event_id, total, active) SELECT event_id, count(*), sum(active = 1) FROM selections WHERE event_id IS NOT NULL GROUP BY event_id""",
+        """CREATE TRIGGER selections_insert_count AFTER INSERT ON selections WHEN NEW.event_id IS NOT NULL BEGIN INSERT INTO event_counts (event_id, total, active) VALUES (NEW.event_id, 1, NEW.active = 1) ON CONFLICT (event_id) DO UPDATE SET total = total + 1, active = active + excluded.active; END""",
+        """CREATE TRIGGER selections_delete_count AFTER DELETE ON selections WHEN OLD.event_id IS NOT NULL BEGIN UPDATE event_counts SET total = total - 1, active = active - (OLD.active = 1) WHERE event_id = OLD.event_id; END""",
+        """CREATE TRIGGER selections_update_count AFTER UPDATE OF event_id, active ON selections WHEN OLD.event_id IS NOT NEW.event_id OR OLD.active IS NOT NEW.active BEGIN UPDATE event_counts SET total = total - 1, active = active - (OLD.active = 1) WHERE event_id = OLD.event_id; INSERT INTO event_counts (event_id, total, active) SELECT NEW.event_id, 1, NEW.active = 1 WHERE NEW.event_id IS NOT NULL ON CONFLICT (event_id) DO UPDATE SET total = total + 1, active = active + excluded.active; END""",
+    ],
+    # 6 - prices as whole hundredths instead of floating point, selections is rebuilt for the
+    # column type so its indexes and triggers are created again, the change log keeps decimal prices
+    [
+        """CREATE TABLE selections_new (id INTEGER PRIMARY KEY AUTOINCREMENT NOT NULL, selection_name VARCHAR(100) NOT NULL UNIQUE, event_id INTEGER, price INTEGER NOT NULL, active BOOLEAN NOT NULL, outcome VARCHAR(20), CONSTRAINT fk_events FOREIGN KEY (event_id) REFERENCES events(id))""",
+        """INSERT INTO selections_new (id, selection_name, event_id, price, active, outcome) SELECT id, selection_name, event_id, CAST(round(price * 100) AS INTEGER), active, outcome FROM selections""",
+        "DROP TABLE selections",
+        "ALTER TABLE selections_new RENAME TO selections",
+        "CREATE INDEX idx_selections_event_active ON selections(event_id, active)",
+        "CREATE INDEX idx_selections_outcome ON selections(outcome)",
+        """CREATE TRIGGER selections_insert_change AFTER INSERT ON selections BEGIN INSERT INTO changes (table_name, row_id, operation, data) VALUES ('selections', NEW.id, 'insert', json_object('id', NEW.id, 'selection_name', NEW.selection_name, 'event_id', NEW.event_id, 'price', NEW.price / 100.0, 'active', NEW.active, 'outcome', NEW.outcome)); END""",
+        """CREATE TRIGGER selections_update_change AFTER UPDATE ON selections BEGIN INSERT INTO changes (table_name, row_id, operation, data) VALUES ('selections', NEW.id, 'update', json_object('id', NEW.id, 'selection_name', NEW.selection_name, 'event_id', NEW.event_id, 'price', NEW.price / 100.0, 'active', NEW.active, 'outcome', NEW.outcome)); END""",
+        """CREATE TRIGGER selections_delete_change AFTER DELETE ON selections BEGIN INSERT INTO changes (table_name, row_id, operation) VALUES ('selections', OLD.id, 'delete'); END""",
+        """CREATE TRIGGER selections_insert_count AFTER INSERT ON selections WHEN NEW.event_id IS NOT NULL BEGIN INSERT INTO event_counts (event_id, total, active) VALUES (NEW.event_id, 1, NEW.active = 1) ON CONFLICT (event_id) DO UPDATE SET total = total + 1, active = active + excluded.active; END""",
+        """CREATE TRIGGER selections_delete_count AFTER DELETE ON selections WHEN OLD.event_id IS NOT NULL BEGIN UPDATE event_counts SET total = total - 1, active = active - (OLD.active = 1) WHERE event_id = OLD.event_id; END""",
+        """CREATE TRIGGER selections_update_count AFTER UPDATE OF event_id, active ON selections WHEN OLD.event_id IS NOT NEW.event_id OR OLD.active IS NOT NEW.active BEGIN UPDATE event_counts SET total = total - 1, active = active - (OLD.active = 1) WHERE event_id = OLD.event_id; INSERT INTO event_counts (event_id, total, active) SELECT NEW.event_id, 1, NEW.active = 1 WHERE NEW.event_id IS NOT NULL ON CONFLICT (event_id) DO UPDATE SET total = total + 1, active = active + excluded.active; END""",
+    ],
+    # 7 - trigram full text indexes of the names, for like, match and prefix searches on names
+    # they read the names from the tables and are kept in sync by triggers
+    [
+        """CREATE VIRTUAL TABLE sports_fts USING fts5(sport_name, content='sports', content_rowid='id', tokenize='trigram')""",
+        "INSERT INTO sports_fts (sports_fts) VALUES ('rebuild')",
+        """CREATE TRIGGER sports_insert_fts AFTER INSERT ON sports BEGIN INSERT INTO sports_fts (rowid, sport_name) VALUES (NEW.id, NEW.sport_name); END""",
+        """CREATE TRIGGER sports_delete_fts AFTER DELETE ON sports BEGIN INSERT INTO sports_fts (sports_fts, rowid, sport_name) VALUES ('delete', OLD.id, OLD.sport_name); END""",
+        """CREATE TRIGGER sports_update_fts AFTER UPDATE OF sport_name ON sports BEGIN INSERT INTO sports_fts (sports_fts, rowid, sport_name) VALUES ('delete', OLD.id, OLD.sport_name); INSERT INTO sports_fts (rowid, sport_name) VALUES (NEW.id, NEW.sport_name); END""",
+        """CREATE VIRTUAL TABLE events_fts USING fts5(event_name, content='events', content_rowid='id', tokenize='trigram')""",
+        "INSERT INTO events_fts (events_fts) VALUES ('rebuild')",
+        """CREATE TRIGGER events_insert_fts AFTER INSERT ON events BEGIN INSERT INTO events_fts (rowid, event_name) VALUES (NEW.id, NEW.event_name); END""",
+        """CREATE TRIGGER events_delete_fts AFTER DELETE ON events BEGIN INSERT INTO events_fts (events_fts, rowid, event_name) VALUES ('delete', OLD.id, OLD.event_name); END""",
+        """CREATE TRIGGER events_update_fts AFTER UPDATE OF event_name ON events BEGIN INSERT INTO events_fts (events_fts, rowid, event_name) VALUES ('delete', OLD.id, OLD.event_name); INSERT INTO events_fts (rowid, event_name) VALUES (NEW.id, NEW.event_name); END""",
+        """CREATE VIRTUAL TABLE selections_fts USING fts5(selection_name, content='selections', content_rowid='id', tokenize='trigram')""",
+        "INSERT INTO selections_fts (selections_fts) VALUES ('rebuild')",
+        """CREATE TRIGGER selections_insert_fts AFTER INSERT ON selections BEGIN INSERT INTO selections_fts (rowid, selection_name) VALUES (NEW.id, NEW.selection_name); END""",
+        """CREATE TRIGGER selections_delete_fts AFTER DELETE ON selections BEGIN INSERT INTO selections_fts (selections_fts, rowid, selection_name) VALUES ('delete', OLD.id, OLD.selection_name); END""",
+        """CREATE TRIGGER selections_update_fts AFTER UPDATE OF selection_name ON selections BEGIN INSERT INTO selections_fts (selections_fts, rowid, selection_name) VALUES ('delete', OLD.id, OLD.selection_name); INSERT INTO selections_fts (rowid, selection_name) VALUES (NEW.id, NEW.selection_name); END""",
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def migrate(path: str) -> int:
+    """
+    Applies all the migrations the database at the given path is missing
+
+    Parameters
+    ----------
+    path : str
+        path of the sqlite database
+
+    Returns
+    -------
+    int
+        schema version of the database after the migration
+    """
+    connection = sqlite3.connect(path, isolation_level=None, timeout=30)
+    try:
+        while True:
+            # the version is read under the write lock, so workers starting together
+            # do not apply the same migration twice
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                version = connection.execute("PRAGMA user_version").fetchone()[0]
+                if version >= SCHEMA_VERSION:
+                    connection.execute("COMMIT")
+                    return version
+                for statement in MIGRATIONS[version]:
+                    connection.execute(statement)
+                # user_version does not accept bound parameters
+                connection.execute(f"PRAGMA user_version = {version + 1}")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+            connection.execute("COMMIT")
+    finally:
+        connection.close()
@@ -0,0 +1,101 @@
+"""
+This python file is used to log the statements slower than a threshold
+Every slow statement is logged as one json line with its normalized sql, its redacted parameters and its duration.
+The EXPLAIN QUERY PLAN of every statement is captured the first time it is slow, so a full scan is seen
+straight away, and the statements are ranked by the total time they were slow for
+"""
+
+import json
+import logging
+import os
+
+from .constants import SLOW_QUERY_THRESHOLD, SLOW_QUERY_SHAPES
+from .metrics import normalize_sql
+
+logger = logging.getLogger("sportsbook.slow_queries")
+
+
+def redact(values):
+    """
+    Returns the parameters with the text replaced by its length, numbers and nulls are kept
+    as they say which rows were read but not what the clients wrote
+    """
+    def redact_value(value):
+        if isinstance(value, (str, bytes)):
+            return f"<{type(value).__name__} {len(value)}>"
+        if value is None or isinstance(value, (bool, int, float)):
+            return value
+        return f"<{type(value).__name__}>"
+    if isinstance(values, dict):
+        return {key: redact_value(value) for key, value in values.items()}
+    return [redact_value(value) for value in values or ()]
+
+
+class SlowQueryLog:
+    """
+    Log and ranking of the statements that took longer than threshold seconds
+    """
+
+    def __init__(self, threshold: float = SLOW_QUERY_THRESHOLD, max_shapes: int = SLOW_QUERY_SHAPES):
+        self.threshold = threshold
+        self.max_shapes = max_shapes
+        # normalized sql -> counters and query plan of the statement
+        self._shapes = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    async def record(self, query: str, values, seconds: float, database):
+        """
+        Logs the statement if it was slow, and captures its query plan the first time
+
+        Parameters
+        ----------
+        query : str
+            statement that was run
+        values : list or dict
+            parameters it was run with
+        seconds : float
+            time it took
+        database : aiosqlite.Connection
+            connection it ran on, the plan is explained on it
+        """
+        if not self.enabled or seconds < self.threshold:
+            return
+        statement = normalize_sql(query)
+        shape = self._shapes.get(statement)
+        if shape is None:
+            if len(self._shapes) >= self.max_shapes:
+                del self._shapes[min(self._shapes, key=lambda key: self._shapes[key]["total_ms"])]
+            shape = self._shapes[statement] = {"sql": statement, "count": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                               "plan": await self._explain(query, values, database)}
+        milliseconds = round(seconds * 1000, 3)
+        shape["count"] += 1
+        shape["total_ms"] = round(shape["total_ms"] + milliseconds, 3)
+        shape["max_ms"] = max(shape["max_ms"], milliseconds)
+        shape["last_params"] = redact(values)
+        logger.warning(json.dumps({"event": "slow_query", "sql": statement, "params": shape["last_params"],
+                                   "duration_ms": milliseconds, "plan": shape["plan"]}, default=str))
+
+    async def _explain(self, query: str, values, database) -> list[str]:
+        """
+        Returns the lines of the query plan, empty when the statement cannot be explained
+        """
+        try:
+            rows = await database.execute_fetchall(f"EXPLAIN QUERY PLAN {query}", values or ())
+        except Exception:
+            return []
+        return [row[3] for row in rows]
+
+    def top(self, limit: int) -> list[dict]:
+        """
+        Returns the slow statements that took the most time in total
+        """
+        return sorted(self._shapes.values(), key=lambda shape: shape["total_ms"], reverse=True)[:limit]
+
+    def clear(self):
+        self._shapes.clear()
+
+
+slow_queries = SlowQueryLog(float(os.environ.get('DB_SLOW_QUERY_MS', SLOW_QUERY_THRESHOLD * 1000)) / 1000)
@@ -1,6 +1,13 @@
+import json
 from fastapi.testclient import TestClient
 from sportsbook.__main__ import app
-from sportsbook.database import fetch_values
+from sportsbook.database import fetch_values, query_cache
+from sportsbook.pubsub import broker
+from sportsbook.names import NAME_MAPS, NameMap
+from sportsbook.constants import Tables
+
+import sqlite3
+import threading
 
 from conftest import execute_query
 
@@ -132,6 +139,33 @@ def test_post_selection_error():
     response = client.post("/selection", json=body)
     assert response.status_code == 422
 
+def test_selection_price_rules():
+    body = {
+    "selection_name": "badprice",
+    "event_name": "test",
+    "active": True,
+    "outcome": "void"}
+
+    # every write path applies the rules of the bulk price updates, prices are not rounded to fit
+    for price, message in ((1.234, "price should be a multiple of 0.01"),
+                           (0.5, "price should be between 1.01 and 1000.0"),
+                           ("Infinity", "price should be a number")):
+        response = client.post("/selection", json={**body, "price": price})
+        assert response.status_code == 422
+        assert response.json()['detail'][0]['msg'] == f"Value error, {message}"
+        response = client.put("/selection", json={"update": {"price": price}, "condition": {"id": 1}})
+        assert response.status_code == 422
+        response = client.post("/selection/bulk", json=[{**body, "price": price}])
+        assert response.json() == [{"error": f"Value error, {message}"}]
+    assert execute_query("SELECT id FROM selections WHERE selection_name = 'badprice'") == []
+
+    response = client.post("/search", json={"table_name": "selections",
+                                            "conditions": [{"key": "price", "operator": "=", "value": "Infinity"}]})
+    assert response.status_code == 200
+    response = client.post("/search", content='{"table_name": "selections", "conditions": [{"key": "price", "operator": "<", "value": Infinity}]}',
+                           headers={"Content-Type": "application/json"})
+    assert response.status_code == 400
+
 def test_put_sport():
     body = {
             "update": {
@@ -169,7 +203,7 @@ def test_put_sport():
     response = client.put("/sport", json=body)
     assert response.status_code == 200
 
-    query = 'SELECT * from events where sport_name = "test1"' 
+    query = 'SELECT e.* from events e join sports s on s.id = e.sport_id where s.sport_name = "test1"' 
     rows = execute_query(query)
     assert len(rows) == 1
 
@@ -216,7 +250,7 @@ def test_put_event():
     rows = execute_query(query)
     assert rows[0]['active'] == 0
 
-    query = 'SELECT * from selections where event_name = "test1"' 
+    query = 'SELECT s.* from selections s join events e on e.id = s.event_id where e.event_name = "test1"' 
     rows = execute_query(query)
     assert len(rows) == 1
 
@@ -257,7 +291,8 @@ def test_put_selection():
     assert response.status_code == 200
     query = 'SELECT * from selections where selection_name = "test"' 
     rows = execute_query(query)
-    assert rows[0]['price'] == 1.1
+    # prices are stored as hundredths
+    assert rows[0]['price'] == 110
 
     body = {
         "update": {
@@ -277,4 +312,396 @@ def test_put_selection():
 
     query = 'select * from events where event_name = "test1"'
     rows = execute_query(query)
-    assert rows[0]['active'] == 0
\ No newline at end of file
+    assert rows[0]['active'] == 0
+
+def test_put_selection_publishes():
+    selection = execute_query('SELECT s.id, s.event_id, e.sport_id from selections s join events e on e.id = s.event_id')[0]
+    by_sport = broker.subscribe({("sports", selection['sport_id'])})
+    by_other = broker.subscribe({("selections", -1)})
+    try:
+        response = client.put("/selection", json={"update": {"price": 2.5}, "condition": {"id": selection['id']}})
+        assert response.status_code == 200
+        message = by_sport.queue.get_nowait()
+        assert message["table"] == "selections"
+        assert message["row"]["id"] == selection['id']
+        assert message["row"]["price"] == 2.5
+        assert message["row"]["event_name"]
+        assert by_other.queue.empty()
+    finally:
+        broker.unsubscribe(by_sport)
+        broker.unsubscribe(by_other)
+
+    response = client.get("/subscribe")
+    assert response.status_code == 400
+
+def test_put_sport_rollback():
+    body = {
+    "sport_name": "test2",
+    "slug": "test2",
+    "active": True
+    }
+    response = client.post("/sport", json=body)
+    assert response.status_code == 200
+
+    # renaming to an existing name fails and the sport keeps its name, its events still find it by id
+    body = {
+        "update": {
+            "sport_name": "test2"
+        },
+        "condition": {
+            "id": 1
+        }
+        }
+    response = client.put("/sport", json=body)
+    assert response.status_code == 400
+
+    query = 'SELECT e.* from events e join sports s on s.id = e.sport_id where s.sport_name = "test1"'
+    rows = execute_query(query)
+    assert len(rows) == 1
+
+def test_search_parent_name():
+    body = {
+        "table_name": "events",
+        "conditions": [{
+            "key": "sport_name",
+            "operator": "=",
+            "value": "test1"
+        }]
+    }
+    response = client.post("/search", json=body)
+    assert response.status_code == 200
+    rows = response.json()
+    assert len(rows) == 1
+    assert rows[0]['sport_name'] == "test1"
+    # the names are added to copies, the cached rows stay as they were read
+    cached = [row for key, entry in query_cache._entries.items() if key[0] == 'search' and 'events' in entry[2]
+              for row in entry[1]]
+    assert cached and all('sport_name' not in row for row in cached)
+
+    body = {
+        "table_name": "events",
+        "conditions": [{
+            "key": "active",
+            "operator": "=",
+            "value": False
+        }],
+        "select": {
+            "table_name": "sports",
+            "join_key": "sport_name"
+        }
+    }
+    response = client.post("/search", json=body)
+    assert response.status_code == 200
+    assert [row['sport_name'] for row in response.json()] == ["test1"]
+
+    # the sport id is selected only to look the name up, the rows hold the selected keys
+    body = {
+        "table_name": "selections",
+        "select": {
+            "table_name": "events",
+            "join_key": "event_name",
+            "keys": ["sport_name"]
+        }
+    }
+    response = client.post("/search", json=body)
+    assert response.status_code == 200
+    assert response.json() and all(list(row) == ["sport_name"] for row in response.json())
+
+def test_search_pagination():
+    for name in ["page1", "page2", "page3"]:
+        body = {
+        "sport_name": name,
+        "slug": name,
+        "active": True
+        }
+        response = client.post("/sport", json=body)
+        assert response.status_code == 200
+
+    body = {
+        "table_name": "sports",
+        "conditions": [{
+            "key": "sport_name",
+            "operator": "like",
+            "value": "page%"
+        }],
+        "limit": 2,
+        "order_by": "sport_name"
+    }
+    response = client.post("/search", json=body)
+    assert response.status_code == 200
+    page = response.json()
+    assert [row['sport_name'] for row in page['rows']] == ["page1", "page2"]
+    assert page['next_cursor']
+
+    body['cursor'] = page['next_cursor']
+    response = client.post("/search", json=body)
+    page = response.json()
+    assert [row['sport_name'] for row in page['rows']] == ["page3"]
+    assert page['next_cursor'] is None
+
+    body['cursor'] = "not a cursor"
+    response = client.post("/search", json=body)
+    assert response.status_code == 400
+
+def test_search_stream():
+    body = {
+        "table_name": "sports",
+        "conditions": [{
+            "key": "sport_name",
+            "operator": "like",
+            "value": "page%"
+        }]
+    }
+    response = client.post("/search", json=body, headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers['content-type'] == "application/x-ndjson"
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert [row['sport_name'] for row in rows] == ["page1", "page2", "page3"]
+
+def test_search_stream_one_reader(monkeypatch):
+    # the sport names are not known yet, they are looked up while the stream holds the only reader
+    monkeypatch.setenv("DB_READERS", "1")
+    monkeypatch.setitem(NAME_MAPS, Tables.SPORTS, NameMap(Tables.SPORTS, 'sport_name'))
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        client.post("/search", json={"table_name": "events"}, headers={"Accept": "application/x-ndjson"})), daemon=True)
+    thread.start()
+    thread.join(10)
+    assert results, "the stream did not finish"
+    rows = [json.loads(line) for line in results[0].text.splitlines()]
+    assert rows and all(row['sport_name'] for row in rows if row['sport_id'] is not None)
+
+def test_post_selection_bulk():
+    body = [
+        {"selection_name": "bulk1", "event_name": "test1", "price": 1.5, "active": True, "outcome": "unsettled"},
+        {"selection_name": "bulk2", "event_name": "test1", "price": 2.5, "active": True, "outcome": "unsettled"},
+        {"selection_name": "bulk1", "event_name": "test1", "price": 1.5, "active": True, "outcome": "unsettled"},
+        {"selection_name": "bulk3", "event_name": "unknown", "price": 1.5, "active": True, "outcome": "unsettled"},
+        {"selection_name": "test1", "event_name": "test1", "price": 1.5, "active": True, "outcome": "unsettled"},
+        {"selection_name": "bulk4", "event_name": "test1", "price": 1.5, "active": True, "outcome": "unknown"},
+    ]
+    response = client.post("/selection/bulk", json=body)
+    assert response.status_code == 200
+    results = response.json()
+    ids = [result['id'] for result in results[:2]]
+    assert [list(result) for result in results[2:]] == [['error']] * 4
+
+    rows = execute_query(f'SELECT * from selections where id in ({ids[0]}, {ids[1]}) order by id')
+    assert [row['selection_name'] for row in rows] == ["bulk1", "bulk2"]
+
+def test_get_changes():
+    response = client.get("/changes", params={"after": 0, "limit": 2})
+    assert response.status_code == 200
+    page = response.json()
+    assert [change['seq'] for change in page['changes']] == [1, 2]
+    assert page['changes'][0]['table_name'] == 'sports'
+    assert page['changes'][0]['operation'] == 'insert'
+    assert page['changes'][0]['data']['sport_name'] == 'test'
+    assert page['last_seq'] == 2
+    assert not page['truncated']
+
+    last_seq = execute_query("SELECT max(seq) AS seq FROM changes")[0]['seq']
+    response = client.put("/sport", json={"update": {"slug": "changed"}, "condition": {"id": 1}})
+    assert response.status_code == 200
+    page = client.get("/changes", params={"after": last_seq, "wait": 1}).json()
+    assert [(change['table_name'], change['row_id'], change['operation']) for change in page['changes']] == [('sports', 1, 'update')]
+    assert page['changes'][0]['data']['slug'] == 'changed'
+
+    # nothing new, the long poll returns empty once the wait is over
+    page = client.get("/changes", params={"after": page['last_seq'], "wait": 0.2}).json()
+    assert page['changes'] == []
+
+    response = client.get("/changes", params={"limit": 0})
+    assert response.status_code == 400
+
+def test_search_count_from_counters():
+    for sport in execute_query("SELECT id, sport_name FROM sports"):
+        for active in (True, False):
+            expected = execute_query(f"SELECT count(*) AS count FROM events WHERE sport_id = {sport['id']} AND active = {int(active)}")
+            for key, value in (("sport_id", sport['id']), ("sport_name", sport['sport_name'])):
+                body = {"table_name": "events", "select": {"keys": "count"},
+                        "conditions": [{"key": key, "operator": "=", "value": value},
+                                       {"key": "active", "operator": "=", "value": active}]}
+                response = client.post("/search", json=body)
+                assert response.status_code == 200
+                assert response.json() == expected
+
+def test_counters_check():
+    response = client.post("/counters/check")
+    assert response.json() == {"sport_counts": [], "event_counts": []}
+
+    connection = sqlite3.connect("test.db")
+    connection.execute("UPDATE event_counts SET active = active + 5 WHERE event_id = 1")
+    connection.commit()
+    connection.close()
+    response = client.post("/counters/check", params={"rebuild": True})
+    mismatches = response.json()["event_counts"]
+    assert [mismatch["event_id"] for mismatch in mismatches] == [1]
+    assert mismatches[0]["counted_active"] == mismatches[0]["active"] + 5
+
+    response = client.post("/counters/check")
+    assert response.json() == {"sport_counts": [], "event_counts": []}
+
+def test_settle_event():
+    client.post("/sport", json={"sport_name": "settled", "slug": "settled", "active": True})
+    for event_name in ("settleone", "settletwo"):
+        client.post("/event", json={"event_name": event_name, "slug": event_name, "active": True, "type": "preplay",
+                                    "sport_name": "settled", "status": "started", "scheduled_start": "2024-01-01T00:00:00",
+                                    "actual_start": "2024-01-01T00:00:00"})
+        for selection_name in ("home", "draw", "away"):
+            client.post("/selection", json={"selection_name": f"{event_name}{selection_name}", "event_name": event_name,
+                                            "price": 2.5, "active": True, "outcome": "unsettled"})
+    events = {row['event_name']: row['id'] for row in execute_query("SELECT id, event_name FROM events WHERE event_name like 'settle%'")}
+    selections = {row['selection_name']: row['id'] for row in execute_query("SELECT id, selection_name FROM selections WHERE selection_name like 'settle%'")}
+
+    # a selection of another event rolls the settlement back
+    response = client.post(f"/event/{events['settleone']}/settle", json={"winners": [selections['settletwohome']]})
+    assert response.status_code == 400
+    assert execute_query(f"SELECT status FROM events WHERE id = {events['settleone']}")[0]['status'] == 'started'
+
+    response = client.post(f"/event/{events['settleone']}/settle",
+                           json={"winners": [selections['settleonehome']], "void": [selections['settleonedraw']]})
+    assert response.status_code == 200
+    rows = execute_query(f"SELECT selection_name, outcome, active FROM selections WHERE event_id = {events['settleone']}")
+    assert {row['selection_name']: row['outcome'] for row in rows} == {"settleonehome": "win", "settleonedraw": "void", "settleoneaway": "lose"}
+    assert not any(row['active'] for row in rows)
+    assert execute_query("SELECT active FROM sports WHERE sport_name = 'settled'")[0]['active'] == 1
+
+    response = client.post("/event/settle/bulk", json=[{"event_id": events['settletwo'], "void_all": True},
+                                                       {"event_id": events['settleone'], "winners": [selections['settleoneaway']]}])
+    assert response.status_code == 200
+    assert response.json() == "Settled 2 events and 6 selections"
+    rows = execute_query(f"SELECT outcome FROM selections WHERE event_id = {events['settletwo']}")
+    assert {row['outcome'] for row in rows} == {"void"}
+    rows = execute_query("SELECT status, active FROM events WHERE event_name like 'settle%'")
+    assert all(row['status'] == 'ended' and not row['active'] for row in rows)
+    assert execute_query("SELECT active FROM sports WHERE sport_name = 'settled'")[0]['active'] == 0
+
+    response = client.post("/event/999999/settle", json={})
+    assert response.status_code == 400
+
+def test_event_book():
+    client.post("/sport", json={"sport_name": "booked", "slug": "booked", "active": True})
+    client.post("/event", json={"event_name": "bookone", "slug": "bookone", "active": True, "type": "preplay",
+                                "sport_name": "booked", "status": "pending", "scheduled_start": "2024-01-01T00:00:00"})
+    for selection_name, price in (("bookhome", 2.0), ("bookdraw", 4.0), ("bookaway", 2.5)):
+        client.post("/selection", json={"selection_name": selection_name, "event_name": "bookone",
+                                        "price": price, "active": True, "outcome": "unsettled"})
+    event_id = execute_query("SELECT id FROM events WHERE event_name = 'bookone'")[0]['id']
+
+    response = client.get(f"/event/{event_id}/book")
+    assert response.status_code == 200
+    book = response.json()
+    assert book["event_id"] == [event_id]
+    assert book["overround"] == [1.15]
+    assert book["margin"] == [0.15]
+    assert book["selections"]["price"] == [2.0, 4.0, 2.5]
+    assert book["selections"]["implied_probability"] == [0.5, 0.25, 0.4]
+    assert abs(sum(book["selections"]["fair_probability"]) - 1) < 1e-5
+    assert book["selections"]["fair_price"] == [2.3, 4.6, 2.875]
+
+    response = client.get("/event/book", params={"event_id": [event_id, 999999]})
+    assert response.status_code == 200
+    books = response.json()
+    assert books["overround"] == [1.15, None]
+    assert books["selections"]["event_id"] == [event_id] * 3
+
+    assert client.get("/event/999999/book").status_code == 400
+    assert client.get("/event/book").status_code == 400
+
+def test_put_prices():
+    selections = execute_query("SELECT id, price FROM selections WHERE selection_name in ('bookhome', 'bookdraw', 'bookaway') ORDER BY id")
+    ids = [row['id'] for row in selections]
+    body = {"id": ids + [ids[0], 999999, ids[1], ids[2]],
+            "price": [3.0, 5.5, 1.5, 3.25, 2.0, 0.5, 1.234]}
+    response = client.put("/selections/prices", json=body)
+    assert response.status_code == 200
+    result = response.json()
+    assert result["updated"] == 1
+    assert {error["id"]: error["error"] for error in result["errors"]} == {
+        ids[1]: "price should be between 1.01 and 1000.0",
+        ids[2]: "price should be a multiple of 0.01",
+        999999: "Selection not found"}
+    rows = execute_query(f"SELECT id, price FROM selections WHERE id in ({ids[0]}, {ids[1]}, {ids[2]}) ORDER BY id")
+    # the last price of a repeated id is used, the rejected prices are not written
+    assert [row['price'] for row in rows] == [325, selections[1]['price'], selections[2]['price']]
+
+    response = client.put("/selections/prices", json={"id": [1, 2], "price": [2.0]})
+    assert response.status_code == 422
+
+def test_search_price():
+    body = {"table_name": "selections", "select": {"keys": ["selection_name", "price"]},
+            "conditions": [{"key": "price", "operator": "between", "value": [3.24, 3.25]}]}
+    response = client.post("/search", json=body)
+    assert response.status_code == 200
+    assert {"selection_name": "bookhome", "price": 3.25} in response.json()
+    assert all(3.24 <= row["price"] <= 3.25 for row in response.json())
+
+def test_search_price_between_ticks():
+    # prices between two ticks are not rounded to the nearest tick, bookhome is at 3.25
+    for operator, value, found in (("=", 3.25, True), ("=", 3.254, False), ("=", 3.246, False),
+                                   (">=", 3.246, True), (">=", 3.254, False),
+                                   (">", 3.246, True), (">", 3.254, False),
+                                   ("<=", 3.254, True), ("<=", 3.246, False),
+                                   ("<", 3.254, True), ("<", 3.246, False),
+                                   ("between", [3.246, 3.254], True), ("between", [3.251, 3.259], False)):
+        body = {"table_name": "selections", "select": {"keys": ["selection_name"]},
+                "conditions": [{"key": "selection_name", "operator": "=", "value": "bookhome"},
+                               {"key": "price", "operator": operator, "value": value}]}
+        response = client.post("/search", json=body)
+        assert response.status_code == 200
+        assert (response.json() == [{"selection_name": "bookhome"}]) == found, (operator, value)
+
+def test_search_match():
+    for name in ("fuzzyballroom", "ballfuzzy", "fuzzyball"):
+        assert client.post("/sport", json={"sport_name": name, "slug": name, "active": True}).status_code == 200
+    body = {"table_name": "sports", "conditions": [{"key": "sport_name", "operator": "match", "value": "FUZZY"}]}
+    response = client.post("/search", json=body)
+    assert response.status_code == 200
+    # names starting with the value come first, shorter names first
+    assert [row['sport_name'] for row in response.json()] == ["fuzzyball", "fuzzyballroom", "ballfuzzy"]
+
+    body["conditions"][0]["operator"] = "prefix"
+    response = client.post("/search", json=body)
+    assert [row['sport_name'] for row in response.json()] == ["fuzzyball", "fuzzyballroom"]
+
+    # the index follows renames
+    sport_id = execute_query("select id from sports where sport_name = 'fuzzyball'")[0]['id']
+    response = client.put("/sport", json={"update": {"sport_name": "fuzzydice"}, "condition": {"id": sport_id}})
+    assert response.status_code == 200
+    body["conditions"][0] = {"key": "sport_name", "operator": "match", "value": "dice"}
+    assert [row['sport_name'] for row in client.post("/search", json=body).json()] == ["fuzzydice"]
+
+    body["conditions"][0]["value"] = "di"
+    assert client.post("/search", json=body).status_code == 400
+
+def test_tree():
+    client.post("/sport", json={"sport_name": "treesport", "slug": "treesport", "active": True})
+    for event_name, status in (("treeone", "pending"), ("treetwo", "started"), ("treeempty", "pending")):
+        client.post("/event", json={"event_name": event_name, "slug": event_name, "active": True, "type": "preplay",
+                                    "sport_name": "treesport", "status": status, "scheduled_start": "2024-01-01T00:00:00"})
+    for selection_name, event_name, active in (("treehome", "treeone", True), ("treeaway", "treeone", False),
+                                               ("treedraw", "treetwo", True)):
+        client.post("/selection", json={"selection_name": selection_name, "event_name": event_name,
+                                        "price": 2.5, "active": active, "outcome": "unsettled"})
+    sport_id = execute_query("SELECT id FROM sports WHERE sport_name = 'treesport'")[0]['id']
+
+    response = client.get(f"/sport/{sport_id}/tree")
+    assert response.status_code == 200
+    tree = response.json()
+    assert tree["sport_name"] == "treesport"
+    assert {event["event_name"]: [selection["selection_name"] for selection in event["selections"]]
+            for event in tree["events"]} == {"treeone": ["treehome", "treeaway"], "treetwo": ["treedraw"], "treeempty": []}
+    assert tree["events"][0]["selections"][0]["price"] == 2.5
+
+    response = client.get(f"/sport/{sport_id}/tree", params={"active_only": True, "status": ["pending"]})
+    assert [(event["event_name"], [selection["selection_name"] for selection in event["selections"]])
+            for event in response.json()["events"]] == [("treeone", ["treehome"]), ("treeempty", [])]
+
+    event_id = tree["events"][1]["id"]
+    response = client.get(f"/event/{event_id}/tree")
+    assert response.status_code == 200
+    assert [selection["selection_name"] for selection in response.json()["selections"]] == ["treedraw"]
+
+    assert client.get(f"/sport/{sport_id}/tree", params={"status": ["finished"]}).status_code == 400
+    assert client.get("/sport/999999/tree").status_code == 400
@@ -0,0 +1,155 @@
+import asyncio
+import sqlite3
+import pytest
+
+from sportsbook.database import ConnectionPool, begin, close_pool, get_db, get_db_path, fetch_row, fetch_values, insert_values, open_pool, query_cache, WriteCoalescer
+
+def test_connection_pool():
+    async def run():
+        pool = ConnectionPool(get_db_path(), readers=2)
+        await pool.open()
+        try:
+            async with pool.reader() as first:
+                async with pool.reader() as second:
+                    assert first is not second
+                    with pytest.raises(sqlite3.OperationalError):
+                        await first.execute("CREATE TABLE not_allowed (id INTEGER)")
+            async with pool.reader() as reused:
+                assert reused in (first, second)
+            async with pool.writer() as writer:
+                rows = await writer.execute_fetchall("PRAGMA busy_timeout")
+                assert rows[0][0] == 5000
+        finally:
+            await pool.close()
+    asyncio.run(run())
+
+def test_query_cache():
+    async def run():
+        query_cache.clear()
+        row = await fetch_row("sports", 1)
+        assert row['id'] == 1
+        hits = query_cache.hits
+        assert (await fetch_row("sports", 1)) == row
+        assert query_cache.hits == hits + 1
+
+        query = "SELECT * FROM sports WHERE id = ?"
+        rows = await fetch_values(query, [1], cache=True)
+        assert (await fetch_values(query, [1], cache=True)) is rows
+
+        # a write drops the row and every search on the table
+        await insert_values("UPDATE sports set slug = :slug WHERE id = :id RETURNING id", {"slug": "cached", "id": 1})
+        assert (await fetch_row("sports", 1))['slug'] == "cached"
+        assert (await fetch_values(query, [1], cache=True))[0]['slug'] == "cached"
+    asyncio.run(run())
+
+def test_begin_retries_when_locked():
+    async def run():
+        pool = ConnectionPool(get_db_path(), readers=1, pragmas={"busy_timeout": 0})
+        await pool.open()
+        other = sqlite3.connect(get_db_path(), isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        asyncio.get_running_loop().call_later(0.1, other.execute, "COMMIT")
+        try:
+            async with pool.writer() as writer:
+                await begin(writer)
+                await writer.execute("COMMIT")
+        finally:
+            other.close()
+            await pool.close()
+    asyncio.run(run())
+
+def test_write_coalescer():
+    async def run():
+        coalescer = WriteCoalescer(enabled=True, delay=0.01)
+        written = []
+        async def cascade(rows, database):
+            written.extend(rows)
+        coalescer.cascades["selections"] = cascade
+        committed = []
+        async def on_commit(table_name, rows):
+            committed.extend((table_name, row["id"]) for row in rows)
+        coalescer.on_commit = on_commit
+        try:
+            rows = await asyncio.gather(*[coalescer.submit("selections", 1 + number % 2, {"price": 10 + number})
+                                          for number in range(20)])
+            missing = await coalescer.submit("selections", 999999, {"price": 1})
+        finally:
+            await coalescer.close()
+        stats = coalescer.stats()
+        assert stats["submitted"] == 21
+        assert stats["batches"] < stats["submitted"]
+        # every caller of a merged update gets the row with the last value
+        assert {row["price"] for row in rows if row["id"] == 1} == {28}
+        assert {row["price"] for row in rows if row["id"] == 2} == {29}
+        assert missing is None
+        assert {row["id"] for row in written} == {1, 2}
+        assert set(committed) == {("selections", 1), ("selections", 2)}
+    asyncio.run(run())
+
+def test_write_coalescer_listener_fails(caplog):
+    async def run():
+        coalescer = WriteCoalescer(enabled=True, delay=0.01)
+        async def cascade(rows, database):
+            return [{"id": row["id"]} for row in rows]
+        coalescer.cascades["selections"] = cascade
+        committed = []
+        async def on_commit(table_name, rows):
+            if table_name == "selections":
+                raise RuntimeError("listener failed")
+            committed.append(table_name)
+        coalescer.on_commit = on_commit
+        try:
+            row = await coalescer.submit("selections", 1, {"price": 30})
+        finally:
+            await coalescer.close()
+        assert row["price"] == 30
+        # the other tables are still notified and the failure is logged
+        assert committed == ["events"]
+        assert "listener failed" in caplog.text
+        assert (await fetch_row("selections", 2))["price"] == 29
+    asyncio.run(run())
+
+def test_compact_changes():
+    async def run():
+        from sportsbook.changes import change_feed, compact_changes
+        await insert_values("UPDATE changes SET changed_at = datetime('now', '-2 days') WHERE seq <= 2")
+        assert await compact_changes(86400) == 2
+        page = await change_feed.read(0, 10)
+        assert page['truncated']
+        assert page['changes'][0]['seq'] == 3
+        assert not (await change_feed.read(2, 10))['truncated']
+    asyncio.run(run())
+
+def test_cache_sees_other_workers(tmp_path, monkeypatch):
+    path = str(tmp_path / "workers.db")
+    monkeypatch.setenv("DB_PATH", path)
+
+    async def run():
+        await open_pool()
+        try:
+            await insert_values("INSERT INTO sports (sport_name, slug, active) VALUES ('one', 'one', true)")
+            assert len(await fetch_values("SELECT * FROM sports", cache=True)) == 1
+            logged_writes = query_cache.logged_writes
+            # another worker writes through its own connection
+            other = sqlite3.connect(path)
+            other.execute("INSERT INTO sports (sport_name, slug, active) VALUES ('two', 'two', true)")
+            other.commit()
+            other.close()
+            assert len(await fetch_values("SELECT * FROM sports", cache=True)) == 2
+            assert query_cache.logged_writes == logged_writes + 1
+            await insert_values("INSERT INTO sports (sport_name, slug, active) VALUES ('three', 'three', true)")
+            assert len(await fetch_values("SELECT * FROM sports", cache=True)) == 3
+
+            # a hit is checked without waiting for the writer
+            query = "SELECT * FROM sports WHERE id = ?"
+            rows = await fetch_values(query, [1], cache=True)
+            async with get_db(write=True) as writer:
+                slow = asyncio.create_task(writer.execute_fetchall(
+                    "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c WHERE x < 2000000) SELECT count(*) FROM c"))
+                await asyncio.sleep(0.01)
+                assert (await asyncio.wait_for(fetch_values(query, [1], cache=True), 0.2)) is rows
+                assert not slow.done()
+                await slow
+        finally:
+            await close_pool()
+    asyncio.run(run())
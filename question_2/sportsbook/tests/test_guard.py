@@ -0,0 +1,80 @@
+import asyncio
+import json
+import pytest
+from fastapi.testclient import TestClient
+
+from sportsbook.__main__ import app
+from sportsbook.database import fetch_values
+from sportsbook.exception import QueryCostException, SearchTimeoutException
+from sportsbook.guard import check_cost, scanned_tables, search_limiter
+from sportsbook.queries import build_search_query
+from sportsbook.models import Search
+
+client = TestClient(app)
+
+def test_scanned_tables():
+    query, values = build_search_query(Search(table_name="events", conditions=[{"key": "slug", "operator": "like", "value": "%x%"}]))
+    assert asyncio.run(scanned_tables(query, values)) == ("events",)
+    # names are looked up in the full text index
+    query, values = build_search_query(Search(table_name="events", conditions=[{"key": "event_name", "operator": "like", "value": "%x%"}]))
+    assert asyncio.run(scanned_tables(query, values)) == ()
+    # every selection is read when the events are joined without a filter on them
+    query, values = build_search_query(Search(table_name="selections", select={"table_name": "events", "join_key": "event_name"},
+                                              conditions=[{"key": "outcome", "operator": "like", "value": "%x%"}]))
+    assert asyncio.run(scanned_tables(query, values)) == ("events", "selections")
+
+def test_check_cost(monkeypatch):
+    client.post("/sport", json={"sport_name": "guarded", "slug": "guarded", "active": True})
+    query, values = build_search_query(Search(table_name="sports"))
+    asyncio.run(check_cost(query, values))
+    with pytest.raises(QueryCostException):
+        asyncio.run(check_cost(query, values, max_rows=0))
+
+    monkeypatch.setenv("SEARCH_MAX_SCAN_ROWS", "0")
+    assert client.post("/search", json={"table_name": "sports"}).status_code == 400
+    # a page without filters reads only up to its limit
+    assert client.post("/search", json={"table_name": "sports", "limit": 10}).status_code == 200
+    # a page filtered on a column without an index may read the whole table to fill it
+    filtered = {"table_name": "sports", "limit": 10, "conditions": [{"key": "slug", "operator": "=", "value": "guarded"}]}
+    assert client.post("/search", json=filtered).status_code == 400
+    # a page filtered through an index is not
+    filtered["conditions"] = [{"key": "active", "operator": "=", "value": True}]
+    assert client.post("/search", json=filtered).status_code == 200
+
+def test_deadline():
+    slow = "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n) SELECT count(*) FROM n"
+    with pytest.raises(SearchTimeoutException):
+        asyncio.run(fetch_values(slow, timeout=0.05))
+    # the connection goes back to the pool without the deadline
+    assert asyncio.run(fetch_values("SELECT 1 AS one", timeout=0.05)) == [{"one": 1}]
+
+def test_search_limit(monkeypatch):
+    monkeypatch.setattr(search_limiter, "limit", 0)
+    response = client.post("/search", json={"table_name": "sports"})
+    assert response.status_code == 429
+    assert response.headers["retry-after"] == "1"
+    monkeypatch.undo()
+    assert client.post("/search", json={"table_name": "sports"}).status_code == 200
+    # a streamed search holds its slot until the stream is sent
+    response = client.post("/search", json={"table_name": "sports"}, headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert client.get("/searches").json()["running"] == 0
+
+def test_search_stream_slot_released():
+    # the client is gone before the body is sent, the slot is released without the body being read
+    body = json.dumps({"table_name": "sports"}).encode()
+    scope = {"type": "http", "method": "POST", "path": "/search", "raw_path": b"/search", "query_string": b"",
+             "root_path": "", "scheme": "http", "server": ("testserver", 80), "client": ("testclient", 50000),
+             "http_version": "1.1", "headers": [(b"content-type", b"application/json"), (b"accept", b"application/x-ndjson")]}
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            raise OSError("client disconnected")
+
+    with pytest.raises(OSError):
+        asyncio.run(app(scope, receive, send))
+    assert search_limiter.stats()["running"] == 0
@@ -0,0 +1,50 @@
+import asyncio
+from datetime import datetime, timezone
+from fastapi.testclient import TestClient
+
+from sportsbook.__main__ import app
+from sportsbook.lifecycle import LifecycleScheduler, start_timestamp
+
+from conftest import execute_query
+
+client = TestClient(app)
+
+def test_start_timestamp():
+    assert start_timestamp("2024-01-01 00:00:00") == datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    assert start_timestamp("2024-01-01T02:00:00+02:00") == datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    assert start_timestamp("soon") is None
+
+def test_start_due_events():
+    client.post("/sport", json={"sport_name": "lifesport", "slug": "lifesport", "active": True})
+    for event_name, scheduled_start in (("lifepast", "2024-01-01T00:00:00"), ("lifemoved", "2024-01-01T00:00:00"),
+                                        ("lifefuture", "2999-01-01T00:00:00")):
+        client.post("/event", json={"event_name": event_name, "slug": event_name, "active": True, "type": "preplay",
+                                    "sport_name": "lifesport", "status": "pending", "scheduled_start": scheduled_start})
+    rows = execute_query("SELECT * FROM events WHERE event_name IN ('lifepast', 'lifemoved', 'lifefuture') ORDER BY id")
+    ids = {row['event_name']: row['id'] for row in rows}
+
+    async def run():
+        scheduler = LifecycleScheduler()
+        scheduler.schedule(rows)
+        # moved to later after it was scheduled, its first entry is skipped
+        scheduler.schedule([{"id": ids["lifemoved"], "status": "pending", "scheduled_start": "2999-01-01T00:00:00"}])
+        now = datetime(2025, 1, 1, tzinfo=timezone.utc).timestamp()
+        started = await scheduler.start_due(now)
+        assert [row['id'] for row in started] == [ids["lifepast"]]
+        assert await scheduler.start_due(now) == []
+        # a stale schedule does not start an event before its start in the table
+        scheduler.schedule([{"id": ids["lifefuture"], "status": "pending", "scheduled_start": "2024-06-01T00:00:00"}])
+        assert await scheduler.start_due(now) == []
+        return scheduler.stats()
+    stats = asyncio.run(run())
+    assert stats["started"] == 1
+    assert stats["pending"] == 1
+    assert stats["last_lag"] == datetime(2025, 1, 1).timestamp() - datetime(2024, 1, 1).timestamp()
+
+    rows = execute_query("SELECT event_name, status, actual_start FROM events WHERE event_name IN ('lifepast', 'lifefuture') ORDER BY id")
+    assert rows == [{"event_name": "lifepast", "status": "started", "actual_start": "2025-01-01 00:00:00+00:00"},
+                    {"event_name": "lifefuture", "status": "pending", "actual_start": None}]
+    # the actual start is written as the api writes dates, so a date search finds it
+    response = client.post("/search", json={"table_name": "events", "select": {"keys": ["event_name"]},
+                                            "conditions_date": [{"key": "actual_start", "operator": "=", "value": "2025-01-01T00:00:00Z"}]})
+    assert response.json() == [{"event_name": "lifepast"}]
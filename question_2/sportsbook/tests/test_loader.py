@@ -0,0 +1,31 @@
+import json
+import sqlite3
+
+from sportsbook.loader import load_files
+
+def test_load_files(tmp_path):
+    sports = tmp_path / "sports.csv"
+    sports.write_text("sport_name,slug,active\nfootball,football,true\nbad!,bad,true\n")
+    events = tmp_path / "events.ndjson"
+    events.write_text("\n".join(json.dumps(event) for event in [
+        {"event_name": "final", "slug": "final", "active": True, "type": "preplay", "sport_name": "football",
+         "status": "pending", "scheduled_start": "2030-01-01T10:00:00Z"},
+        {"event_name": "other", "slug": "other", "active": True, "type": "preplay", "sport_name": "tennis",
+         "status": "pending", "scheduled_start": "2030-01-01T10:00:00Z"},
+    ]))
+    selections = tmp_path / "selections.csv"
+    selections.write_text("selection_name,event_name,price,active,outcome\n"
+                          + "".join(f"home{i},final,1.5,true,unsettled\n" for i in range(5))
+                          + "home1,final,1.5,true,unsettled\n"
+                          + "home9,final,1.234,true,unsettled\n")
+    messages = []
+    results = load_files(str(tmp_path / "load.db"),
+                         {"sports": [str(sports)], "events": [str(events)], "selections": [str(selections)]},
+                         batch_size=4, out=messages.append)
+
+    assert [(result['loaded'], result['rejected']) for result in results] == [(1, 1), (1, 1), (5, 2)]
+    connection = sqlite3.connect(tmp_path / "load.db")
+    assert connection.execute("SELECT count(*) FROM selections s JOIN events e ON e.id = s.event_id "
+                              "WHERE e.event_name = 'final'").fetchone()[0] == 5
+    assert connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    connection.close()
@@ -0,0 +1,33 @@
+from fastapi.testclient import TestClient
+
+from sportsbook.__main__ import app
+from sportsbook.metrics import Metrics, normalize_sql
+
+client = TestClient(app)
+
+def test_normalize_sql():
+    assert normalize_sql("SELECT *\n  FROM events WHERE id IN (?, ?,?)") == "SELECT * FROM events WHERE id IN (?...)"
+    assert normalize_sql("SELECT * FROM events WHERE id IN (?)") == "SELECT * FROM events WHERE id IN (?)"
+
+def test_render():
+    registry = Metrics()
+    registry.observe_query("SELECT 1 WHERE 'a' = ?", 0.002, 2)
+    text = registry.render({"sportsbook_pool_readers": ("Pooled connections readers", 4.0)})
+    assert "sportsbook_pool_readers 4.0" in text
+    assert 'sportsbook_query_duration_seconds_count{statement="SELECT 1 WHERE \'a\' = ?"} 1' in text
+    assert 'sportsbook_query_rows_total{statement="SELECT 1 WHERE \'a\' = ?"} 2' in text
+
+    # nothing is timed when metrics are off
+    registry = Metrics(enabled=False)
+    registry.observe_query("SELECT 1", 0.002, 1)
+    assert registry.queries.series == {}
+
+def test_metrics_endpoint():
+    client.post("/search", json={"table_name": "sports"})
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'sportsbook_request_duration_seconds_count{method="POST",route="/search",status="200"}' in response.text
+    assert 'sportsbook_query_duration_seconds_count{statement="SELECT sports.* FROM sports"}' in response.text
+    assert 'sportsbook_connection_wait_seconds_count{connection="reader"}' in response.text
+    assert "sportsbook_pool_idle_readers" in response.text
@@ -0,0 +1,20 @@
+import asyncio
+
+from sportsbook.pubsub import Broker, format_event
+
+def test_broker():
+    async def run():
+        broker = Broker(size=2)
+        first = broker.subscribe({("sports", 1)})
+        second = broker.subscribe({("sports", 2)})
+        await broker.publish("sports", [{"id": 1, "active": False}, {"id": 2, "active": True}])
+        assert (await first.get())["row"] == {"id": 1, "active": False}
+        assert (await second.get())["row"] == {"id": 2, "active": True}
+        assert first.queue.empty() and second.queue.empty()
+
+        # a subscriber that does not read is dropped once its queue is full
+        await broker.publish("sports", [{"id": 1, "active": True}] * 3)
+        assert first.dropped
+        assert broker.stats() == {"subscribers": 1, "published": 5, "dropped": 1}
+        assert format_event(await first.get()) == 'event: sports\ndata: {"id": 1, "active": true}\n\n'
+    asyncio.run(run())
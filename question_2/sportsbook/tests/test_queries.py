@@ -0,0 +1,80 @@
+import base64
+import pytest
+
+from sportsbook.models import Search
+from sportsbook.queries import build_search_query, compile_search, decode_cursor
+from sportsbook.exception import InvalidQueryException
+
+def test_search_is_parameterized():
+    search = Search(table_name="selections", conditions=[{"key": "price", "operator": "between", "value": [1, 2]},
+                                                         {"key": "event_name", "operator": "like", "value": "test%"}])
+    query, values = build_search_query(search)
+    assert query == ("SELECT selections.* FROM selections WHERE selections.price between ? AND ? "
+                     "AND selections.event_id IN (SELECT rowid FROM events_fts WHERE event_name LIKE ?)")
+    # prices are compared as stored, in hundredths
+    assert values == [100, 200, "test%"]
+
+def test_search_values_are_scalars():
+    for value in ([1, 2], {"id": 1}):
+        with pytest.raises(InvalidQueryException):
+            build_search_query(Search(table_name="sports", conditions=[{"key": "id", "operator": "=", "value": value}]))
+    with pytest.raises(InvalidQueryException):
+        build_search_query(Search(table_name="sports", conditions=[{"key": "id", "operator": "between", "value": [1, [2]]}]))
+    with pytest.raises(InvalidQueryException):
+        build_search_query(Search(table_name="events", conditions_date=[{"key": "scheduled_start", "operator": "=",
+                                                                         "value": ["2024-01-01T00:00:00Z"]}]))
+
+def test_decode_cursor():
+    assert decode_cursor(base64.urlsafe_b64encode(b'[1.5, 7]').decode(), "price") == [1.5, 7]
+    for position in (b'[{"x": 1}]', b'[[1]]', b'[null]', b'{"id": 1}'):
+        with pytest.raises(InvalidQueryException):
+            decode_cursor(base64.urlsafe_b64encode(position).decode(), "id")
+
+def test_search_shape_is_cached():
+    compile_search.cache_clear()
+    first = Search(table_name="sports", conditions=[{"key": "sport_name", "operator": "=", "value": "a"}])
+    second = Search(table_name="sports", conditions=[{"key": "sport_name", "operator": "=", "value": "b"}])
+    assert build_search_query(first)[0] == build_search_query(second)[0]
+    assert compile_search.cache_info().hits == 1
+    assert compile_search.cache_info().misses == 1
+
+def test_search_unknown_column():
+    search = Search(table_name="sports", conditions=[{"key": "1=1 or sport_name", "operator": "=", "value": "a"}])
+    with pytest.raises(InvalidQueryException):
+        build_search_query(search)
+    with pytest.raises(InvalidQueryException):
+        build_search_query(Search(table_name="sqlite_master"))
+
+def test_count_children_reads_counters():
+    search = Search(table_name="selections", select={"keys": "count"},
+                    conditions=[{"key": "active", "operator": "=", "value": True},
+                                {"key": "event_name", "operator": "=", "value": "final"}])
+    query, values = build_search_query(search)
+    assert query == ("SELECT coalesce((SELECT CASE ?1 WHEN 1 THEN active WHEN 0 THEN total - active ELSE 0 END "
+                     "FROM event_counts WHERE event_id = (SELECT id FROM events WHERE event_name = ?2)), 0) AS count")
+    assert values == [True, "final"]
+
+    # anything but equality on the parent and active is counted from the table
+    search = Search(table_name="events", select={"keys": "count"},
+                    conditions=[{"key": "sport_id", "operator": "=", "value": 1},
+                                {"key": "status", "operator": "=", "value": "pending"}])
+    assert "sport_counts" not in build_search_query(search)[0]
+
+def test_match_search():
+    search = Search(table_name="sports", conditions=[{"key": "sport_name", "operator": "match", "value": 'ba"ll'}])
+    query, values = build_search_query(search)
+    assert query == ("SELECT sports.* FROM sports WHERE sports.id IN (SELECT rowid FROM sports_fts WHERE sports_fts MATCH ?) "
+                     "ORDER BY instr(lower(sports.sport_name), lower(?)), length(sports.sport_name), sports.sport_name")
+    # the value is searched as one quoted phrase, not as a full text query
+    assert values == ['"ba""ll"', 'ba"ll']
+
+    search = Search(table_name="events", conditions=[{"key": "sport_name", "operator": "prefix", "value": "foot"}])
+    query, values = build_search_query(search)
+    assert query == "SELECT events.* FROM events WHERE events.sport_id IN (SELECT rowid FROM sports_fts WHERE sport_name LIKE ?)"
+    assert values == ["foot%"]
+
+    # full text conditions only work on names and need enough characters for the trigrams
+    with pytest.raises(InvalidQueryException):
+        build_search_query(Search(table_name="events", conditions=[{"key": "slug", "operator": "match", "value": "foot"}]))
+    with pytest.raises(InvalidQueryException):
+        build_search_query(Search(table_name="sports", conditions=[{"key": "sport_name", "operator": "match", "value": "fo"}]))
@@ -0,0 +1,71 @@
+import sqlite3
+
+from sportsbook.schema import migrate, MIGRATIONS, SCHEMA_VERSION
+from sportsbook.queries import UPDATE_SPORT_EVENT, UPDATE_EVENT_SELECTION
+
+def query_plan(query, values):
+    connection = sqlite3.connect("test.db")
+    rows = connection.execute(f"EXPLAIN QUERY PLAN {query}", values).fetchall()
+    connection.close()
+    return " ".join(row[-1] for row in rows)
+
+def test_migrate_is_idempotent():
+    assert migrate("test.db") == SCHEMA_VERSION
+    connection = sqlite3.connect("test.db")
+    assert connection.execute("PRAGMA user_version").fetchone()[0] == SCHEMA_VERSION
+    connection.close()
+
+def test_cascade_queries_use_counters():
+    plan = query_plan(UPDATE_SPORT_EVENT, {"sport_ids": "[1]"})
+    assert "sport_counts" in plan
+    assert "events" not in plan
+
+    plan = query_plan(UPDATE_EVENT_SELECTION, {"event_ids": "[1]"})
+    assert "event_counts" in plan
+    assert "selections" not in plan
+
+def test_counter_triggers():
+    connection = sqlite3.connect("test.db", isolation_level=None)
+    counters = "SELECT coalesce(max(total), 0), coalesce(max(active), 0) FROM sport_counts WHERE sport_id = 1"
+    try:
+        connection.execute("BEGIN")
+        total, active = connection.execute(counters).fetchone()
+        connection.execute("INSERT INTO events (event_name, slug, active, type, sport_id, status, scheduled_start) VALUES ('counted', 'counted', 1, 'preplay', 1, 'pending', '2024-01-01')")
+        assert connection.execute(counters).fetchone() == (total + 1, active + 1)
+        connection.execute("UPDATE events SET active = 0 WHERE event_name = 'counted'")
+        assert connection.execute(counters).fetchone() == (total + 1, active)
+        connection.execute("UPDATE events SET sport_id = NULL WHERE event_name = 'counted'")
+        assert connection.execute(counters).fetchone() == (total, active)
+    finally:
+        connection.execute("ROLLBACK")
+        connection.close()
+
+def test_migrate_names_to_ids(tmp_path):
+    path = str(tmp_path / "names.db")
+    connection = sqlite3.connect(path, isolation_level=None)
+    for statement in [statement for migration in MIGRATIONS[:2] for statement in migration]:
+        connection.execute(statement)
+    connection.execute("PRAGMA user_version = 2")
+    connection.execute("INSERT INTO sports (sport_name, slug, active) VALUES ('football', 'football', 1)")
+    connection.execute("INSERT INTO events (event_name, slug, active, type, sport_name, status, scheduled_start) VALUES ('final', 'final', 1, 'preplay', 'football', 'pending', '2030-01-01')")
+    connection.execute("INSERT INTO events (event_name, slug, active, type, sport_name, status, scheduled_start) VALUES ('orphan', 'orphan', 1, 'preplay', 'unknown', 'pending', '2030-01-01')")
+    connection.execute("INSERT INTO selections (selection_name, event_name, price, active, outcome) VALUES ('home', 'final', 1.5, 1, 'unsettled')")
+    assert migrate(path) == SCHEMA_VERSION
+    # the parents are referenced by id, a name without a parent becomes NULL
+    assert connection.execute("SELECT e.event_name, s.sport_name FROM events e LEFT JOIN sports s ON s.id = e.sport_id ORDER BY e.id").fetchall() == [('final', 'football'), ('orphan', None)]
+    assert connection.execute("SELECT e.event_name FROM selections s JOIN events e ON e.id = s.event_id").fetchall() == [('final',)]
+    assert connection.execute("SELECT total, active FROM sport_counts").fetchall() == [(1, 1)]
+    connection.close()
+
+def test_migrate_prices_to_hundredths(tmp_path):
+    path = str(tmp_path / "prices.db")
+    connection = sqlite3.connect(path, isolation_level=None)
+    for statement in [statement for migration in MIGRATIONS[:5] for statement in migration]:
+        connection.execute(statement)
+    connection.execute("PRAGMA user_version = 5")
+    connection.execute("INSERT INTO selections (selection_name, event_id, price, active, outcome) VALUES ('old', NULL, 1.1, 1, 'unsettled')")
+    assert migrate(path) == SCHEMA_VERSION
+    assert connection.execute("SELECT price, typeof(price) FROM selections").fetchone() == (110, 'integer')
+    connection.execute("UPDATE selections SET price = 215")
+    assert connection.execute("SELECT data ->> 'price' FROM changes ORDER BY seq DESC").fetchone() == (2.15,)
+    connection.close()
@@ -0,0 +1,42 @@
+import asyncio
+import json
+import logging
+from fastapi.testclient import TestClient
+
+from sportsbook.__main__ import app
+from sportsbook.database import fetch_values
+from sportsbook.slowlog import SlowQueryLog, redact, slow_queries
+
+client = TestClient(app)
+
+def test_redact():
+    assert redact(["home", 12, 1.5, None, True]) == ["<str 4>", 12, 1.5, None, True]
+    assert redact({"cond_event_name": "final", "cond_id": 3}) == {"cond_event_name": "<str 5>", "cond_id": 3}
+
+def test_slow_query_log(caplog):
+    threshold = slow_queries.threshold
+    slow_queries.clear()
+    # every statement is slow
+    slow_queries.threshold = 1e-9
+    try:
+        with caplog.at_level(logging.WARNING, logger="sportsbook.slow_queries"):
+            for name in ("first", "second"):
+                asyncio.run(fetch_values("SELECT * FROM events WHERE slug = ?", [name]))
+    finally:
+        slow_queries.threshold = threshold
+    logged = [json.loads(record.getMessage()) for record in caplog.records]
+    assert logged[0]["sql"] == "SELECT * FROM events WHERE slug = ?"
+    assert logged[0]["params"] == ["<str 5>"]
+    assert logged[0]["plan"] == ["SCAN events"]
+
+    response = client.get("/queries/slow")
+    assert response.status_code == 200
+    slow = [query for query in response.json()["queries"] if query["sql"] == "SELECT * FROM events WHERE slug = ?"][0]
+    assert slow["count"] == 2
+    assert slow["plan"] == ["SCAN events"]
+    assert slow["last_params"] == ["<str 6>"]
+
+def test_slow_query_log_disabled():
+    log = SlowQueryLog(threshold=0)
+    asyncio.run(log.record("SELECT 1", [], 10.0, None))
+    assert log.top(10) == []
@@ -0,0 +1,71 @@
+"""
+This python file is used to load a sport or an event with all its children as one nested tree
+Every level of the tree is read with one query, for all the parents of the level at once,
+and the children are ordered by parent so they are attached to their parents in one pass
+"""
+
+import json
+
+from .constants import Tables, PARENT_KEYS, VALID_EVENT_STATUS
+from .database import fetch_values
+from .exception import InvalidQueryException
+from .models import rows_from_db
+from .queries import TREE_CHILDREN, TREE_STATUS_CONDITION
+
+# table of the children of every table of the tree
+CHILD_TABLES = {Tables.SPORTS: Tables.EVENTS, Tables.EVENTS: Tables.SELECTIONS}
+
+
+def attach_children(parents: list[dict], children: list[dict], id_key: str, key: str):
+    """
+    Sets the children of every parent under key, in one pass over both lists
+    parents are ordered by id and children by their parent id, as read by TREE_CHILDREN
+    """
+    position = 0
+    for parent in parents:
+        start = position
+        while position < len(children) and children[position][id_key] == parent['id']:
+            position += 1
+        parent[key] = children[start:position]
+
+
+async def get_tree(table_name: str, root: dict, active_only: bool = False, statuses: list = None) -> dict:
+    """
+    Loads the children of the row down to the selections as a nested tree
+
+    Parameters
+    ----------
+    table_name : str
+        table of the root row, sports or events
+    root : dict
+        row the tree starts from
+    active_only : bool
+        only the active events and selections
+    statuses : list
+        only the events with one of these statuses, all of them when None
+
+    Returns
+    -------
+    dict
+        copy of the root row with its children under the name of their table, e.g.
+        a sport has its events under "events" and every event its selections under "selections"
+    """
+    if statuses and not set(statuses) <= set(VALID_EVENT_STATUS):
+        raise InvalidQueryException(f"Event status should be one among {VALID_EVENT_STATUS}")
+    tree = dict(root)
+    level = [tree]
+    while level and table_name in CHILD_TABLES:
+        child_table = CHILD_TABLES[table_name]
+        id_key = PARENT_KEYS[child_table][1]
+        values = [json.dumps([parent['id'] for parent in level]), active_only]
+        condition = ""
+        if child_table == Tables.EVENTS and statuses:
+            condition = TREE_STATUS_CONDITION
+            values.append(json.dumps(statuses))
+        rows = await fetch_values(TREE_CHILDREN.format(table_name=child_table, id_key=id_key, condition=condition),
+                                  values, cache=True)
+        # the cached rows are shared, so the rows that get children of their own are copied
+        children = rows_from_db(child_table, rows) if child_table not in CHILD_TABLES else [dict(row) for row in rows]
+        attach_children(level, children, id_key, child_table)
+        level, table_name = children, child_table
+    return tree